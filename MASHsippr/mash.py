@@ -1,13 +1,36 @@
 #!/usr/bin/env python
 from accessoryFunctions.accessoryFunctions import printtime, make_path, GenObject
+from MASHsippr.refseqindex import RefSeqIndex
+from MASHsippr.minhash import References, adaptivesketch, sketchreads, writesketches
+from sipprutilities.fileio import temporaryname
 from threading import Thread
-from subprocess import call
+from subprocess import call, Popen, PIPE
 from queue import Queue
+import heapq
+import numpy
 import os
 import re
 __author__ = 'adamkoziol'
 
 
+class Hit(object):
+    """
+    Line of mash dist outputs ordered as by sort -gk3: by distance, and for ties, by the whole line. The comparison is
+    reversed, so that the furthest of the retained hits is at the root of a heap, and can be replaced by a closer hit
+    """
+    __slots__ = ('distance', 'line')
+
+    def __lt__(self, other):
+        return (self.distance, self.line) > (other.distance, other.line)
+
+    def __init__(self, line):
+        """
+        :param line: line of mash dist outputs
+        """
+        self.distance = float(line.split('\t')[2])
+        self.line = line
+
+
 class Mash(object):
     def sketching(self):
         printtime('Indexing files for {} analysis'.format(self.analysistype), self.starttime)
@@ -28,7 +51,9 @@ class Mash(object):
             sample[self.analysistype].refseqsketch = os.path.join(sample[self.analysistype].targetpath,
                                                                   'RefSeqSketchesDefaults.msh')
             sample[self.analysistype].sketchfilenoext = os.path.join(sample[self.analysistype].reportdir, sample.name)
-            sample[self.analysistype].sketchfile = sample[self.analysistype].sketchfilenoext + '.msh'
+            # Sketches created by the native sketcher are written in the JSON format of mash info -d
+            sample[self.analysistype].sketchfile = sample[self.analysistype].sketchfilenoext + \
+                ('.json' if self.nativesketch else '.msh')
             # Make the mash output directory if necessary
             make_path(sample[self.analysistype].reportdir)
             # Create a file containing the path/name of the filtered, corrected fastq files
@@ -40,6 +65,9 @@ class Mash(object):
             # Create the system call
             sample.commands.sketch = 'mash sketch -m 2 -p {} -l {} -o {}' \
                 .format(self.cpus, sample[self.analysistype].filelist, sample[self.analysistype].sketchfilenoext)
+            # The reference sketches are required to decide when to stop adaptive sketching
+            if self.adaptivesketch:
+                self.reference(sample[self.analysistype].refseqsketch)
             # Add each sample to the threads
             try:
                 self.sketchqueue.put(sample)
@@ -53,66 +81,190 @@ class Mash(object):
     def sketch(self):
         while True:
             sample = self.sketchqueue.get()
-            if not os.path.isfile(sample[self.analysistype].sketchfile):
+            if self.adaptivesketch:
+                # Only sketch as many reads as are required for the closest reference genome to be settled
+                references = self.reference(sample[self.analysistype].refseqsketch)
+                self.sketches[sample.name] = [adaptivesketch(fastq, references, self.threads)
+                                              for fastq in sample.general.trimmedcorrectedfastqfiles]
+                if not os.path.isfile(sample[self.analysistype].sketchfile):
+                    writesketches(sample[self.analysistype].sketchfile, self.sketches[sample.name])
+            elif self.nativesketch:
+                # As with mash sketch -l, each FASTQ file is sketched separately. Sketches of previously sketched files
+                # are retrieved from the cache
+                self.sketches[sample.name] = [sketchreads(fastq, self.sketchcache, self.threads)
+                                              for fastq in sample.general.trimmedcorrectedfastqfiles]
+                if not os.path.isfile(sample[self.analysistype].sketchfile):
+                    writesketches(sample[self.analysistype].sketchfile, self.sketches[sample.name])
+            elif not os.path.isfile(sample[self.analysistype].sketchfile):
                 call(sample.commands.sketch, shell=True, stdout=self.fnull, stderr=self.fnull)
             self.sketchqueue.task_done()
 
     def mashing(self):
         printtime('Performing {} analyses'.format(self.analysistype), self.starttime)
-        # Create the threads for the analysis
-        for i in range(self.cpus):
-                threads = Thread(target=self.mash, args=())
-                threads.setDaemon(True)
-                threads.start()
-        # Populate threads for each gene, genome combination
+        # Group the samples by their reference sketch file, so that each reference sketch only needs to be loaded once
+        batches = dict()
         for sample in self.metadata:
             sample[self.analysistype].mashresults = os.path.join(sample[self.analysistype].reportdir, '{}.tab'.format(
                 sample.name))
+            # The full table of distances to every reference genome is written in the order in which the distances are
+            # calculated, so it is kept separate from the results table, which is sorted by distance
+            sample[self.analysistype].mashfulltable = os.path.join(sample[self.analysistype].reportdir,
+                                                                   '{}_full.tab'.format(sample.name))
+            if os.path.isfile(sample[self.analysistype].mashresults):
+                # Find the closest reference genomes in the existing results
+                with open(sample[self.analysistype].mashresults) as mashresults:
+                    self.besthits[sample.name] = self.closest(mashresults)
+            elif os.path.isfile(sample[self.analysistype].sketchfile):
+                batches.setdefault(sample[self.analysistype].refseqsketch, list()).append(sample)
+        for refseqsketch, samples in sorted(batches.items()):
+            if self.nativesketch:
+                self.besthits.update(self.nativemash(refseqsketch, samples))
+            else:
+                self.besthits.update(self.batchmash(refseqsketch, samples))
+        self.parse()
 
-            sample.commands.mash = \
-                'mash dist -p {} {} {} | sort -gk3 > {}'.format(self.threads,
-                                                                sample[self.analysistype].refseqsketch,
-                                                                sample[self.analysistype].sketchfile,
-                                                                sample[self.analysistype].mashresults)
+    def batchmash(self, refseqsketch, samples):
+        """
+        Calculate the distances between the reference sketch and the sketches of all the samples with a single call
+        of mash dist, rather than one call per sample, so that the (large) reference sketch is only loaded once
+        :param refseqsketch: name and path of the reference sketch file
+        :param samples: list of the metadata objects of the samples to query
+        :return: dictionary of sample name: list of the lines of mash dist outputs with the smallest distances
+        """
+        # The query IDs in the mash dist outputs are the names of the FASTQ files used to create the sample sketches
+        queries = dict()
+        for sample in samples:
+            for fastq in sample.general.trimmedcorrectedfastqfiles:
+                queries[fastq] = sample
+        command = ['mash', 'dist', '-p', str(self.cpus), refseqsketch] + \
+            [sample[self.analysistype].sketchfile for sample in samples]
+        for sample in samples:
+            sample.commands.mash = ' '.join(command)
+        # Only the closest reference genomes of each sample are kept in memory as the distances stream by
+        heaps = {sample.name: list() for sample in samples}
+        # Unless they are not desired, the full tables are written in the order in which mash dist outputs the
+        # distances, so they do not need to be sorted. The tables are written to temporary files, which are only
+        # renamed if mash dist succeeds, so that a failed run is repeated rather than parsed
+        tables = dict()
+        if self.mashtable:
+            tables = {sample.name: open(temporaryname(sample[self.analysistype].mashfulltable), 'w')
+                      for sample in samples}
+        process = Popen(command, stdout=PIPE, stderr=self.fnull, universal_newlines=True)
+        for line in process.stdout:
             try:
-                self.mashqueue.put(sample)
-            except (KeyboardInterrupt, SystemExit):
-                printtime('Received keyboard interrupt, quitting threads', self.starttime)
-                quit()
-        # Join the threads
-        self.mashqueue.join()
-        self.parse()
+                name = queries[line.split('\t')[1]].name
+                self.pushhit(heaps[name], line)
+            except (IndexError, KeyError, ValueError):
+                continue
+            if self.mashtable:
+                tables[name].write(line)
+        process.wait()
+        for table in tables.values():
+            table.close()
+        besthits = dict()
+        if process.returncode:
+            # Without results, the closest reference genomes of the samples are set to 'NA' when parsing
+            printtime('mash dist failed with exit code {} for the samples {}'
+                      .format(process.returncode, ', '.join(sample.name for sample in samples)), self.starttime)
+            for table in tables.values():
+                os.remove(table.name)
+            return besthits
+        for sample in samples:
+            besthits[sample.name] = self.sortedhits(heaps[sample.name])
+            if self.mashtable:
+                os.replace(tables[sample.name].name, sample[self.analysistype].mashfulltable)
+            # The closest reference genomes are written to the results table of the sample, sorted by distance
+            with open(sample[self.analysistype].mashresults, 'w') as mashresults:
+                mashresults.write(''.join(besthits[sample.name]))
+        return besthits
 
-    def mash(self):
-        while True:
-            sample = self.mashqueue.get()
-            # , stdout=self.fnull, stderr=self.fnull
-            if not os.path.isfile(sample[self.analysistype].mashresults):
-                call(sample.commands.mash, shell=True)
-            self.mashqueue.task_done()
+    def nativemash(self, refseqsketch, samples):
+        """
+        Calculate the distances between the reference sketches and the native sketches of the samples. The reference
+        sketches are loaded (and compiled on first use) once for all the samples
+        :param refseqsketch: name and path of the reference sketch file
+        :param samples: list of the metadata objects of the samples to query
+        :return: dictionary of sample name: list of the lines of mash dist outputs with the smallest distances
+        """
+        references = self.reference(refseqsketch)
+        besthits = dict()
+        for sample in samples:
+            heap = list()
+            # Without the full table, only the closest references of each sketch need to be output
+            limit = None if self.mashtable else self.mashhits
+            lines = (line for sketch in self.sketches[sample.name]
+                     for line in references.lines(sketch, limit, self.lsh))
+            if self.mashtable:
+                with open(sample[self.analysistype].mashfulltable, 'w') as mashtable:
+                    for line in lines:
+                        self.pushhit(heap, line)
+                        mashtable.write(line)
+            else:
+                for line in lines:
+                    self.pushhit(heap, line)
+            besthits[sample.name] = self.sortedhits(heap)
+            # The closest reference genomes are written to the results table of the sample, sorted by distance
+            with open(sample[self.analysistype].mashresults, 'w') as mashresults:
+                mashresults.write(''.join(besthits[sample.name]))
+        return besthits
+
+    def reference(self, refseqsketch):
+        """
+        Load reference sketches once, and reuse them for the remainder of the analyses
+        :param refseqsketch: name and path of the reference sketch file
+        :return: References object
+        """
+        if refseqsketch not in self.references:
+            self.references[refseqsketch] = References(refseqsketch)
+        return self.references[refseqsketch]
+
+    def closest(self, lines):
+        """
+        Find the closest reference genomes in mash dist outputs without sorting all the outputs
+        :param lines: iterable of lines of mash dist outputs
+        :return: list of the self.mashhits lines with the smallest distances, sorted by distance
+        """
+        heap = list()
+        for line in lines:
+            try:
+                self.pushhit(heap, line)
+            except (IndexError, ValueError):
+                continue
+        return self.sortedhits(heap)
+
+    def pushhit(self, heap, line):
+        """
+        Add a line of mash dist outputs to a heap of the self.mashhits closest reference genomes. Ties are broken by
+        the whole line, so the retained genomes are the same as those of sort -gk3 | head
+        :param heap: list used as the heap
+        :param line: line of mash dist outputs
+        """
+        hit = Hit(line)
+        if len(heap) < self.mashhits:
+            heapq.heappush(heap, hit)
+        elif heap[0] < hit:
+            heapq.heapreplace(heap, hit)
+
+    @staticmethod
+    def sortedhits(heap):
+        """
+        :param heap: heap populated by pushhit
+        :return: list of lines in the heap sorted by distance, and then by the whole line
+        """
+        return [hit.line for hit in sorted(heap, reverse=True)]
 
     def parse(self):
         printtime('Determining closest refseq genome', self.starttime)
-        # Create a dictionary to store the accession: taxonomy id of refseq genomes
-        refdict = dict()
         # Set the name of the file storing the assembly summaries
         referencefile = os.path.join(self.referencefilepath, self.analysistype, 'assembly_summary_refseq.txt')
-        # Extract the accession: genus species key: value pairs from the refseq summary file
-        with open(referencefile) as reffile:
-            for line in reffile:
-                # Ignore the first couple of lines
-                if line.startswith('# assembly_accession'):
-                    # Iterate through all the lines with data
-                    for accessionline in reffile:
-                        # Split the lines on tabs
-                        data = accessionline.split('\t')
-                        # Populate the dictionary with the accession: tax id e.g. GCF_001298055: Helicobacter pullorum
-                        refdict[data[0].split('.')[0]] = data[7]
+        # Use the (indexed) refseq summary file to look up the accession: genus species pairs
+        # e.g. GCF_001298055: Helicobacter pullorum
+        refdict = RefSeqIndex(referencefile)
         for sample in self.metadata:
 
             try:
-                # Open the results and extract the first line of data
-                mashdata = open(sample[self.analysistype].mashresults).readline().rstrip()
+                # Extract the line of data with the closest reference genome
+                mashdata = self.besthits[sample.name][0].rstrip()
                 # Split on tabs
                 data = mashdata.split('\t')
                 referenceid, queryid, sample[self.analysistype].mashdistance, sample[self.analysistype]. \
@@ -124,7 +276,7 @@ class Mash(object):
                 sample[self.analysistype].closestrefseq = refdict[refid]
                 sample[self.analysistype].closestrefseqgenus = sample[self.analysistype].closestrefseq.split()[0]
                 sample[self.analysistype].closestrefseqspecies = sample[self.analysistype].closestrefseq.split()[1]
-            except (KeyError, ValueError):
+            except (IndexError, KeyError, ValueError):
                 sample[self.analysistype].closestrefseq = 'NA'
                 sample[self.analysistype].closestrefseqgenus = 'NA'
                 sample[self.analysistype].closestrefseqspecies = 'NA'
@@ -133,20 +285,52 @@ class Mash(object):
                 sample[self.analysistype].nummatches = 'NA'
             # Set the closest refseq genus - will be used for all typing that requires the genus to be known
             sample.general.referencegenus = sample[self.analysistype].closestrefseqgenus
+        if self.screen:
+            self.screening(refdict)
+        refdict.close()
         self.reporter()
 
+    def screening(self, refdict):
+        """
+        Find all the genera with reference genomes contained in the reads of each sample, so that samples containing
+        multiple genera can be flagged
+        :param refdict: RefSeqIndex of the refseq summary file
+        """
+        printtime('Screening samples for multiple genera', self.starttime)
+        # The samples are screened one at a time, as each screen holds a flag for every reference hash in memory
+        for sample in self.metadata:
+            references = self.reference(sample[self.analysistype].refseqsketch)
+            containment = references.screen(sample.general.trimmedcorrectedfastqfiles, self.threads)
+            # Find the greatest containment of a reference of each genus
+            genera = dict()
+            for index in numpy.flatnonzero(containment >= self.containment):
+                try:
+                    genus = refdict[references.names[index].split('.')[0]].split()[0]
+                except (IndexError, KeyError):
+                    continue
+                genera[genus] = max(genera.get(genus, 0), float(containment[index]))
+            sample[self.analysistype].containedgenera = \
+                {genus: '{:.3f}'.format(genera[genus]) for genus in sorted(genera)}
+            sample[self.analysistype].multiple = len(genera) > 1
+
     def reporter(self):
         make_path(self.reportpath)
-        header = 'Strain,ReferenceGenus,ReferenceFile,ReferenceGenomeMashDistance,Pvalue,NumMatchingHashes\n'
+        header = 'Strain,ReferenceGenus,ReferenceFile,ReferenceGenomeMashDistance,Pvalue,NumMatchingHashes'
+        # Add the contained genera to the report when screening
+        header += ',ContainedGenera\n' if self.screen else '\n'
         data = ''
         for sample in self.metadata:
             try:
-                data += '{},{},{},{},{},{}\n'.format(sample.name,
-                                                     sample[self.analysistype].closestrefseqgenus,
-                                                     sample[self.analysistype].closestrefseq,
-                                                     sample[self.analysistype].mashdistance,
-                                                     sample[self.analysistype].pvalue,
-                                                     sample[self.analysistype].nummatches)
+                data += '{},{},{},{},{},{}'.format(sample.name,
+                                                   sample[self.analysistype].closestrefseqgenus,
+                                                   sample[self.analysistype].closestrefseq,
+                                                   sample[self.analysistype].mashdistance,
+                                                   sample[self.analysistype].pvalue,
+                                                   sample[self.analysistype].nummatches)
+                if self.screen:
+                    data += ',{}'.format(';'.join('{} ({})'.format(genus, containment) for genus, containment in
+                                                  sorted(sample[self.analysistype].containedgenera.items())))
+                data += '\n'
             except AttributeError:
                 data += '{}\n'.format(sample.name)
         # Create the report file
@@ -163,7 +347,58 @@ class Mash(object):
         self.cpus = inputobject.cpus
         self.threads = int(self.cpus / len(self.metadata)) if self.cpus / len(self.metadata) > 1 else 1
         self.sketchqueue = Queue(maxsize=self.cpus)
-        self.mashqueue = Queue(maxsize=4)
+        # Number of closest reference genomes to retain for each sample
+        try:
+            self.mashhits = int(inputobject.mashhits)
+        except AttributeError:
+            self.mashhits = 10
+        # Determine whether the full table of distances to every reference genome should be written for each sample
+        try:
+            self.mashtable = not inputobject.skipmashtable
+        except AttributeError:
+            self.mashtable = True
+        # Dictionary of sample name: mash dist outputs of the closest reference genomes
+        self.besthits = dict()
+        # Determine whether the samples should be sketched (and compared to the reference sketches) natively rather
+        # than with mash
+        try:
+            self.nativesketch = inputobject.nativesketch
+        except AttributeError:
+            self.nativesketch = False
+        # Folder in which the native sketches of the FASTQ files are cached
+        try:
+            self.sketchcache = inputobject.sketchcache if inputobject.sketchcache else \
+                os.path.join(self.referencefilepath, 'sketchcache')
+        except AttributeError:
+            self.sketchcache = os.path.join(self.referencefilepath, 'sketchcache')
+        # Determine whether the reads should only be sketched until the closest reference genome is settled. This
+        # requires the native sketcher
+        try:
+            self.adaptivesketch = inputobject.adaptivesketch
+        except AttributeError:
+            self.adaptivesketch = False
+        # Determine whether the native sketches should only be compared to the reference sketches sharing a band of
+        # the locality-sensitive hashing index
+        try:
+            self.lsh = inputobject.lsh
+        except AttributeError:
+            self.lsh = False
+        if self.adaptivesketch or self.lsh:
+            self.nativesketch = True
+        # Determine whether the reads should be screened for all the contained genera, and the minimum fraction of
+        # the hashes of a reference genome that must be present in the reads
+        try:
+            self.screen = inputobject.screen
+        except AttributeError:
+            self.screen = False
+        try:
+            self.containment = float(inputobject.containment)
+        except AttributeError:
+            self.containment = 0.1
+        # Dictionary of sample name: list of the native sketches of the FASTQ files of the sample
+        self.sketches = dict()
+        # Dictionary of reference sketch file: References object
+        self.references = dict()
         self.analysistype = analysistype
         self.pipeline = inputobject.pipeline
         self.fnull = open(os.devnull, 'w')  # define /dev/null
@@ -72,6 +72,38 @@ class MashSippr(object):
         else:
             self.runmetadata = MetadataObject()
         self.analysistype = 'mash'
+        try:
+            self.mashhits = int(args.mashhits)
+        except AttributeError:
+            self.mashhits = 10
+        try:
+            self.skipmashtable = args.skipmashtable
+        except AttributeError:
+            self.skipmashtable = False
+        try:
+            self.nativesketch = args.nativesketch
+        except AttributeError:
+            self.nativesketch = False
+        try:
+            self.sketchcache = args.sketchcache
+        except AttributeError:
+            self.sketchcache = None
+        try:
+            self.adaptivesketch = args.adaptivesketch
+        except AttributeError:
+            self.adaptivesketch = False
+        try:
+            self.lsh = args.lsh
+        except AttributeError:
+            self.lsh = False
+        try:
+            self.screen = args.screen
+        except AttributeError:
+            self.screen = False
+        try:
+            self.containment = float(args.containment)
+        except AttributeError:
+            self.containment = 0.1
         self.copy = False
         # Run the analyses
         self.runner()
@@ -125,6 +157,38 @@ if __name__ == '__main__':
                              'in the provided sample sheet will be used. Please note that bcl2fastq creates '
                              'subfolders using the project name, so if multiple names are provided, the results '
                              'will be split as into multiple projects')
+    parser.add_argument('--mashhits',
+                        default=10,
+                        help='Number of closest RefSeq genomes to retain for each sample. Default is 10')
+    parser.add_argument('--skipmashtable',
+                        action='store_true',
+                        help='Skip writing the distances to every RefSeq genome to sample_full.tab, in the order in '
+                             'which they are calculated. The closest RefSeq genomes are always written to sample.tab, '
+                             'sorted by distance')
+    parser.add_argument('--nativesketch',
+                        action='store_true',
+                        help='Sketch the reads, and calculate the distances to the RefSeq sketches, without calling '
+                             'mash. The RefSeq sketches are still read with mash info the first time they are used')
+    parser.add_argument('--sketchcache',
+                        help='Folder in which to cache the native sketches of FASTQ files. Defaults to '
+                             'targetpath/sketchcache')
+    parser.add_argument('--adaptivesketch',
+                        action='store_true',
+                        help='Natively sketch the reads in chunks, and stop once the closest RefSeq genome has not '
+                             'changed for several consecutive chunks. Implies --nativesketch')
+    parser.add_argument('--lsh',
+                        action='store_true',
+                        help='Only compare the samples to the RefSeq genomes sharing a band of a locality-sensitive '
+                             'hashing index of the RefSeq sketches. The index is built the first time it is used. '
+                             'Implies --nativesketch')
+    parser.add_argument('--screen',
+                        action='store_true',
+                        help='Screen the reads for every RefSeq genome contained in the reads, and report all the '
+                             'genera found. Samples with more than one genus are flagged as multiple')
+    parser.add_argument('--containment',
+                        default=0.1,
+                        help='Minimum fraction of the hashes of a RefSeq genome that must be present in the reads for '
+                             'the genome to be reported by the screen. Default is 0.1')
     # Get the arguments into an object
     arguments = parser.parse_args()
     arguments.pipeline = False
@@ -0,0 +1,614 @@
+#!/usr/bin/env python
+from fastsippr.fastqio import fastqchunks
+from fastsippr.kmers import canonical, encode, fmix
+from sipprutilities.fileio import atomicwrite, checksum
+from subprocess import Popen, PIPE
+import numpy
+import json
+import math
+import os
+__author__ = 'adamkoziol'
+
+# Default parameters of mash sketch
+KMER = 21
+SKETCHSIZE = 1000
+SEED = 42
+# Minimum number of copies of a k-mer required to include the k-mer in sketches of reads (mash sketch -m 2)
+MINCOUNT = 2
+# Number of bins into which the hashes are divided for locality-sensitive hashing, and the number of bins in each band
+LSHBINS = 128
+LSHROWS = 2
+# Upper case nucleotides corresponding to the two-bit codes of fastsippr.kmers
+BASES = numpy.frombuffer(b'ACGT', dtype=numpy.uint8)
+
+
+def rotl(values, bits):
+    """
+    Rotate the bits of 64-bit integers to the left
+    """
+    return (values << numpy.uint64(bits)) | (values >> numpy.uint64(64 - bits))
+
+
+def murmur3(data, length, seed=SEED):
+    """
+    Calculate the first 64 bits of the MurmurHash3_x64_128 hash of byte strings of the same length. This is the hash
+    used by mash, so the hashes (and therefore the sketches and distances) are identical to those of mash
+    :param data: two-dimensional array of bytes with one string per row. The number of columns must be a multiple of
+    16, and the bytes following the end of the strings must be zero
+    :param length: length of the strings
+    :param seed: seed of the hash function
+    :return: array of unsigned 64-bit hashes
+    """
+    c1 = numpy.uint64(0x87c37b91114253d5)
+    c2 = numpy.uint64(0x4cf5ad432745937f)
+    # Read the bytes as pairs of little-endian 64-bit words
+    words = numpy.ascontiguousarray(data).view('<u8').astype(numpy.uint64)
+    h1 = numpy.full(len(words), seed, dtype=numpy.uint64)
+    h2 = numpy.full(len(words), seed, dtype=numpy.uint64)
+    blocks = length // 16
+    for block in range(blocks):
+        k1 = words[:, 2 * block] * c1
+        k1 = rotl(k1, 31) * c2
+        h1 ^= k1
+        h1 = (rotl(h1, 27) + h2) * numpy.uint64(5) + numpy.uint64(0x52dce729)
+        k2 = words[:, 2 * block + 1] * c2
+        k2 = rotl(k2, 33) * c1
+        h2 ^= k2
+        h2 = (rotl(h2, 31) + h1) * numpy.uint64(5) + numpy.uint64(0x38495ab5)
+    # The bytes of the tail are followed by zeros, so the words can be used without masking
+    tail = length % 16
+    if tail > 8:
+        k2 = words[:, 2 * blocks + 1] * c2
+        h2 ^= rotl(k2, 33) * c1
+    if tail:
+        k1 = words[:, 2 * blocks] * c1
+        h1 ^= rotl(k1, 31) * c2
+    h1 ^= numpy.uint64(length)
+    h2 ^= numpy.uint64(length)
+    h1 += h2
+    h2 += h1
+    h1 = fmix(h1, 0)
+    h2 = fmix(h2, 0)
+    return h1 + h2
+
+
+def kmerhashes(sequences, k=KMER, seed=SEED):
+    """
+    Hash the canonical k-mers of a list of sequences in the same way as mash: the k-mers containing characters other
+    than ACGT are skipped, and the lexicographically smaller of each k-mer and its reverse complement is hashed
+    :param sequences: list of nucleotide sequences (as strings)
+    :param k: length of k-mers to use
+    :param seed: seed of the hash function
+    :return: array of unsigned 64-bit hashes
+    """
+    codes, _ = encode(sequences)
+    # The two-bit codes are ordered in the same way as the nucleotides, so the smaller two-bit k-mer is also the
+    # lexicographically smaller string
+    kmers, _ = canonical(codes, k)
+    # Convert the k-mers back into their nucleotide strings, one base per byte
+    data = numpy.zeros((len(kmers), (k + 15) // 16 * 16), dtype=numpy.uint8)
+    for position in range(k):
+        data[:, position] = BASES[((kmers >> numpy.uint64(2 * (k - position - 1))) & numpy.uint64(3))
+                                  .astype(numpy.intp)]
+    return murmur3(data, k, seed)
+
+
+def pvalue(shared, reflength, querylength, kmer, sketchsize):
+    """
+    Calculate the probability of observing at least the number of shared hashes by chance, as in mash dist
+    :param shared: number of shared hashes
+    :param reflength: length of the reference sequence
+    :param querylength: length of the query sequence
+    :param kmer: k-mer length
+    :param sketchsize: number of hashes compared
+    :return: p-value
+    """
+    if shared == 0:
+        return 1.
+    kmerspace = 4. ** kmer
+    px = 1. / (1. + kmerspace / max(reflength, 1))
+    py = 1. / (1. + kmerspace / max(querylength, 1))
+    r = px * py / (px + py - px * py)
+    # Sum the upper tail of the binomial distribution. Past the mean, the terms decrease quickly, so the summation
+    # stops once they no longer change the total
+    total = 0.
+    for count in range(shared, sketchsize + 1):
+        term = math.exp(math.lgamma(sketchsize + 1) - math.lgamma(count + 1) - math.lgamma(sketchsize - count + 1) +
+                        count * math.log(r) + (sketchsize - count) * math.log1p(-r))
+        total += term
+        if count > sketchsize * r and term <= total * 1e-17:
+            break
+    return min(total, 1.)
+
+
+def distance(shared, denominators, kmer):
+    """
+    Convert the numbers of shared hashes into mash distances
+    :param shared: array of the number of shared hashes
+    :param denominators: array of the number of hashes compared
+    :param kmer: k-mer length
+    :return: array of mash distances
+    """
+    jaccard = shared / numpy.maximum(denominators, 1).astype(numpy.float64)
+    with numpy.errstate(divide='ignore'):
+        distances = numpy.log((1 + jaccard) / (2 * jaccard)) / kmer
+    return numpy.where(jaccard > 0, numpy.minimum(distances, 1.), 1.)
+
+
+def bandkeys(hashes, owners, bins=LSHBINS, rows=LSHROWS):
+    """
+    Create the locality-sensitive hashing keys of sketches. The hashes of each sketch are divided into bins by their
+    remainder, and the smallest hash of each bin acts as one of a set of independent MinHash values, so the smallest
+    hashes of two sketches in a bin are identical with a probability equal to the Jaccard similarity of the sketches.
+    The smallest hashes of consecutive bins are combined into bands, and sketches with an identical band key are
+    likely to be similar
+    :param hashes: array of hashes sorted in ascending order
+    :param owners: array of the sketch from which each hash originated
+    :param bins: number of bins
+    :param rows: number of bins in each band
+    :return: array of band keys, and array of the sketch of each key. Bands with an empty bin are skipped
+    """
+    hashes = numpy.asarray(hashes, dtype=numpy.uint64)
+    combined = numpy.asarray(owners).astype(numpy.uint64) * numpy.uint64(bins) + hashes % numpy.uint64(bins)
+    # As the hashes are sorted, the first hash of every sketch and bin is the smallest hash of the bin
+    combined, first = numpy.unique(combined, return_index=True)
+    minima = hashes[first]
+    # Find the bands with all their bins populated. The bins of each band are consecutive in the unique values
+    bands, starts, counts = numpy.unique(combined // numpy.uint64(rows), return_index=True, return_counts=True)
+    starts = starts[counts == rows]
+    bands = bands[counts == rows]
+    # Combine the band number and the smallest hash of each bin of the band into a single key
+    keys = fmix(bands % numpy.uint64(bins // rows), 0)
+    for row in range(rows):
+        keys = fmix(keys ^ minima[starts + row], 0)
+    return keys, (bands // numpy.uint64(bins // rows)).astype(numpy.int64)
+
+
+class Sketch(object):
+    """
+    Bottom-s MinHash sketch of a set of sequences. Sequences can be added in chunks, so that reads can be sketched
+    without loading all of them into memory. Only the hashes smaller than the largest hash of the current sketch can
+    change the sketch, so the counts of all larger hashes are discarded after each chunk
+    """
+
+    def add(self, sequences):
+        """
+        Add the k-mers of a list of sequences to the sketch
+        :param sequences: list of nucleotide sequences (as strings)
+        """
+        self.length += sum(len(sequence) for sequence in sequences)
+        hashes = kmerhashes(sequences, self.kmer)
+        if self.cutoff is not None:
+            hashes = hashes[hashes <= self.cutoff]
+        # Merge the counts of the hashes with the counts of the previous chunks
+        hashes, counts = numpy.unique(hashes, return_counts=True)
+        hashes, inverse = numpy.unique(numpy.concatenate([self.candidates, hashes]), return_inverse=True)
+        counts = numpy.bincount(inverse.ravel(), weights=numpy.concatenate([self.counts, counts]),
+                                minlength=len(hashes)).astype(numpy.int64)
+        # Once the sketch is full, any hash larger than its largest hash can be ignored
+        solid = hashes[counts >= self.mincount]
+        if len(solid) >= self.size:
+            self.cutoff = solid[self.size - 1]
+            keep = hashes <= self.cutoff
+            hashes = hashes[keep]
+            counts = counts[keep]
+        self.candidates = hashes
+        self.counts = counts
+
+    @property
+    def hashes(self):
+        """
+        :return: sorted array of the hashes in the sketch
+        """
+        return self.candidates[self.counts >= self.mincount][:self.size]
+
+    def __init__(self, kmer=KMER, size=SKETCHSIZE, mincount=1):
+        """
+        :param kmer: length of k-mers to use
+        :param size: number of hashes to include in the sketch
+        :param mincount: minimum number of copies of a k-mer required to include the k-mer in the sketch
+        """
+        self.kmer = kmer
+        self.size = size
+        self.mincount = mincount
+        # Total length of the sequences
+        self.length = 0
+        self.candidates = numpy.zeros(0, dtype=numpy.uint64)
+        self.counts = numpy.zeros(0, dtype=numpy.int64)
+        self.cutoff = None
+
+
+def writesketches(filename, sketches, kmer=KMER, size=SKETCHSIZE):
+    """
+    Write sketches in the JSON format used by mash info -d
+    :param filename: name and path of the file to create
+    :param sketches: list of dictionaries with the name, length, comment, and hashes of each sketch
+    :param kmer: k-mer length of the sketches
+    :param size: size of the sketches
+    """
+    data = {'kmer': kmer,
+            'alphabet': 'ACGT',
+            'preserveCase': False,
+            'canonical': True,
+            'sketchSize': size,
+            'hashType': 'MurmurHash3_x64_128',
+            'hashBits': 64,
+            'hashSeed': SEED,
+            'sketches': [{'name': sketch['name'],
+                          'length': int(sketch['length']),
+                          'comment': sketch.get('comment', ''),
+                          'hashes': [int(value) for value in sketch['hashes']]} for sketch in sketches]}
+    atomicwrite(filename, lambda handle: json.dump(data, handle))
+
+
+def readsketches(filename):
+    """
+    Read sketches in the JSON format used by mash info -d. Sketches in the mash binary format are converted by mash
+    :param filename: name and path of the sketch file
+    :return: dictionary of the sketch parameters and sketches, as created by writesketches
+    """
+    if filename.endswith('.json'):
+        with open(filename) as handle:
+            return json.load(handle)
+    process = Popen(['mash', 'info', '-d', filename], stdout=PIPE, universal_newlines=True)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise IOError('mash could not read the sketch file {}'.format(filename))
+    return json.loads(output)
+
+
+def sketchreads(fastq, cachepath, threads=1, kmer=KMER, size=SKETCHSIZE, mincount=MINCOUNT):
+    """
+    Sketch the reads in a FASTQ file. The sketches are stored in a cache keyed by the checksum of the contents of the
+    file and the sketch parameters, so the same file is never sketched twice, even if it is moved or renamed
+    :param fastq: name and path of the FASTQ file
+    :param cachepath: folder in which to store the sketches
+    :param threads: number of threads to use for decompression
+    :param kmer: length of k-mers to use
+    :param size: number of hashes to include in the sketch
+    :param mincount: minimum number of copies of a k-mer required to include the k-mer in the sketch
+    :return: dictionary of the name, length, comment, and hashes of the sketch
+    """
+    cachefile = os.path.join(cachepath, '{}_{}_{}_{}.json'.format(checksum(fastq), kmer, size, mincount))
+    try:
+        sketch = readsketches(cachefile)['sketches'][0]
+    except (IOError, OSError, ValueError, KeyError, IndexError):
+        sketcher = Sketch(kmer, size, mincount)
+        for chunk in fastqchunks(fastq, threads=threads):
+            sketcher.add([sequence for _, sequence, _ in chunk])
+        sketch = {'name': fastq,
+                  'length': sketcher.length,
+                  'comment': '',
+                  'hashes': sketcher.hashes.tolist()}
+        try:
+            os.makedirs(cachepath, exist_ok=True)
+            writesketches(cachefile, [sketch], kmer, size)
+        except (IOError, OSError):
+            pass
+    # The name of the cached sketch may be the name of an identical file
+    sketch['name'] = fastq
+    return sketch
+
+
+def adaptivesketch(fastq, references, threads=1, patience=3, tolerance=0.1, mincount=MINCOUNT):
+    """
+    Sketch the reads in a FASTQ file in chunks, and compare the sketch to the references after each chunk. Sketching
+    stops once the closest reference, and the margin between its distance and the distance of the second closest
+    reference, have remained the same for a number of consecutive chunks. As the remaining reads are not read, the
+    sketch is not identical to the sketch of all the reads, and is therefore not cached
+    :param fastq: name and path of the FASTQ file
+    :param references: References object to which the sketch is compared
+    :param threads: number of threads to use for decompression
+    :param patience: number of consecutive chunks over which the closest reference must remain the same
+    :param tolerance: maximum relative change in the margin between chunks for the margin to be considered the same
+    :param mincount: minimum number of copies of a k-mer required to include the k-mer in the sketch
+    :return: dictionary of the name, length, comment, and hashes of the sketch
+    """
+    sketcher = Sketch(references.kmer, references.sketchsize, mincount)
+    previous = None
+    stable = 0
+    reads = 0
+    for chunk in fastqchunks(fastq, threads=threads):
+        sketcher.add([sequence for _, sequence, _ in chunk])
+        reads += len(chunk)
+        hashes = sketcher.hashes
+        # The distances are not meaningful until the sketch is full
+        if len(hashes) < sketcher.size or len(references.names) < 2:
+            continue
+        distances = distance(*references.distances(hashes), kmer=references.kmer)
+        closest = numpy.argsort(distances, kind='mergesort')[:2]
+        margin = distances[closest[1]] - distances[closest[0]]
+        if previous is not None and closest[0] == previous[0] and margin > 0 \
+                and abs(margin - previous[1]) <= tolerance * previous[1]:
+            stable += 1
+        else:
+            stable = 0
+        previous = (closest[0], margin)
+        if stable >= patience:
+            break
+    return {'name': fastq,
+            'length': sketcher.length,
+            'comment': 'adaptive sketch of the first {} reads'.format(reads),
+            'hashes': sketcher.hashes.tolist()}
+
+
+class References(object):
+    """
+    Collection of reference sketches. The hashes of all the references are stored in a single sorted array, so that
+    the references sharing hashes with a query can be found with a binary search per query hash, rather than by
+    comparing the query to every reference. The arrays are compiled once, and stored next to the sketch file
+    """
+
+    def distances(self, queryhashes, candidates=None):
+        """
+        Compare a query sketch to every reference in the same way as mash dist: the hashes of the query and of each
+        reference are merged, and the hashes shared within the smallest sketchsize hashes of the merged hashes are
+        counted
+        :param queryhashes: sorted array of the hashes of the query sketch
+        :param candidates: if provided, sorted array of the indices of the only references to compare
+        :return: array of the number of shared hashes, and array of the number of hashes compared for each reference,
+        or for each candidate reference if candidates are provided
+        """
+        query = numpy.asarray(queryhashes, dtype=numpy.uint64)[:self.sketchsize]
+        if candidates is not None:
+            return self.candidatedistances(query, candidates)
+        starts = numpy.searchsorted(self.hashes, query, side='left')
+        counts = numpy.searchsorted(self.hashes, query, side='right') - starts
+        # Find the index of every reference hash matching a query hash
+        total = int(counts.sum())
+        indices = numpy.repeat(starts - numpy.cumsum(counts) + counts, counts) + numpy.arange(total)
+        # The rank of each query hash in the query sketch
+        queryranks = numpy.repeat(numpy.arange(len(query)), counts)
+        owners = self.owners[indices]
+        positions = self.positions[indices].astype(numpy.int64)
+        # Group the shared hashes by reference. The query hashes are sorted, so the shared hashes of each reference
+        # remain sorted
+        order = numpy.argsort(owners, kind='mergesort')
+        owners = owners[order]
+        # The number of shared hashes up to and including each shared hash of the reference
+        sharedranks = numpy.arange(total) - numpy.searchsorted(owners, owners, side='left') + 1
+        # The rank of each shared hash in the merged hashes of the query and the reference
+        mergedranks = positions[order] + queryranks[order] + 2 - sharedranks
+        shared = numpy.bincount(owners[mergedranks <= self.sketchsize], minlength=len(self.names))
+        common = numpy.bincount(owners, minlength=len(self.names))
+        denominators = numpy.minimum(self.sketchsize, self.sizes + len(query) - common)
+        return shared, denominators
+
+    def candidatedistances(self, query, candidates):
+        """
+        Compare a query sketch to a few candidate references in the same way as distances. Only the hashes of the
+        candidates are searched, so the time taken depends on the number of candidates rather than on the number of
+        references
+        :param query: sorted array of the (at most sketchsize) hashes of the query sketch
+        :param candidates: sorted array of the indices of the references to compare
+        :return: array of the number of shared hashes, and array of the number of hashes compared for each candidate
+        """
+        candidates = numpy.asarray(candidates, dtype=numpy.int64)
+        sizes = numpy.asarray(self.sizes)[candidates]
+        offsets = numpy.asarray(self.offsets)[candidates]
+        # Gather the (sorted) hashes of each candidate from the hashes stored in the order of the references
+        total = int(sizes.sum())
+        segments = numpy.repeat(numpy.arange(len(candidates)), sizes)
+        positions = numpy.arange(total) - numpy.repeat(numpy.cumsum(sizes) - sizes, sizes)
+        hashes = self.referencehashes[offsets[segments] + positions]
+        # The rank in the query sketch of each candidate hash, and whether the hash is shared with the query
+        queryranks = numpy.searchsorted(query, hashes, side='left')
+        matched = queryranks < len(query)
+        matched[matched] = query[queryranks[matched]] == hashes[matched]
+        segments = segments[matched]
+        # The shared hashes of each candidate remain sorted, so the number of shared hashes up to and including each
+        # shared hash is found in the same way as in distances
+        sharedranks = numpy.arange(len(segments)) - numpy.searchsorted(segments, segments, side='left') + 1
+        mergedranks = positions[matched] + queryranks[matched] + 2 - sharedranks
+        shared = numpy.bincount(segments[mergedranks <= self.sketchsize], minlength=len(candidates))
+        common = numpy.bincount(segments, minlength=len(candidates))
+        denominators = numpy.minimum(self.sketchsize, sizes + len(query) - common)
+        return shared, denominators
+
+    def screen(self, fastqfiles, threads=1):
+        """
+        Find the fraction of the hashes of every reference sketch that are present in the k-mers of a set of reads, as
+        in mash screen. All the references are screened in a single pass through the reads
+        :param fastqfiles: list of names and paths of FASTQ files
+        :param threads: number of threads to use for decompression
+        :return: array of the containment of each reference in the reads
+        """
+        found = numpy.zeros(len(self.hashes), dtype=bool)
+        for fastq in fastqfiles:
+            for chunk in fastqchunks(fastq, threads=threads):
+                hashes = numpy.unique(kmerhashes([sequence for _, sequence, _ in chunk], self.kmer))
+                # Mark every reference hash matching a hash of the reads
+                starts = numpy.searchsorted(self.hashes, hashes, side='left')
+                counts = numpy.searchsorted(self.hashes, hashes, side='right') - starts
+                starts = starts[counts > 0]
+                counts = counts[counts > 0]
+                found[numpy.repeat(starts - numpy.cumsum(counts) + counts, counts) +
+                      numpy.arange(int(counts.sum()))] = True
+        return numpy.bincount(self.owners[found], minlength=len(self.names)) / \
+            numpy.maximum(self.sizes, 1).astype(numpy.float64)
+
+    def candidates(self, queryhashes):
+        """
+        Find the references sharing at least one band key with a query sketch using the locality-sensitive hashing
+        index
+        :param queryhashes: sorted array of the hashes of the query sketch
+        :return: sorted array of the indices of the candidate references
+        """
+        indexkeys, indexowners = self.lshindex()
+        keys, _ = bandkeys(queryhashes, numpy.zeros(len(queryhashes), dtype=numpy.int64))
+        starts = numpy.searchsorted(indexkeys, keys, side='left')
+        counts = numpy.searchsorted(indexkeys, keys, side='right') - starts
+        indices = numpy.repeat(starts - numpy.cumsum(counts) + counts, counts) + numpy.arange(int(counts.sum()))
+        return numpy.unique(indexowners[indices])
+
+    def lshindex(self):
+        """
+        Create (or load) the locality-sensitive hashing index of the references: the sorted band keys of all the
+        references, and the reference of each key
+        :return: array of band keys, array of the reference of each key
+        """
+        if self.lsh is None:
+            keysfile, ownersfile = self.lshfiles(self.sketchfile)
+            try:
+                self.lsh = numpy.load(keysfile, mmap_mode='r'), numpy.load(ownersfile, mmap_mode='r')
+            except (IOError, OSError, ValueError):
+                keys, owners = bandkeys(self.hashes, self.owners)
+                order = numpy.argsort(keys, kind='mergesort')
+                self.lsh = keys[order], owners[order].astype(numpy.uint32)
+                try:
+                    atomicwrite(ownersfile, lambda handle: numpy.save(handle, self.lsh[1]), 'wb')
+                    atomicwrite(keysfile, lambda handle: numpy.save(handle, self.lsh[0]), 'wb')
+                except (IOError, OSError):
+                    pass
+        return self.lsh
+
+    def lines(self, sketch, limit=None, lsh=False):
+        """
+        Create mash dist outputs for the comparisons of a query sketch to the references
+        :param sketch: dictionary of the name, length, and hashes of the query sketch
+        :param limit: if provided, only output this number of references with the smallest distances
+        :param lsh: boolean of whether only the candidate references of the locality-sensitive hashing index should be
+        compared to the query. If there are no candidates, all the references are compared
+        :return: lines of reference-ID, query-ID, distance, p-value, and shared-hashes in the order of the references
+        """
+        queryhashes = numpy.array(sketch['hashes'], dtype=numpy.uint64)
+        candidates = None
+        if lsh:
+            candidates = self.candidates(queryhashes)
+            if not len(candidates):
+                candidates = None
+        # The distances are calculated for the candidates only, or for every reference
+        shared, denominators = self.distances(queryhashes, candidates)
+        indices = candidates if candidates is not None else numpy.arange(len(self.names))
+        distances = distance(shared, denominators, self.kmer)
+        order = numpy.arange(len(indices))
+        if limit is not None:
+            order = numpy.sort(numpy.argsort(distances, kind='mergesort')[:limit])
+        for position in order:
+            index = indices[position]
+            yield '{}\t{}\t{:g}\t{:g}\t{}/{}\n'.format(
+                self.names[index], sketch['name'], distances[position],
+                pvalue(int(shared[position]), int(self.lengths[index]), sketch['length'], self.kmer,
+                       int(denominators[position])),
+                shared[position], denominators[position])
+
+    def compile(self, sketchfile):
+        """
+        Convert the sketches into sorted arrays of hashes, with the reference and the rank within the reference of
+        each hash
+        :param sketchfile: name and path of the sketch file
+        """
+        data = readsketches(sketchfile)
+        self.kmer = data['kmer']
+        self.sketchsize = data['sketchSize']
+        self.names = [sketch['name'] for sketch in data['sketches']]
+        self.lengths = numpy.array([sketch['length'] for sketch in data['sketches']], dtype=numpy.int64)
+        hashes = [numpy.array(sorted(sketch['hashes']), dtype=numpy.uint64) for sketch in data['sketches']]
+        self.sizes = numpy.array([len(values) for values in hashes], dtype=numpy.int64)
+        hashes = numpy.concatenate(hashes) if hashes else numpy.zeros(0, dtype=numpy.uint64)
+        # Keep the hashes in the order of the references as well, so that the hashes of a few references can be
+        # compared without searching the hashes of every reference
+        self.referencehashes = hashes
+        self.offsets = numpy.cumsum(self.sizes) - self.sizes
+        owners = numpy.repeat(numpy.arange(len(self.names), dtype=numpy.uint32), self.sizes)
+        positions = (numpy.arange(len(hashes)) - numpy.repeat(numpy.cumsum(self.sizes) - self.sizes, self.sizes)) \
+            .astype(numpy.uint32)
+        order = numpy.argsort(hashes, kind='mergesort')
+        self.hashes = hashes[order]
+        self.owners = owners[order]
+        self.positions = positions[order]
+
+    def load(self, sketchfile):
+        """
+        Load the compiled sketches stored next to the sketch file. The arrays are memory-mapped rather than read. The
+        compiled sketches are only used if the sketch file is unchanged: the modification time and size are checked
+        first, and if they differ, the checksum of the file is compared to the checksum of the compiled sketches
+        :param sketchfile: name and path of the sketch file
+        :return: boolean of whether the compiled sketches were loaded
+        """
+        metadatafile = self.compiledfiles(sketchfile)['metadata']
+        try:
+            with open(metadatafile) as metadata:
+                compiled = json.load(metadata)
+            stats = os.stat(sketchfile)
+            if compiled['mtime'] != stats.st_mtime or compiled['size'] != stats.st_size:
+                if compiled['checksum'] != checksum(sketchfile):
+                    return False
+                # The file was touched, but not changed. Update the compiled sketches with the new modification time
+                compiled['mtime'] = stats.st_mtime
+                compiled['size'] = stats.st_size
+                try:
+                    atomicwrite(metadatafile, lambda handle: json.dump(compiled, handle), 'w')
+                except (IOError, OSError):
+                    pass
+            arrays = {name: numpy.load(filename, mmap_mode='r')
+                      for name, filename in self.compiledfiles(sketchfile).items() if name != 'metadata'}
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+        # Ensure that the arrays correspond to the metadata
+        if len(arrays['sizes']) != len(compiled['names']) or len(arrays['hashes']) != int(arrays['sizes'].sum()) \
+                or len(arrays['referencehashes']) != len(arrays['hashes']):
+            return False
+        self.kmer = compiled['kmer']
+        self.sketchsize = compiled['sketchsize']
+        self.names = compiled['names']
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        return True
+
+    def save(self, sketchfile):
+        """
+        Store the compiled sketches next to the sketch file
+        :param sketchfile: name and path of the sketch file
+        """
+        stats = os.stat(sketchfile)
+        compiled = {'mtime': stats.st_mtime,
+                    'size': stats.st_size,
+                    'checksum': checksum(sketchfile),
+                    'kmer': self.kmer,
+                    'sketchsize': self.sketchsize,
+                    'names': self.names}
+        for name, filename in self.compiledfiles(sketchfile).items():
+            if name != 'metadata':
+                atomicwrite(filename, lambda handle: numpy.save(handle, getattr(self, name)), 'wb')
+        # Remove any locality-sensitive hashing index of outdated sketches
+        for filename in self.lshfiles(sketchfile):
+            if os.path.isfile(filename):
+                os.remove(filename)
+        # Write the metadata last, so that the arrays are complete whenever the metadata exists
+        atomicwrite(self.compiledfiles(sketchfile)['metadata'], lambda handle: json.dump(compiled, handle), 'w')
+
+    @staticmethod
+    def compiledfiles(sketchfile):
+        """
+        :param sketchfile: name and path of the sketch file
+        :return: dictionary of the names and paths of the compiled files
+        """
+        base = os.path.splitext(sketchfile)[0] + '_compiled'
+        files = {name: '{}_{}.npy'.format(base, name) for name in ['hashes', 'referencehashes', 'offsets', 'owners',
+                                                                    'positions', 'sizes', 'lengths']}
+        files['metadata'] = base + '.json'
+        return files
+
+    @staticmethod
+    def lshfiles(sketchfile):
+        """
+        :param sketchfile: name and path of the sketch file
+        :return: names and paths of the files of the band keys and the references of the keys
+        """
+        base = '{}_compiled_lsh{}x{}'.format(os.path.splitext(sketchfile)[0], LSHBINS, LSHROWS)
+        return base + '_keys.npy', base + '_owners.npy'
+
+    def __init__(self, sketchfile):
+        """
+        :param sketchfile: name and path of the sketch file (mash binary or JSON format)
+        """
+        self.sketchfile = sketchfile
+        # Locality-sensitive hashing index, which is created when it is first required
+        self.lsh = None
+        if not self.load(sketchfile):
+            self.compile(sketchfile)
+            try:
+                self.save(sketchfile)
+            except (IOError, OSError):
+                pass
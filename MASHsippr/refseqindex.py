@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+from sipprutilities.sqliteindex import SQLiteIndex
+import os
+__author__ = 'adamkoziol'
+
+
+class RefSeqIndex(SQLiteIndex):
+    """
+    Looks up the organism names of RefSeq assemblies using an SQLite index of the RefSeq assembly summary file, so the
+    summary file does not need to be read on every run
+    """
+
+    @staticmethod
+    def parse(summaryfile):
+        """
+        Extract the accession: genus species pairs from the summary file
+        :param summaryfile: name and path of the RefSeq assembly summary file
+        :return: tuples of accession (without the version) e.g. GCF_001298055, and organism name
+        e.g. Helicobacter pullorum
+        """
+        with open(summaryfile) as summary:
+            for line in summary:
+                # Ignore the first couple of lines
+                if line.startswith('# assembly_accession'):
+                    # Iterate through all the lines with data
+                    for accessionline in summary:
+                        # Split the lines on tabs
+                        data = accessionline.split('\t')
+                        yield data[0].split('.')[0], data[7]
+
+    def __getitem__(self, accession):
+        """
+        :param accession: accession (without the version) of the RefSeq assembly e.g. GCF_001298055
+        :return: organism name of the assembly
+        """
+        return SQLiteIndex.__getitem__(self, accession)[0]
+
+    def __init__(self, summaryfile):
+        """
+        :param summaryfile: name and path of the RefSeq assembly summary file
+        """
+        SQLiteIndex.__init__(self, summaryfile, os.path.splitext(summaryfile)[0] + '.sqlite', 'summary',
+                             ['accession', 'organism'], self.parse)
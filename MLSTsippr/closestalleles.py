@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+from fastsippr.fastqio import fastqchunks
+from fastsippr.kmers import contained, kmerhashes
+from Bio import SeqIO
+import numpy
+import os
+__author__ = 'adamkoziol'
+
+
+class ClosestAlleles(object):
+    """
+    Finds the closest alleles of every gene to a set of reads in a single step. The k-mers of all the alleles are
+    loaded once, and the alleles are ranked by the Jaccard similarity of their k-mers and the k-mers of the reads, as
+    with mash dist, which reports the distance calculated from this similarity
+    """
+
+    def readkmers(self, fastq, threads=1):
+        """
+        Find the k-mers present in a set of reads at least self.mincount times. As with the -m option of mash sketch,
+        this removes most of the k-mers containing sequencing errors
+        :param fastq: name and path of the FASTQ file
+        :param threads: number of threads to use for decompression
+        :return: sorted array of unique k-mer hashes
+        """
+        hashes = [numpy.zeros(0, dtype=numpy.uint64)]
+        for chunk in fastqchunks(fastq, threads=threads):
+            kmers, _, _ = kmerhashes([sequence for _, sequence, _ in chunk], self.kmer)
+            hashes.append(kmers)
+        kmers, counts = numpy.unique(numpy.concatenate(hashes), return_counts=True)
+        return kmers[counts >= self.mincount]
+
+    def closest(self, readkmers, count=5):
+        """
+        Rank the alleles of every gene by their similarity to the reads
+        :param readkmers: sorted array of unique k-mer hashes of the reads
+        :param count: number of alleles to return for each gene
+        :return: dictionary of gene: list of the names of the closest alleles
+        """
+        # Count the number of k-mers that each allele shares with the reads
+        shared = numpy.bincount(self.owners[contained(self.hashes, readkmers)],
+                                minlength=len(self.names)).astype(numpy.float64)
+        jaccard = shared / (self.sizes + len(readkmers) - shared)
+        closest = dict()
+        for gene, (start, end) in self.genes.items():
+            # Sort the alleles of the gene by decreasing similarity; ties are kept in the order of the allele file
+            order = numpy.argsort(-jaccard[start:end], kind='mergesort')[:count]
+            closest[gene] = [self.names[start + index] for index in order]
+        return closest
+
+    def __init__(self, allelefiles, kmer=21, mincount=2):
+        """
+        :param allelefiles: list of names and paths of the allele files of each gene
+        :param kmer: length of k-mers to use
+        :param mincount: minimum number of times a k-mer must be present in the reads
+        """
+        self.kmer = kmer
+        self.mincount = mincount
+        # Names of the alleles, and the number of unique k-mers in each allele
+        self.names = list()
+        sizes = list()
+        hashes = list()
+        owners = list()
+        # Dictionary of gene: (index of the first allele of the gene, index following the last allele of the gene)
+        self.genes = dict()
+        for allelefile in sorted(allelefiles):
+            gene = os.path.split(allelefile)[1].split('.')[0]
+            records = [record for record in SeqIO.parse(allelefile, 'fasta')]
+            start = len(self.names)
+            self.genes[gene] = (start, start + len(records))
+            self.names.extend(record.id for record in records)
+            kmers, alleles, _ = kmerhashes([str(record.seq) for record in records], self.kmer)
+            # Only keep one copy of each k-mer for every allele
+            pairs = numpy.unique(numpy.rec.fromarrays([alleles + start, kmers], names='allele,kmer'))
+            hashes.append(pairs['kmer'])
+            owners.append(pairs['allele'])
+            sizes.append(numpy.bincount(pairs['allele'] - start, minlength=len(records)))
+        # Sort the k-mers of all the alleles, so that the shared k-mers can be found with a binary search
+        hashes = numpy.concatenate(hashes) if hashes else numpy.zeros(0, dtype=numpy.uint64)
+        owners = numpy.concatenate(owners) if owners else numpy.zeros(0, dtype=numpy.int64)
+        order = numpy.argsort(hashes, kind='mergesort')
+        self.hashes = hashes[order]
+        self.owners = owners[order]
+        self.sizes = numpy.concatenate(sizes).astype(numpy.float64) if sizes else numpy.zeros(0)
@@ -3,6 +3,9 @@ import subprocess
 import time
 import os
 from MLSTsippr.sipprmlst import MLSTmap
+from fastsippr.arguments import fastsipprarguments, fastsipprattributes
+from MLSTsippr.profiles import Profile
+from sipprutilities.fileio import atomicwrite
 from sipprCommon.objectprep import Objectprep
 from accessoryFunctions.accessoryFunctions import printtime, make_dict, dotter, make_path
 from accessoryFunctions.metadataprinter import MetadataPrinter
@@ -28,13 +31,14 @@ class GeneSippr(object):
             objects.objectprep()
             self.runmetadata = objects.samples
         # Run the analyses
-        MLSTmap(self, self.analysistype, self.cutoff)
+        mlstmap = MLSTmap(self, self.analysistype, self.cutoff)
+        # Use the parsed allele names from the target files to link the results to genes
+        self.alleleindex = mlstmap.alleleindex
         # Create the reports
         self.reporter()
         for sample in self.runmetadata.samples:
             # Remove large attributes from the object
             try:
-                delattr(sample[self.analysistype], 'profiledata')
                 delattr(sample[self.analysistype], 'allelenames')
                 delattr(sample[self.analysistype], 'alleles')
                 delattr(sample[self.analysistype], 'faidict')
@@ -59,33 +63,27 @@ class GeneSippr(object):
         # Populate self.plusdict in order to reuse parsing code from an assembly-based method
         for sample in self.runmetadata.samples:
             if sample.general.bestassemblyfile != 'NA':
-                for gene in sample[self.analysistype].allelenames:
-                    for allele, percentidentity in sample[self.analysistype].results.items():
-                        if gene in allele:
-                            # Split the allele number from the gene name using the appropriate delimiter
-                            if '_' in allele:
-                                splitter = '_'
-                            elif '-' in allele:
-                                splitter = '-'
-                            else:
-                                splitter = ''
-                            # Create the plusdict dictionary as in the assembly-based (r)MLST method. Allows all the
-                            # parsing and sequence typing code to be reused.
-                            try:
-                                self.plusdict[sample.name][gene][allele.split(splitter)[1]][percentidentity] \
-                                    = sample[self.analysistype].avgdepth[allele]
-                            except IndexError:
-                                pass
+                genes = set(sample[self.analysistype].allelenames)
+                alleleindex = self.alleleindex.get(sample[self.analysistype].combinedalleles, dict())
+                for allelename, percentidentity in sample[self.analysistype].results.items():
+                    # Look up the gene name and allele number parsed from the target file
+                    try:
+                        gene, allele = alleleindex[allelename]
+                    except KeyError:
+                        continue
+                    if gene in genes:
+                        # Create the plusdict dictionary as in the assembly-based (r)MLST method. Allows all the
+                        # parsing and sequence typing code to be reused.
+                        self.plusdict[sample.name][gene][allele][percentidentity] \
+                            = sample[self.analysistype].avgdepth[allelename]
         self.profiler()
-        self.sequencetyper()
+        # The samples are typed as the reports are written
         self.mlstreporter()
 
     def profiler(self):
-        """Creates a dictionary from the profile scheme(s)"""
+        """Creates a matrix of the alleles of each sequence type from the profile scheme(s)"""
         printtime('Loading profiles', self.starttime)
-        from csv import DictReader
         # Initialise variables
-        profiledata = defaultdict(make_dict)
         profileset = set()
         genedict = dict()
         # Find all the unique profiles to use with a set
@@ -102,38 +100,82 @@ class GeneSippr(object):
                 if sample.general.bestassemblyfile != 'NA':
                     if sequenceprofile == sample[self.analysistype].profile:
                         genelist = [allele for allele in sample[self.analysistype].alleles]
-            try:
-                # Open the sequence profile file as a dictionary
-                profile = DictReader(open(sequenceprofile), dialect='excel-tab')
-            # Revert to standard comma separated values
-            except KeyError:
-                # Open the sequence profile file as a dictionary
-                profile = DictReader(open(sequenceprofile))
-            # Iterate through the rows
-            for row in profile:
-                # Iterate through the genes
-                for gene in genelist:
-                    # Add the sequence profile, and type, the gene name and the allele number to the dictionary
-                    try:
-                        profiledata[sequenceprofile][row['ST']][gene] = row[gene]
-                    except KeyError:
-                        try:
-                            profiledata[sequenceprofile][row['rST']][gene] = row[gene]
-                        except KeyError:
-                            raise
+            # Load the sequence types, and the alleles of each of the genes into an integer matrix. The profile is
+            # stored once, and the samples refer to it with the name of their profile file
+            self.profiles[sequenceprofile] = Profile(sequenceprofile, genelist)
             # Add the gene list to a dictionary
             genedict[sequenceprofile] = sorted(genelist)
-            # Add the profile data, and gene list to each sample
-            for sample in self.runmetadata.samples:
-                if sample.general.bestassemblyfile != 'NA':
-                    if sequenceprofile == sample[self.analysistype].profile:
-                        # Populate the metadata with the profile data
-                        sample[self.analysistype].profiledata = profiledata[sample[self.analysistype].profile]
-                        dotter()
+            dotter()
+
+    def queryalleles(self, sample):
+        """
+        Determine the allele(s) of each gene in the sample, and store them, along with the percent identity, in
+        self.bestdict
+        :param sample: sample object
+        """
+        genome = sample.name
+        # For each gene in plusdict[genome]
+        for gene in sample[self.analysistype].allelenames:
+            # Clear the appropriate count and lists
+            multiallele = list()
+            multipercent = list()
+            # Go through the alleles in plusdict
+            for allele in self.plusdict[genome][gene]:
+                percentid = list(self.plusdict[genome][gene][allele].keys())[0]
+                # "N" alleles screw up the allele splitter function
+                if allele != "N":
+                    # Use the alleleSplitter function to get the allele number
+                    # allelenumber, alleleprenumber = allelesplitter(allele)
+                    # Append as appropriate - alleleNumber is treated as an integer for proper sorting
+                    multiallele.append(int(allele))
+                    multipercent.append(percentid)
+                # If the allele is "N"
+                else:
+                    # Append "N" and a percent identity of 0
+                    multiallele.append("N")
+                    multipercent.append(0)
+            # Populate self.bestdict with genome, gene, alleles joined with a space (this was made like
+            # this because allele is a list generated by the .iteritems() above
+            try:
+                self.bestdict[genome][gene][" ".join(str(allele)
+                                                     for allele in sorted(multiallele))] = \
+                    multipercent[0]
+            except IndexError:
+                self.bestdict[genome][gene]['NA'] = 0
+
+    def batchtyper(self):
+        """
+        Compare the alleles of all the samples that share a profile to the profile matrix in a single operation. The
+        best sequence type(s) and the number of matches are stored in self.bestmatch, and the genes that do not match
+        each best sequence type are stored in self.mismatchgenes
+        """
+        # Group the samples by profile
+        profiles = dict()
+        for sample in self.runmetadata.samples:
+            if sample.general.bestassemblyfile != 'NA':
+                if type(sample[self.analysistype].allelenames) == list and sample[self.analysistype].profile != 'NA':
+                    self.queryalleles(sample)
+                    profiles.setdefault(sample[self.analysistype].profile, list()).append(sample)
+        for profile, samples in profiles.items():
+            # Create lists of the alleles and the percent identities of all the samples
+            queries = [{gene: list(self.bestdict[sample.name][gene].keys())[0]
+                        for gene in sample[self.analysistype].allelenames} for sample in samples]
+            identities = [{gene: list(self.bestdict[sample.name][gene].values())[0]
+                           for gene in sample[self.analysistype].allelenames} for sample in samples]
+            # All the samples share the same profile
+            results = self.profiles[profile].typing(queries, identities)
+            for sample, (matches, mismatches) in zip(samples, results):
+                self.bestmatch[sample.name] = defaultdict(int, matches)
+                self.mismatchgenes[sample.name] = mismatches
 
     def sequencetyper(self):
-        """Determines the sequence type of each strain based on comparisons to sequence type profiles"""
+        """
+        Determines the sequence type of each strain based on comparisons to sequence type profiles
+        :return: generator of each sample once it has been typed
+        """
         printtime('Performing sequence typing', self.starttime)
+        # Type all the samples that share a profile together
+        self.batchtyper()
         for sample in self.runmetadata.samples:
             if sample.general.bestassemblyfile != 'NA':
                 if type(sample[self.analysistype].allelenames) == list:
@@ -142,72 +184,11 @@ class GeneSippr(object):
                     # Iterate through the genomes
                     # for sample in self.runmetadata.samples:
                     genome = sample.name
-                    # Initialise self.bestmatch[genome] with an int that will eventually be replaced by the # of matches
-                    self.bestmatch[genome] = defaultdict(int)
                     if sample[self.analysistype].profile != 'NA':
-                        # Create the profiledata variable to avoid writing self.profiledata[self.analysistype]
-                        profiledata = sample[self.analysistype].profiledata
-                        # For each gene in plusdict[genome]
-                        for gene in sample[self.analysistype].allelenames:
-                            # Clear the appropriate count and lists
-                            multiallele = list()
-                            multipercent = list()
-                            # Go through the alleles in plusdict
-                            for allele in self.plusdict[genome][gene]:
-                                percentid = list(self.plusdict[genome][gene][allele].keys())[0]
-                                # "N" alleles screw up the allele splitter function
-                                if allele != "N":
-                                    # Use the alleleSplitter function to get the allele number
-                                    # allelenumber, alleleprenumber = allelesplitter(allele)
-                                    # Append as appropriate - alleleNumber is treated as an integer for proper sorting
-                                    multiallele.append(int(allele))
-                                    multipercent.append(percentid)
-                                # If the allele is "N"
-                                else:
-                                    # Append "N" and a percent identity of 0
-                                    multiallele.append("N")
-                                    multipercent.append(0)
-                            # Populate self.bestdict with genome, gene, alleles joined with a space (this was made like
-                            # this because allele is a list generated by the .iteritems() above
-                            try:
-                                self.bestdict[genome][gene][" ".join(str(allele)
-                                                                     for allele in sorted(multiallele))] = \
-                                    multipercent[0]
-                            except IndexError:
-                                self.bestdict[genome][gene]['NA'] = 0
-                            # Find the profile with the most alleles in common with the query genome
-                            for sequencetype in profiledata:
-                                # The number of genes in the analysis
-                                header = len(profiledata[sequencetype])
-                                # refallele is the allele number of the sequence type
-                                refallele = profiledata[sequencetype][gene]
-                                # If there are multiple allele matches for a gene in the reference profile e.g. 10 692
-                                if len(refallele.split(" ")) > 1:
-                                    # Map the split (on a space) alleles as integers - if they are treated as integers,
-                                    # the alleles will sort properly
-                                    intrefallele = map(int, refallele.split(" "))
-                                    # Create a string of the joined, sorted alleles
-                                    sortedrefallele = " ".join(str(allele) for allele in sorted(intrefallele))
-                                else:
-                                    # Use the reference allele as the sortedRefAllele
-                                    sortedrefallele = refallele
-                                for allele, percentid in self.bestdict[genome][gene].items():
-                                    # If the allele in the query genome matches the allele in the reference profile, add
-                                    # the result to the bestmatch dictionary. Genes with multiple alleles were sorted
-                                    # the same, strings with multiple alleles will match: 10 692 will never be 692 10
-                                    if allele == sortedrefallele and float(percentid) == 100.00:
-                                        # Increment the number of matches to each profile
-                                        self.bestmatch[genome][sequencetype] += 1
-                                    # Special handling of BACT000060 and BACT000065 genes for E. coli and BACT000014
-                                    # for Listeria. When the reference profile has an allele of 'N', and the query
-                                    # allele doesn't, set the allele to 'N', and count it as a match
-                                    elif gene == 'BACT000060' or gene == 'BACT000065' or gene == 'BACT000014':
-                                        if sortedrefallele == 'N' and allele != 'N':
-                                            # Increment the number of matches to each profile
-                                            self.bestmatch[genome][sequencetype] += 1
-                                    elif allele == sortedrefallele and sortedrefallele == 'N':
-                                        # Increment the number of matches to each profile
-                                        self.bestmatch[genome][sequencetype] += 1
+                        # Create the profiledata variable to avoid writing the full self.profiles lookup
+                        profiledata = self.profiles[sample[self.analysistype].profile]
+                        # The number of genes in the analysis
+                        header = len(profiledata.genes) if len(profiledata) else 0
                         # Get the best number of matches
                         # From: https://stackoverflow.com/questions/613183/sort-a-python-dictionary-by-value
                         try:
@@ -221,7 +202,7 @@ class GeneSippr(object):
                             # Iterate through best match
                             for sequencetype, matches in self.bestmatch[genome].items():
                                 if matches == sortedmatches:
-                                    for gene in profiledata[sequencetype]:
+                                    for gene in profiledata.genes:
                                         # Populate resultProfile with the genome, best match to profile, # of matches
                                         # to the profile, gene, query allele(s), reference allele(s), and % identity
                                         self.resultprofile[genome][sequencetype][sortedmatches][gene][
@@ -237,9 +218,9 @@ class GeneSippr(object):
                                 # If the number of matches for a profile matches the best number of matches
                                 if matches == sortedmatches:
                                     # Iterate through the gene in the analysis
-                                    for gene in profiledata[sequencetype]:
+                                    for gene in profiledata.genes:
                                         # Get the reference allele as above
-                                        refallele = profiledata[sequencetype][gene]
+                                        refallele = profiledata.allele(sequencetype, gene)
                                         # As above get the reference allele split and ordered as necessary
                                         if len(refallele.split(" ")) > 1:
                                             intrefallele = map(int, refallele.split(" "))
@@ -260,10 +241,20 @@ class GeneSippr(object):
                                                 list(self.bestdict[genome][gene].keys())[0]] \
                                                 = str(list(self.bestdict[genome][gene].values())[0])
                                             #
-                                            if sortedrefallele != list(self.bestdict[sample.name][gene].keys())[0]:
+                                            if gene in self.mismatchgenes[genome][sequencetype]:
                                                 mismatches.append(
                                                     ({gene: ('{} ({})'.format(list(self.bestdict[sample.name][gene]
                                                                                    .keys())[0], sortedrefallele))}))
+                            # The profile is partial or novel, so find the closest sequence types with up to
+                            # self.tolerance mismatched genes
+                            query = {gene: list(self.bestdict[genome][gene].keys())[0]
+                                     for gene in sample[self.analysistype].allelenames}
+                            identity = {gene: list(self.bestdict[genome][gene].values())[0]
+                                        for gene in sample[self.analysistype].allelenames}
+                            sample[self.analysistype].closestsequencetypes = \
+                                [{'sequencetype': sequencetype, 'mismatches': sorted(genes)}
+                                 for sequencetype, genes in profiledata.nearest(query, identity, self.nearest,
+                                                                                self.tolerance)]
                         elif sortedmatches == 0:
                             for gene in sample[self.analysistype].allelenames:
                                 # Populate the results profile with negative values for sequence type and sorted matches
@@ -286,12 +277,13 @@ class GeneSippr(object):
                 sample[self.analysistype].matchestosequencetype = 'NA'
                 sample[self.analysistype].mismatchestosequencetype = 'NA'
                 sample[self.analysistype].sequencetype = 'NA'
+            # Yield each sample as soon as it has been typed, so that its report can be written
+            yield sample
 
     def mlstreporter(self):
         """ Parse the results into a report"""
         printtime('Writing reports', self.starttime)
         # Initialise variables
-        combinedrow = str()
         reportdirset = set()
         # Populate a set of all the report directories to use. A standard analysis will only have a single report
         # directory, while pipeline analyses will have as many report directories as there are assembled samples
@@ -302,8 +294,26 @@ class GeneSippr(object):
                     make_path(sample[self.analysistype].reportdir)
                     # Add to the set - I probably could have used a counter here, but I decided against it
                     reportdirset.add(sample[self.analysistype].reportdir)
+        # Create the report folder
+        make_path(self.reportpath)
+        # Set the name of the report containing all the data from all samples
+        if self.pipeline:
+            reportname = os.path.join(self.reportpath, '{}.csv'.format(self.analysistype))
+        else:
+            reportname = os.path.join(self.reportpath, '{}_{:}.csv'.format(self.analysistype,
+                                                                          time.strftime("%Y.%m.%d.%H.%M.%S")))
+        # The rows of each sample are written to a temporary file as soon as the sample is typed, so that the memory
+        # usage does not grow with the number of samples. The temporary file is renamed once all the samples have been
+        # written, so the report is never left incomplete
+        atomicwrite(reportname, self.samplereporter)
+
+    def samplereporter(self, combinedreport):
+        """
+        Type each sample, and write its rows to the combined report as soon as it has been typed
+        :param combinedreport: open handle of the report containing all the data from all samples
+        """
         # Create a report for each sample from :self.resultprofile
-        for sample in self.runmetadata.samples:
+        for sample in self.sequencetyper():
             if sample.general.bestassemblyfile != 'NA':
                 if sample[self.analysistype].reportdir != 'NA':
                     if type(sample[self.analysistype].allelenames) == list:
@@ -327,7 +337,7 @@ class GeneSippr(object):
                                 row += ',,{},{},'.format(seqtype, sample[self.analysistype].matches)
                             # Iterate through all the genes present in the analyses for the sample
                             for gene in sorted(sample[self.analysistype].allelenames):
-                                refallele = sample[self.analysistype].profiledata[seqtype][gene]
+                                refallele = self.profiles[sample[self.analysistype].profile].allele(seqtype, gene)
                                 # Set the allele and percent id from the dictionary's keys and values, respectively
                                 allele = \
                                     list(self.resultprofile[sample.name][seqtype][sample[self.analysistype].matches]
@@ -354,7 +364,10 @@ class GeneSippr(object):
                             row += '\n'
                             # Increment the number of sequence types observed for the sample
                             seqcount += 1
-                        combinedrow += row
+                        # Write the rows of the sample, and flush them to disk, so that the report of an interrupted
+                        # run includes every typed sample
+                        combinedreport.write(row)
+                        combinedreport.flush()
                         # If the length of the # of report directories is greater than 1 (script is being run as part of
                         # the assembly pipeline) make a report for each sample
                         if self.pipeline:
@@ -364,19 +377,6 @@ class GeneSippr(object):
                                 # Write the row to the report
                                 report.write(row)
                 dotter()
-            # Create the report folder
-            make_path(self.reportpath)
-            # Create the report containing all the data from all samples
-            if self.pipeline:
-                with open(os.path.join(self.reportpath,  '{}.csv'.format(self.analysistype)), 'w') \
-                        as combinedreport:
-                    # Write the results to this report
-                    combinedreport.write(combinedrow)
-            else:
-                with open(os.path.join(self.reportpath, '{}_{:}.csv'.format(
-                        self.analysistype, time.strftime("%Y.%m.%d.%H.%M.%S"))), 'w') as combinedreport:
-                    # Write the results to this report
-                    combinedreport.write(combinedrow)
 
     def __init__(self, args, pipelinecommit, startingtime, scriptpath, analysistype, cutoff, pipeline):
         """
@@ -446,6 +446,22 @@ class GeneSippr(object):
             self.copy = args.copy
         except AttributeError:
             self.copy = False
+        # Number of closest sequence types to report for partial profiles, and the maximum number of mismatched genes
+        # allowed for those sequence types
+        try:
+            self.nearest = int(args.nearest)
+        except AttributeError:
+            self.nearest = 5
+        try:
+            self.tolerance = int(args.tolerance)
+        except AttributeError:
+            self.tolerance = 3
+        try:
+            self.kmercalling = args.kmercalling
+        except AttributeError:
+            self.kmercalling = False
+        # Pass any arguments of the optional FastSippr stages on to the analyses
+        fastsipprattributes(self, args)
         self.runmetadata = args.runmetadata
         # Use the argument for the number of threads to use, or default to the number of cpus in the system
         try:
@@ -475,6 +491,10 @@ class GeneSippr(object):
         self.mlstseqtype = defaultdict(make_dict)
         self.resultprofile = defaultdict(make_dict)
         self.referenceprofile = defaultdict(make_dict)
+        self.mismatchgenes = dict()
+        self.alleleindex = dict()
+        # Dictionary of profile file: Profile object shared by all the samples typed with the scheme
+        self.profiles = dict()
         # Run the analyses
         self.runner()
 
@@ -538,11 +558,22 @@ if __name__ == '__main__':
     parser.add_argument('-a', '--analysistype',
                         required=True,
                         help='Specify analysis type: mlst or rmlst')
+    parser.add_argument('--nearest',
+                        default=5,
+                        help='Number of closest sequence types to report for samples without an exact match. '
+                             'Default is 5')
+    parser.add_argument('--tolerance',
+                        default=3,
+                        help='Maximum number of mismatched genes allowed for the closest sequence types. Default is 3')
+    parser.add_argument('--kmercalling',
+                        action='store_true',
+                        help='Call alleles that are fully covered by the k-mers of the baited reads without reference '
+                             'mapping. Genes without a single fully covered allele are still mapped')
     parser.add_argument('-C', '--copy',
                         action='store_true',
                         help='Normally, the program will create symbolic links of the files into the sequence path, '
                              'however, the are occasions when it is necessary to copy the files instead')
-
+    fastsipprarguments(parser)
     # Get the arguments into an object
     arguments = parser.parse_args()
     arguments.pipeline = False
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+from csv import DictReader
+from itertools import product
+from sipprutilities.fileio import atomicwrite, checksum
+import numpy
+import json
+import os
+__author__ = 'adamkoziol'
+
+# Code used in the profile matrix for genes with an allele of 'N'
+NOALLELE = -1
+# Code used for query alleles that are not present in the profile. As it is never stored in the matrix, it never matches
+UNKNOWN = numpy.iinfo(numpy.int32).min
+# Special handling of BACT000060 and BACT000065 genes for E. coli and BACT000014 for Listeria. When the reference
+# profile has an allele of 'N', any query allele other than 'N' is counted as a match
+NGENES = {'BACT000060', 'BACT000065', 'BACT000014'}
+
+
+def sortalleles(refallele):
+    """
+    Sort profile entries with multiple allele matches e.g. 692 10 numerically, so that they can be compared to the
+    sorted query alleles
+    :param refallele: allele number(s) of a gene in the reference profile
+    :return: string of the sorted allele number(s) joined with a space
+    """
+    if len(refallele.split(" ")) > 1:
+        # Map the split (on a space) alleles as integers - if they are treated as integers, the alleles will sort
+        # properly
+        return " ".join(str(allele) for allele in sorted(map(int, refallele.split(" "))))
+    return refallele
+
+
+class Profile(object):
+    """
+    Integer matrix (sequence types x genes) of a sequence type profile file. Allele numbers are stored as integers,
+    'N' alleles as NOALLELE, and all other entries (e.g. multiple allele matches) as negative codes starting at -2.
+    Indexing the object with a sequence type returns a dictionary of gene: allele, so it can be used in place of the
+    nested profile dictionaries
+    """
+
+    def encode(self, allele, create=False):
+        """
+        Convert an allele string into its code in the profile matrix
+        :param allele: allele number(s) as a string
+        :param create: boolean of whether a code should be created for previously unseen entries
+        :return: integer code of the allele
+        """
+        try:
+            return int(allele)
+        except ValueError:
+            pass
+        if allele == 'N':
+            return NOALLELE
+        allele = sortalleles(allele)
+        if create:
+            return self.codes.setdefault(allele, -2 - len(self.codes))
+        return self.codes.get(allele, UNKNOWN)
+
+    def decode(self, code):
+        """
+        Convert a code from the profile matrix back into an allele string
+        :param code: integer code of the allele
+        :return: allele number(s) as a string
+        """
+        if code >= 0:
+            return str(code)
+        if code == NOALLELE:
+            return 'N'
+        return self.names[code]
+
+    def typing(self, queries, identities):
+        """
+        Determine the best sequence type(s) of multiple samples at once. The alleles of all the samples are stacked
+        into a single matrix, and compared to the profile matrix one gene at a time
+        :param queries: list of dictionaries of gene: query allele(s) (sorted, and joined with a space) for each sample
+        :param identities: list of dictionaries of gene: percent identity of the query allele(s) for each sample
+        :return: list of tuples for each sample of: dictionary of best sequence type(s): number of matching genes, and
+        dictionary of best sequence type(s): set of genes with alleles that differ from the sequence type. Samples
+        without any matches have empty dictionaries
+        """
+        values = numpy.array([[self.encode(query.get(gene, 'NA')) for gene in self.genes] for query in queries],
+                             dtype=numpy.int32).reshape(len(queries), len(self.genes))
+        perfect = numpy.array([[float(identity.get(gene, 0)) == 100.00 for gene in self.genes]
+                               for identity in identities], dtype=bool).reshape(len(queries), len(self.genes))
+        # Transpose the profile matrix, so that the alleles of each gene are contiguous in memory
+        columns = numpy.ascontiguousarray(self.matrix.T)
+        counts = numpy.zeros((len(queries), len(self.sequencetypes)), dtype=numpy.int32)
+        for index in range(len(self.genes)):
+            # Compare the allele of every sample (rows) to the allele of every sequence type (columns)
+            counts += self.matching(columns[index], values[:, index, numpy.newaxis],
+                                    perfect[:, index, numpy.newaxis], self.special[index])
+        results = list()
+        for index in range(len(queries)):
+            best = int(counts[index].max()) if len(self.sequencetypes) else 0
+            if not best:
+                results.append((dict(), dict()))
+                continue
+            rows = numpy.flatnonzero(counts[index] == best)
+            matches = {self.sequencetypes[row]: best for row in rows}
+            # Genes with alleles that differ from the allele in the best sequence type(s)
+            mismatches = {self.sequencetypes[row]: {gene for gene, differs in zip(self.genes,
+                                                                                  self.matrix[row] != values[index])
+                                                    if differs} for row in rows}
+            results.append((matches, mismatches))
+        return results
+
+    @staticmethod
+    def matching(reference, query, perfect, special):
+        """
+        Determine which profile alleles match the query alleles. Query alleles with 100% identity match the same
+        allele in the profile, and 'N' alleles match 'N'. For the special genes, a profile allele of 'N' matches any
+        query allele other than 'N'
+        :param reference: array of the codes of the profile alleles
+        :param query: array of the codes of the query alleles (broadcast against the profile alleles)
+        :param perfect: boolean array of whether each query allele has 100% identity
+        :param special: boolean (or boolean array) of whether the gene(s) are special
+        :return: boolean array of whether each profile allele matches the query allele
+        """
+        equal = reference == query
+        return numpy.where(special, (equal & perfect) | ((reference == NOALLELE) & (query != NOALLELE)),
+                           equal & (perfect | (query == NOALLELE)))
+
+    def nearest(self, query, identity, k=5, tolerance=3):
+        """
+        Find the sequence types closest to the query alleles, using the same definition of a matching allele as
+        typing(). A sequence type with at most tolerance mismatched genes must match the query in at least one of
+        tolerance + 1 blocks of genes, so only the sequence types that share a block with the query (found with the
+        block index) are compared to the query
+        :param query: dictionary of gene: query allele(s) (sorted, and joined with a space)
+        :param identity: dictionary of gene: percent identity of the query allele(s)
+        :param k: maximum number of sequence types to return
+        :param tolerance: maximum number of mismatched genes
+        :return: list of up to k tuples of sequence type, and set of mismatched genes sorted by number of mismatches
+        """
+        values = numpy.array([self.encode(query.get(gene, 'NA')) for gene in self.genes], dtype=numpy.int32)
+        perfect = numpy.array([float(identity.get(gene, 0)) == 100.00 for gene in self.genes], dtype=bool)
+        candidates = set()
+        for columns, index in self.blockindex(tolerance):
+            # A profile allele of 'N' in a special gene matches any query allele other than 'N', so look up both
+            # possibilities for these genes
+            options = [(value, NOALLELE) if self.special[column] and value != NOALLELE else (value,)
+                       for column, value in zip(columns, values[columns])]
+            for key in product(*options):
+                candidates.update(index.get(numpy.array(key, dtype=numpy.int32).tobytes(), list()))
+        if not candidates:
+            return list()
+        rows = numpy.array(sorted(candidates), dtype=numpy.int64)
+        differs = ~self.matching(self.matrix[rows], values, perfect, self.special)
+        distances = differs.sum(axis=1)
+        # Sort the candidates by the number of mismatches, and then by their order in the profile
+        order = [position for position in numpy.lexsort((rows, distances)) if distances[position] <= tolerance][:k]
+        return [(self.sequencetypes[rows[position]],
+                 {gene for gene, mismatch in zip(self.genes, differs[position]) if mismatch}) for position in order]
+
+    def blockindex(self, tolerance):
+        """
+        Split the genes into tolerance + 1 blocks, and create an index of the packed alleles of each block: the
+        alleles of a block are packed into a single bytes key, which is linked to the rows of all the sequence types
+        with those alleles. The index is created once for each tolerance
+        :param tolerance: maximum number of mismatched genes
+        :return: list of tuples of the columns in each block, and dictionary of packed alleles: array of rows
+        """
+        if tolerance not in self.blockindexes:
+            blockindex = list()
+            for columns in numpy.array_split(numpy.arange(len(self.genes)), tolerance + 1):
+                # Empty blocks (more blocks than genes) match every sequence type
+                if not len(columns):
+                    blockindex.append((columns, {b'': numpy.arange(len(self.sequencetypes))}))
+                    continue
+                block = numpy.ascontiguousarray(self.matrix[:, columns], dtype=numpy.int32)
+                # View each row of the block as a single value, so identical rows can be grouped with numpy.unique
+                packed = block.view(numpy.dtype((numpy.void, block.itemsize * len(columns)))).ravel()
+                keys, inverse = numpy.unique(packed, return_inverse=True)
+                inverse = inverse.ravel()
+                # Group the rows by their packed alleles
+                order = numpy.argsort(inverse, kind='mergesort')
+                groups = numpy.split(order, numpy.cumsum(numpy.bincount(inverse, minlength=len(keys)))[:-1])
+                blockindex.append((columns, {key.tobytes(): group for key, group in zip(keys, groups)}))
+            self.blockindexes[tolerance] = blockindex
+        return self.blockindexes[tolerance]
+
+    def extend(self, profile):
+        """
+        Add the sequence types from another profile (e.g. a supplemental profile) to this profile. Sequence types that
+        are present in both profiles are replaced with the definitions in the other profile
+        :param profile: Profile object with the same genes
+        """
+        # Re-encode the alleles of the other profile, as the codes of non-numeric entries differ between profiles
+        rows = numpy.array([[self.encode(profile.decode(int(code)), create=True) for code in row]
+                            for row in profile.matrix], dtype=numpy.int32).reshape(len(profile), len(self.genes))
+        # Copy the matrix, as compiled profiles are memory-mapped in read-only mode
+        matrix = numpy.array(self.matrix)
+        new = list()
+        for sequencetype, row in zip(profile.sequencetypes, rows):
+            if sequencetype in self.rows:
+                matrix[self.rows[sequencetype]] = row
+            else:
+                self.rows[sequencetype] = len(self.sequencetypes)
+                self.sequencetypes.append(sequencetype)
+                new.append(row)
+        if new:
+            matrix = numpy.vstack([matrix] + new)
+        self.matrix = matrix
+        self.names = {code: allele for allele, code in self.codes.items()}
+        # The block indices are no longer valid
+        self.blockindexes = dict()
+
+    def parse(self, profilefile):
+        """
+        Parse the profile file, and encode the alleles of each sequence type into the profile matrix
+        :param profilefile: name and path of the tab-delimited profile file
+        """
+        rows = list()
+        with open(profilefile) as profile:
+            reader = DictReader(profile, dialect='excel-tab')
+            # rMLST profiles use rST rather than ST as the name of the sequence type column
+            stcolumn = 'ST' if 'ST' in reader.fieldnames else 'rST'
+            for row in reader:
+                self.sequencetypes.append(row[stcolumn])
+                rows.append([self.encode(row[gene], create=True) for gene in self.genes])
+        self.matrix = numpy.array(rows, dtype=numpy.int32).reshape(len(rows), len(self.genes))
+
+    def load(self, profilefile):
+        """
+        Load the compiled profile stored next to the profile file. The matrix is memory-mapped rather than read. The
+        compiled profile is only used if the profile file is unchanged: the modification time and size are checked
+        first, and if they differ, the checksum of the file is compared to the checksum of the compiled file
+        :param profilefile: name and path of the profile file
+        :return: boolean of whether the compiled profile was loaded
+        """
+        matrixfile, metadatafile = self.compiledfiles(profilefile)
+        try:
+            with open(metadatafile) as metadata:
+                compiled = json.load(metadata)
+            stats = os.stat(profilefile)
+            # The genes may be supplied in a different order than in the analysis that compiled the profile
+            if sorted(compiled['genes']) != sorted(self.genes):
+                return False
+            if compiled['mtime'] != stats.st_mtime or compiled['size'] != stats.st_size:
+                if compiled['checksum'] != checksum(profilefile):
+                    return False
+                # The file was touched, but not changed. Update the compiled profile with the new modification time
+                compiled['mtime'] = stats.st_mtime
+                compiled['size'] = stats.st_size
+                try:
+                    atomicwrite(metadatafile, lambda handle: json.dump(compiled, handle), 'w')
+                except (IOError, OSError):
+                    pass
+            matrix = numpy.load(matrixfile, mmap_mode='r')
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+        # Ensure that the matrix corresponds to the metadata
+        if matrix.shape != (len(compiled['sequencetypes']), len(self.genes)):
+            return False
+        # Reorder the columns of the matrix to match the order of the genes in this analysis. The matrix is only
+        # copied if the order differs
+        if compiled['genes'] != self.genes:
+            columns = {gene: column for column, gene in enumerate(compiled['genes'])}
+            matrix = matrix[:, [columns[gene] for gene in self.genes]]
+        self.matrix = matrix
+        self.sequencetypes = compiled['sequencetypes']
+        self.codes = compiled['codes']
+        return True
+
+    def save(self, profilefile):
+        """
+        Write the compiled profile next to the profile file. If the folder cannot be written to, the profile will
+        simply be parsed again in the next analysis
+        :param profilefile: name and path of the profile file
+        """
+        matrixfile, metadatafile = self.compiledfiles(profilefile)
+        stats = os.stat(profilefile)
+        compiled = {'mtime': stats.st_mtime,
+                    'size': stats.st_size,
+                    'checksum': checksum(profilefile),
+                    'genes': self.genes,
+                    'sequencetypes': self.sequencetypes,
+                    'codes': self.codes}
+        try:
+            # Write the matrix before the metadata, as the metadata determines whether the matrix is used
+            atomicwrite(matrixfile, lambda handle: numpy.save(handle, self.matrix), 'wb')
+            atomicwrite(metadatafile, lambda handle: json.dump(compiled, handle), 'w')
+        except (IOError, OSError):
+            pass
+
+    @staticmethod
+    def compiledfiles(profilefile):
+        """
+        :param profilefile: name and path of the profile file
+        :return: names of the compiled matrix and metadata files
+        """
+        base = os.path.splitext(profilefile)[0]
+        return base + '_compiled.npy', base + '_compiled.json'
+
+    def allele(self, sequencetype, gene):
+        """
+        Look up the allele of a single gene of a sequence type directly in the profile matrix, without decoding the
+        rest of the profile of the sequence type
+        :param sequencetype: sequence type
+        :param gene: name of the gene
+        :return: allele number(s) as a string. Sequence types not in the profile (e.g. 'NA') have empty alleles
+        """
+        column = self.columns[gene]
+        try:
+            row = self.rows[sequencetype]
+        except KeyError:
+            return str()
+        return self.decode(int(self.matrix[row, column]))
+
+    def __getitem__(self, sequencetype):
+        try:
+            row = self.matrix[self.rows[sequencetype]]
+        # Sequence types not in the profile (e.g. 'NA') do not have any alleles
+        except KeyError:
+            return {gene: str() for gene in self.genes}
+        return {gene: self.decode(int(code)) for gene, code in zip(self.genes, row)}
+
+    def __iter__(self):
+        return iter(self.sequencetypes)
+
+    def __len__(self):
+        return len(self.sequencetypes)
+
+    def __init__(self, profilefile, genes):
+        """
+        :param profilefile: name and path of the tab-delimited profile file
+        :param genes: list of the genes in the analysis
+        """
+        self.genes = list(genes)
+        # Dictionary of gene: column in the matrix
+        self.columns = {gene: column for column, gene in enumerate(self.genes)}
+        self.special = numpy.array([gene in NGENES for gene in self.genes], dtype=bool)
+        # Dictionaries of allele string: code, and code: allele string for the entries that are not allele numbers
+        self.codes = dict()
+        self.sequencetypes = list()
+        self.matrix = None
+        # Dictionary of mismatch tolerance: block index used in nearest sequence type searches
+        self.blockindexes = dict()
+        # Use the compiled profile from a previous analysis if it is up to date. Otherwise, parse the profile file, and
+        # compile it for future analyses
+        if not self.load(profilefile):
+            self.parse(profilefile)
+            self.save(profilefile)
+        self.names = {code: allele for allele, code in self.codes.items()}
+        # Dictionary of sequence type: row in the matrix
+        self.rows = {sequencetype: row for row, sequencetype in enumerate(self.sequencetypes)}
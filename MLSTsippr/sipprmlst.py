@@ -1,13 +1,21 @@
 #!/usr/bin/env python
 from accessoryFunctions.accessoryFunctions import printtime, GenObject
 from sipprCommon.sippingmethods import Sippr
+from fastsippr.fastsippr import FastSippr
+from fastsippr.fastqio import fastqchunks
+from fastsippr.kmers import kmerhashes
+from sipprutilities.fileio import atomicwrite
+from collections import defaultdict
+from threading import Thread
+from queue import Queue
 from Bio import SeqIO
 from glob import glob
+import numpy
 import os
 __author__ = 'adamkoziol'
 
 
-class MLSTmap(Sippr):
+class MLSTmap(FastSippr):
 
     def targets(self):
         printtime('Finding {} target files'.format(self.analysistype), self.start)
@@ -50,14 +58,18 @@ class MLSTmap(Sippr):
         genedict = dict()
         for combinedfile in alleleset:
             genedict[combinedfile] = set()
+            self.alleleindex[combinedfile] = dict()
             # Find all the gene names from the combined alleles files
             for record in SeqIO.parse(open(combinedfile, "rU"), "fasta"):
-                # Determine whether an underscore, or a hyphen is being used to separate the gene name and allele
-                # number, split on the delimiter, and add the gene name to the set
-                if '_' in record.id:
-                    genedict[combinedfile].add(record.id.split('_')[0])
-                elif '-' in record.id:
-                    genedict[combinedfile].add(record.id.split('-')[0])
+                # Parse the allele name into the gene name and allele number once, so that the results can be linked
+                # to the genes with a dictionary lookup
+                # Skip records whose names do not contain a delimiter
+                try:
+                    gene, allele = self.allelesplitter(record.id)
+                except ValueError:
+                    continue
+                self.alleleindex[combinedfile][record.id] = (gene, allele)
+                genedict[combinedfile].add(gene)
         #
         for sample in self.runmetadata:
             if sample.general.bestassemblyfile != 'NA':
@@ -90,12 +102,173 @@ class MLSTmap(Sippr):
                                                                      '{}_targetMatches.fastq.gz'
                                                                      .format(self.analysistype))
 
+    def bait(self, maskmiddle='f', k='27'):
+        """
+        Bait the reads with bbduk, and then (if desired) call the alleles that are exactly matched by the k-mers of the
+        baited reads, so that only the remaining genes need to go through reference mapping
+        """
+        Sippr.bait(self, maskmiddle, k)
+        if self.kmercalling:
+            self.exactcalling()
+
+    def exactcalling(self):
+        """
+        Find the alleles that have all their k-mers present in the baited reads at sufficient depth. If exactly one
+        allele of a gene is fully covered, the allele is called without mapping. The alleles of the other genes are
+        written to a reduced target file, which is used for the reference mapping
+        """
+        printtime('Calling exact {} alleles from k-mers'.format(self.analysistype), self.start)
+        for i in range(len(self.runmetadata)):
+            # Send the threads to the exact calling method
+            threads = Thread(target=self.exactcall, args=())
+            # Set the daemon to true - something to do with thread management
+            threads.setDaemon(True)
+            # Start the threading
+            threads.start()
+        for sample in self.runmetadata:
+            if sample.general.bestassemblyfile != 'NA':
+                # Samples without alleles are not called, but still receive empty exact calls
+                sample[self.analysistype].exactresults = dict()
+                sample[self.analysistype].exactdepth = dict()
+            if sample.general.bestassemblyfile != 'NA' and sample[self.analysistype].runanalysis:
+                # Set the name of the reduced target file. Note that the .fasta extension is required, as it is
+                # stripped off to create the name of the bowtie2 index
+                sample[self.analysistype].unresolvedtargets = \
+                    os.path.join(sample[self.analysistype].outputdir,
+                                 '{}_unresolvedtargets.fasta'.format(self.analysistype))
+                self.exactqueue.put(sample)
+        self.exactqueue.join()
+
+    def exactcall(self):
+        while True:
+            sample = self.exactqueue.get()
+            alleleindex = self.alleleindex.get(sample[self.analysistype].combinedalleles, dict())
+            # Count the k-mers in the baited reads
+            hashes = [numpy.zeros(0, dtype=numpy.uint64)]
+            for chunk in fastqchunks(sample[self.analysistype].baitedfastq, threads=self.threads):
+                kmers, _, _ = kmerhashes([sequence for _, sequence, _ in chunk], self.exactkmer)
+                hashes.append(kmers)
+            readkmers, readcounts = numpy.unique(numpy.concatenate(hashes), return_counts=True)
+            # Find the fully covered alleles of each gene. Process the alleles in batches to keep memory usage
+            # constant for large databases
+            covered = defaultdict(dict)
+            batch = list()
+            length = 0
+            for record in SeqIO.parse(sample[self.analysistype].baitfile, 'fasta'):
+                batch.append(record)
+                length += len(record.seq)
+                if length >= 5000000:
+                    self.coveredalleles(batch, readkmers, readcounts, alleleindex, covered)
+                    batch = list()
+                    length = 0
+            self.coveredalleles(batch, readkmers, readcounts, alleleindex, covered)
+            # Call the alleles of the genes with exactly one fully covered allele
+            sample[self.analysistype].exactresults = dict()
+            sample[self.analysistype].exactdepth = dict()
+            for gene, alleles in covered.items():
+                if len(alleles) == 1:
+                    for allele, depth in alleles.items():
+                        sample[self.analysistype].exactresults[allele] = '{:.2f}'.format(100)
+                        sample[self.analysistype].exactdepth[allele] = '{:.2f}'.format(depth)
+            resolved = {alleleindex[allele][0] for allele in sample[self.analysistype].exactresults}
+            # Write the alleles of the remaining genes to the reduced target file. The file is rewritten on every
+            # run, as the resolved genes depend on the baited reads
+            records = (record for record in SeqIO.parse(sample[self.analysistype].baitfile, 'fasta')
+                       if alleleindex.get(record.id, (None,))[0] not in resolved)
+            atomicwrite(sample[self.analysistype].unresolvedtargets,
+                        lambda unresolved: SeqIO.write(records, unresolved, 'fasta'))
+            # If every gene was called, there is no need to perform the mapping. The results of the mapping will not
+            # be populated, so initialise them here to receive the exact calls
+            if not os.path.getsize(sample[self.analysistype].unresolvedtargets):
+                sample[self.analysistype].runanalysis = False
+            try:
+                sample[self.analysistype].results
+            except KeyError:
+                sample[self.analysistype].results = dict()
+            try:
+                sample[self.analysistype].avgdepth
+            except KeyError:
+                sample[self.analysistype].avgdepth = dict()
+            # Set the baitfile to use in the mapping steps as the reduced target file
+            sample[self.analysistype].baitfile = sample[self.analysistype].unresolvedtargets
+            self.exactqueue.task_done()
+
+    def coveredalleles(self, records, readkmers, readcounts, alleleindex, covered):
+        """
+        Find the alleles with every k-mer present in the reads at least self.averagedepth times. Requiring each k-mer,
+        rather than the average, to reach the depth floor prevents a single read with a variant from calling the
+        variant allele when the true allele is covered at a high depth
+        :param records: list of SeqIO records of the alleles
+        :param readkmers: sorted array of unique k-mer hashes in the baited reads
+        :param readcounts: array of the number of times each k-mer is present in the baited reads
+        :param alleleindex: dictionary of allele name: (gene name, allele number)
+        :param covered: dictionary of gene: {allele name: depth} to populate with the fully covered alleles
+        """
+        # Alleles shorter than the k-mer length cannot be covered
+        records = [record for record in records if len(record.seq) >= self.exactkmer]
+        if not records or not len(readkmers):
+            return
+        hashes, owners, _ = kmerhashes([str(record.seq) for record in records], self.exactkmer)
+        # Find the number of times each of the k-mers of the alleles is present in the reads
+        indices = numpy.minimum(numpy.searchsorted(readkmers, hashes), len(readkmers) - 1)
+        counts = numpy.where(readkmers[indices] == hashes, readcounts[indices], 0)
+        # The k-mers are ordered by allele, so the k-mers of each allele are a contiguous segment of the arrays.
+        # Alleles with unknown bases in every k-mer have empty segments, and are skipped
+        kmercounts = numpy.bincount(owners, minlength=len(records))
+        alleles = numpy.flatnonzero(kmercounts)
+        starts = numpy.searchsorted(owners, alleles)
+        minimum = numpy.minimum.reduceat(counts, starts)
+        # Convert the average k-mer count into the average depth of coverage of the bases
+        lengths = numpy.array([len(records[allele].seq) for allele in alleles], dtype=numpy.float64)
+        depth = numpy.add.reduceat(counts, starts) / kmercounts[alleles] * lengths / (lengths - self.exactkmer + 1)
+        for allele, lowest, coverage in zip(alleles, minimum, depth):
+            name = records[allele].id
+            if lowest >= self.averagedepth and name in alleleindex:
+                covered[alleleindex[name][0]][name] = float(coverage)
+
+    def clipper(self):
+        """
+        Filter the mapping results as in Sippr.clipper, and then add the alleles called from k-mers to the results
+        """
+        FastSippr.clipper(self)
+        for sample in self.runmetadata:
+            if self.kmercalling and sample.general.bestassemblyfile != 'NA':
+                sample[self.analysistype].results.update(sample[self.analysistype].exactresults)
+                sample[self.analysistype].avgdepth.update(sample[self.analysistype].exactdepth)
+
+    @staticmethod
+    def allelesplitter(allelename):
+        """
+        Split an allele name e.g. abcZ_2 or BACT000001-5 into the gene name and the allele number
+        :param allelename: name of the allele in the combined allele file
+        :return: tuple of the gene name and allele number
+        :raises ValueError: if the name does not contain a delimiter
+        """
+        # Determine whether an underscore, or a hyphen is being used to separate the gene name and allele number
+        if '_' in allelename:
+            splitter = '_'
+        elif '-' in allelename:
+            splitter = '-'
+        else:
+            raise ValueError('Cannot split allele name {} into a gene name and allele number'.format(allelename))
+        gene, allele = allelename.split(splitter)[:2]
+        return gene, allele
+
     def __init__(self, inputobject, analysistype, cutoff):
         self.analysistype = analysistype
+        # Dictionary of combined allele file: {allele name: (gene name, allele number)}
+        self.alleleindex = dict()
         self.targetpath = inputobject.targetpath
         self.profileset = set()
         self.runmetadata = inputobject.runmetadata.samples
         self.pipeline = inputobject.pipeline
         self.copy = inputobject.copy
         self.logfile = inputobject.logfile
-        Sippr.__init__(self, inputobject, cutoff)
+        # Determine whether alleles exactly matched by the k-mers of the baited reads should be called without mapping
+        try:
+            self.kmercalling = inputobject.kmercalling
+        except AttributeError:
+            self.kmercalling = False
+        self.exactkmer = 31
+        self.exactqueue = Queue(maxsize=inputobject.cpus)
+        FastSippr.__init__(self, inputobject, cutoff)
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 from SPAdesPipeline.OLCspades.mMLST import *
+from MLSTsippr.closestalleles import ClosestAlleles
+from MLSTsippr.profiles import Profile
 from subprocess import call
 # from customtargets import *
 
@@ -119,89 +121,17 @@ class MLSTmap(object):
         """
         Completely changed the mapping logic, so this method overrides the default method
         """
-        self.rmlstsketching()
-        self.rmlstmashing()
+        self.closestalleles()
 
-    def rmlstsketching(self):
+    def closestalleles(self):
         """
-        Create a sketch file of the baited fastq to be used by mash to determine the closest alleles for each gene
-        """
-        printtime('Indexing {} sorted bam files'.format(self.analysistype), self.start)
-        for i in range(len(self.runmetadata)):
-            # Send the threads to
-            threads = Thread(target=self.rmlstsketch, args=())
-            # Set the daemon to true - something to do with thread management
-            threads.setDaemon(True)
-            # Start the threading
-            threads.start()
-        for sample in self.runmetadata:
-            if sample.general.bestassemblyfile != 'NA':
-                sample[self.analysistype].sketchcall = 'mash sketch -s 100000 -m 2 -p {} -o {}{}_sketch {}'.format(
-                    self.cpus, sample[self.analysistype].reportdir, self.analysistype,
-                    sample[self.analysistype].baitedfastq)
-                sample[self.analysistype].sketchfile = '{}{}_sketch.msh'.format(sample[self.analysistype].reportdir,
-                                                                                self.analysistype)
-                self.sketchqueue.put(sample)
-        self.sketchqueue.join()
-
-    def rmlstsketch(self):
-        while True:
-            sample = self.sketchqueue.get()
-            if not os.path.isfile(sample[self.analysistype].sketchfile):
-                call(sample[self.analysistype].sketchcall, shell=True, stdout=self.devnull, stderr=self.devnull)
-            self.sketchqueue.task_done()
-
-    def rmlstmashing(self):
-        """
-        Run mash to determine the closest alleles for each gene in the analysis
+        Determine the five closest alleles of each gene in the analysis to the baited reads. The k-mers of the alleles
+        are loaded once for each set of allele files, and all the genes are scored for a sample in a single step
         """
         printtime('Finding closest alleles for each {} gene target'.format(self.analysistype), self.start)
-        for sample in self.runmetadata:
-            if sample.general.bestassemblyfile != 'NA':
-                if 'alleles' in sample[self.analysistype].datastore:
-                    for i in range(len(sample[self.analysistype].allelenames)):
-                        # Send the threads to
-                        threads = Thread(target=self.rmlstmash, args=())
-                        # Set the daemon to true - something to do with thread management
-                        threads.setDaemon(True)
-                        # Start the threading
-                        threads.start()
-        for sample in self.runmetadata:
-            if sample.general.bestassemblyfile != 'NA':
-                # Set the name, and create the directory to store the mash tables
-                sample[self.analysistype].mashtabledir = os.path.join(sample[self.analysistype].reportdir, 'mashtables')
-                make_path(sample[self.analysistype].mashtabledir)
-                outtablelist = list()
-                if 'alleles' in sample[self.analysistype].datastore:
-                    for allele in sample[self.analysistype].alleles:
-                        # Create the name for the table file
-                        outtable = '{}/{}.tab'.format(sample[self.analysistype].mashtabledir,
-                                                      os.path.split(allele)[1].split('.')[0])
-                        outtablelist.append(outtable)
-                        # Not adding the mash command to the object, as there are 53 rMLST genes, and it will get messy
-                        mashcommand = 'mash dist -i -p {} {} {} | sort -gk3 > {}'.format(
-                            self.cpus, sample[self.analysistype].sketchfile, allele, outtable)
-                        self.mashqueue.put((outtable, mashcommand))
-                    sample[self.analysistype].outtables = sorted(outtablelist)
-        self.mashqueue.join()
-        self.rmlstmashparsing()
-
-    def rmlstmash(self):
-        while True:
-            outtable, mashcommand = self.mashqueue.get()
-            # Run the command if the table has not yet been created
-            if not os.path.isfile(outtable):
-                call(mashcommand, shell=True, stdout=self.devnull, stderr=self.devnull)
-            self.mashqueue.task_done()
-
-    def rmlstmashparsing(self):
-        """
-        Parses mash results to determine the five closest alleles for each gene in the analysis
-        """
-        printtime('Parsing closest {} allele matches'.format(self.analysistype), self.start)
         for i in range(len(self.runmetadata)):
             # Send the threads to
-            threads = Thread(target=self.rmlstmashparse, args=())
+            threads = Thread(target=self.closestallele, args=())
             # Set the daemon to true - something to do with thread management
             threads.setDaemon(True)
             # Start the threading
@@ -210,20 +140,23 @@ class MLSTmap(object):
             if sample.general.bestassemblyfile != 'NA':
                 sample[self.analysistype].mashalleles = list()
                 if 'alleles' in sample[self.analysistype].datastore:
-                    for table in sample[self.analysistype].outtables:
-                        self.mashparsequeue.put((sample, table))
-        self.mashparsequeue.join()
+                    # Load the alleles of the sample's allele files (if they have not already been loaded)
+                    allelefiles = tuple(sorted(sample[self.analysistype].alleles))
+                    if allelefiles not in self.allelesketches:
+                        self.allelesketches[allelefiles] = ClosestAlleles(allelefiles)
+                    self.closestqueue.put((sample, self.allelesketches[allelefiles]))
+        self.closestqueue.join()
         self.reduceddatabasecreating()
 
-    def rmlstmashparse(self):
+    def closestallele(self):
         while True:
-            sample, table = self.mashparsequeue.get()
-            # Open the mash results and extract the top five lines
-            data = open(table, 'rb').readlines()[:5]
-            for row in data:
-                # Populate the attribute with the gene/allele name from the mash results
-                sample[self.analysistype].mashalleles.append(row.split('\t')[1])
-            self.mashparsequeue.task_done()
+            sample, allelesketches = self.closestqueue.get()
+            # Find the k-mers in the baited reads, and score the alleles of every gene against them
+            readkmers = allelesketches.readkmers(sample[self.analysistype].baitedfastq)
+            for gene, alleles in sorted(allelesketches.closest(readkmers, 5).items()):
+                # Populate the attribute with the gene/allele names of the closest alleles
+                sample[self.analysistype].mashalleles.extend(alleles)
+            self.closestqueue.task_done()
 
     def reduceddatabasecreating(self):
         """
@@ -498,7 +431,6 @@ class MLSTmap(object):
         """Creates a dictionary from the profile scheme(s)"""
         printtime('Loading {} sequence profiles'.format(self.analysistype), self.start)
         # Initialise variables
-        profiledata = defaultdict(make_dict)
         profileset = set()
         supplementalset = ''
         genedict = {}
@@ -518,39 +450,17 @@ class MLSTmap(object):
                 if sample.general.bestassemblyfile != 'NA':
                     if sequenceprofile == sample[self.analysistype].profile[0]:
                         genelist = [os.path.split(x)[1].split('.')[0] for x in sample[self.analysistype].alleles]
-            try:
-                # Open the sequence profile file as a dictionary
-                profile = DictReader(open(sequenceprofile), dialect='excel-tab')
-            # Revert to standard comma separated values
-            except KeyError:
-                # Open the sequence profile file as a dictionary
-                profile = DictReader(open(sequenceprofile))
-            # Iterate through the rows
-            for row in profile:
-                # Iterate through the genes
-                for gene in genelist:
-                    # Add the sequence profile, and type, the gene name and the allele number to the dictionary
-                    try:
-                        profiledata[sequenceprofile][row['ST']][gene] = row[gene]
-                    except KeyError:
-                        profiledata[sequenceprofile][row['rST']][gene] = row[gene]
+            # Load the (compiled) sequence profile. The profile is stored once, and the samples refer to it with the
+            # name of their profile file
+            self.profiles[sequenceprofile] = Profile(sequenceprofile, genelist)
             # Load the supplemental profile definitions
             if self.analysistype == 'rmlst':
-                supplementalprofile = DictReader(open(supplementalset), dialect='excel-tab')
-                # Do the same with the supplemental profile
-                for row in supplementalprofile:
-                    # Iterate through the genes
-                    for gene in genelist:
-                        # Add the sequence profile, and type, the gene name and the allele number to the dictionary
-                        profiledata[sequenceprofile][row['rST']][gene] = row[gene]
+                self.profiles[sequenceprofile].extend(Profile(supplementalset, genelist))
             # Add the gene list to a dictionary
             genedict[sequenceprofile] = sorted(genelist)
-            # Add the profile data, and gene list to each sample
             for sample in self.runmetadata:
                 if sample.general.bestassemblyfile != 'NA':
                     if sequenceprofile == sample[self.analysistype].profile[0]:
-                        # Populate the metadata with the profile data
-                        sample[self.analysistype].profiledata = profiledata[sample[self.analysistype].profile[0]]
                         # Add the allele directory to a list of directories used in this analysis
                         self.allelefolders.add(sample[self.analysistype].alleledir)
                     dotter()
@@ -588,9 +498,8 @@ class MLSTmap(object):
             # Initialise self.bestmatch[genome] with an int that will eventually be replaced by the # of matches
             self.bestmatch[genome] = defaultdict(int)
             if sample[self.analysistype].profile != 'NA':
-                # Create the profiledata variable to avoid writing self.profiledata[self.analysistype]
-                # profiledata = self.profiledata[self.analysistype]
-                profiledata = sample[self.analysistype].profiledata
+                # Create the profiledata variable to avoid writing the full self.profiles lookup
+                profiledata = self.profiles[sample[self.analysistype].profile[0]]
                 # For each gene name in the list of gene names
                 for gene in sample[self.analysistype].allelenames:
                     # Clear the appropriate count and lists
@@ -633,9 +542,9 @@ class MLSTmap(object):
                     # Find the profile with the most alleles in common with the query genome
                     for sequencetype in profiledata:
                         # The number of genes in the analysis
-                        header = len(profiledata[sequencetype])
+                        header = len(profiledata.genes)
                         # refallele is the allele number of the sequence type
-                        refallele = profiledata[sequencetype][gene]
+                        refallele = profiledata.allele(sequencetype, gene)
                         # If there are multiple allele matches for a gene in the reference profile e.g. 10 692
                         if len(refallele.split(" ")) > 1:
                             # Map the split (on a space) alleles as integers - if they are treated as integers,
@@ -673,7 +582,7 @@ class MLSTmap(object):
                     # Iterate through best match
                     for sequencetype, matches in self.bestmatch[genome].iteritems():
                         if matches == sortedmatches:
-                            for gene in profiledata[sequencetype]:
+                            for gene in profiledata.genes:
                                 # Populate resultProfile with the genome, best match to profile, # of matches
                                 # to the profile, gene, query allele(s), reference allele(s), and % identity
                                 self.resultprofile[genome][sequencetype][sortedmatches][gene][
@@ -689,9 +598,9 @@ class MLSTmap(object):
                         # If the number of matches for a profile matches the best number of matches
                         if matches == sortedmatches:
                             # Iterate through the gene in the analysis
-                            for gene in profiledata[sequencetype]:
+                            for gene in profiledata.genes:
                                 # Get the reference allele as above
-                                refallele = profiledata[sequencetype][gene]
+                                refallele = profiledata.allele(sequencetype, gene)
                                 # As above get the reference allele split and ordered as necessary
                                 if len(refallele.split(" ")) > 1:
                                     intrefallele = map(int, refallele.split(" "))
@@ -763,8 +672,7 @@ class MLSTmap(object):
                             row += ',,{},{},'.format(seqtype, matches)
                         # Iterate through all the genes present in the analyses for the sample
                         for gene in sorted(sample[self.analysistype].allelenames):
-                            # refallele = self.profiledata[self.analysistype][seqtype][gene]
-                            refallele = sample[self.analysistype].profiledata[seqtype][gene]
+                            refallele = self.profiles[sample[self.analysistype].profile[0]].allele(seqtype, gene)
                             # Set the allele and percent id from the dictionary's keys and values, respectively
                             allele = self.resultprofile[sample.name][seqtype][matches][gene].keys()[0]
                             percentid = self.resultprofile[sample.name][seqtype][matches][gene].values()[0]
@@ -808,8 +716,6 @@ class MLSTmap(object):
             try:
                 delattr(sample[self.analysistype], "allelenames")
                 delattr(sample[self.analysistype], "alleles")
-                delattr(sample[self.analysistype], "profiledata")
-                delattr(sample[self.analysistype], "outtables")
                 delattr(sample[self.analysistype], "mashalleles")
                 delattr(sample[self.analysistype], "faidict")
             except KeyError:
@@ -837,9 +743,11 @@ class MLSTmap(object):
         self.reportpath = os.path.join(inputobject.path, 'reports')
         self.cpus = inputobject.cpus
         self.analysistype = analysistype
-        self.sketchqueue = Queue(maxsize=self.cpus)
-        self.mashqueue = Queue(maxsize=self.cpus)
-        self.mashparsequeue = Queue(maxsize=self.cpus)
+        self.closestqueue = Queue(maxsize=self.cpus)
+        # Dictionary of allele files: ClosestAlleles object with the k-mers of the alleles
+        self.allelesketches = dict()
+        # Dictionary of profile file: Profile object shared by all the samples typed with the scheme
+        self.profiles = dict()
         self.databasesqueue = Queue(maxsize=self.cpus)
         self.baitqueue = Queue(maxsize=self.cpus)
         self.start = inputobject.starttime
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+__author__ = 'adamkoziol'
+
+# Names of the command line arguments of the optional FastSippr stages
+OPTIONS = ['prefilter', 'maxdepth', 'collapse']
+
+
+def fastsipprarguments(parser):
+    """
+    Add the arguments of the optional FastSippr stages to the argument parser of an analysis
+    :param parser: ArgumentParser object
+    """
+    parser.add_argument('--prefilter',
+                        action='store_true',
+                        help='Use the baited reads to reduce the targets to those with plausible k-mer hits prior to '
+                             'reference mapping')
+    parser.add_argument('--maxdepth',
+                        help='Maximum depth of coverage of each target to retain prior to reference mapping. The '
+                             'baited reads are retained in a seeded random order until every target they hit is '
+                             'covered to this depth. Default is no maximum')
+    parser.add_argument('--collapse',
+                        action='store_true',
+                        help='Collapse exact duplicate baited reads into a single read prior to reference mapping. The '
+                             'number of copies of each read is restored when calculating the depth of coverage')
+
+
+def fastsipprattributes(inputobject, args):
+    """
+    Copy the arguments of the optional FastSippr stages to the object that is passed to FastSippr. Arguments that were
+    not supplied are not set, so FastSippr uses its defaults
+    :param inputobject: object to populate
+    :param args: command line arguments
+    """
+    for option in OPTIONS:
+        try:
+            value = getattr(args, option)
+        except AttributeError:
+            continue
+        if value is not None:
+            setattr(inputobject, option, value)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE
+from collections import deque
+import shutil
+import struct
+import zlib
+__author__ = 'adamkoziol'
+
+# Maximum amount of uncompressed data in a BGZF block. This ensures that the compressed block, including the header
+# and footer, is always under the 64 kB limit imposed by the 16-bit block size field
+BLOCKSIZE = 65280
+# Empty block that marks the end of a BGZF file
+EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+# Size of the chunks of data read from non-BGZF files
+CHUNKSIZE = 1048576
+
+
+def blocks(handle):
+    """
+    Split a BGZF file into its compressed blocks by reading the block size stored in the header of each block
+    :param handle: file handle opened in binary mode
+    :return: raw bytes of each block (header, compressed data, and footer)
+    """
+    while True:
+        header = handle.read(12)
+        if len(header) < 12:
+            break
+        # The extra field contains the BC subfield with the total size of the block minus one
+        extralength = struct.unpack('<H', header[10:12])[0]
+        extra = handle.read(extralength)
+        blocksize = None
+        position = 0
+        while position < extralength:
+            identifier = extra[position:position + 2]
+            fieldlength = struct.unpack('<H', extra[position + 2:position + 4])[0]
+            if identifier == b'BC':
+                blocksize = struct.unpack('<H', extra[position + 4:position + 6])[0] + 1
+            position += 4 + fieldlength
+        if blocksize is None:
+            raise IOError('Block is missing the BGZF block size field')
+        yield header + extra + handle.read(blocksize - 12 - extralength)
+
+
+def inflate(block):
+    """
+    Decompress a single BGZF block, and verify its checksum
+    :param block: raw bytes of the block
+    :return: decompressed bytes
+    """
+    extralength = struct.unpack('<H', block[10:12])[0]
+    data = zlib.decompress(block[12 + extralength:-8], -15)
+    crc, size = struct.unpack('<II', block[-8:])
+    if size != len(data) or crc != zlib.crc32(data) & 0xffffffff:
+        raise IOError('BGZF block failed the integrity check')
+    return data
+
+
+def deflate(data, level=6):
+    """
+    Compress data into a single BGZF block
+    :param data: bytes to compress - must not be longer than BLOCKSIZE
+    :param level: zlib compression level
+    :return: raw bytes of the block
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    # Header: gzip magic number, deflate, the FEXTRA flag, and the BC subfield storing the total block size minus one
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2, len(compressed) + 25)
+    return header + compressed + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def isbgzf(filename):
+    """
+    Determine whether a file is BGZF-compressed by inspecting the header of the first block
+    :param filename: name and path of the file
+    :return: boolean of whether the file is BGZF-compressed
+    """
+    with open(filename, 'rb') as handle:
+        header = handle.read(18)
+    return len(header) == 18 and header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
+
+def readchunks(filename, threads=1):
+    """
+    Read the decompressed contents of a file in chunks. BGZF files are decompressed in parallel, as every block can
+    be inflated independently. Other gzip files are decompressed with pigz if it is installed, and with zlib otherwise
+    :param filename: name and path of the (compressed) file
+    :param threads: number of threads to use for decompression
+    :return: chunks of decompressed bytes
+    """
+    if filename.endswith('.gz') and isbgzf(filename):
+        with open(filename, 'rb') as handle, ThreadPoolExecutor(max_workers=threads) as executor:
+            # Keep a limited number of blocks in flight, so that memory usage remains constant, and yield the
+            # decompressed blocks in the order in which they were read
+            pending = deque()
+            for block in blocks(handle):
+                pending.append(executor.submit(inflate, block))
+                if len(pending) >= threads * 4:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    elif filename.endswith('.gz') and shutil.which('pigz'):
+        process = Popen(['pigz', '-dc', '-p', str(threads), filename], stdout=PIPE)
+        with process.stdout:
+            for chunk in iter(lambda: process.stdout.read(CHUNKSIZE), b''):
+                yield chunk
+        process.wait()
+    elif filename.endswith('.gz'):
+        # Multi-member gzip files are decompressed by restarting the decompressor at the end of each member
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        with open(filename, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(CHUNKSIZE), b''):
+                while chunk:
+                    yield decompressor.decompress(chunk)
+                    chunk = decompressor.unused_data
+                    if chunk:
+                        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    else:
+        with open(filename, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(CHUNKSIZE), b''):
+                yield chunk
+
+
+def readlines(filename, threads=1):
+    """
+    Read the lines of a (compressed) text file
+    :param filename: name and path of the file
+    :param threads: number of threads to use for decompression
+    :return: lines of the file without trailing newline characters
+    """
+    remainder = b''
+    for chunk in readchunks(filename, threads):
+        lines = (remainder + chunk).split(b'\n')
+        # The final line may be incomplete, so keep it until the next chunk is read
+        remainder = lines.pop()
+        for line in lines:
+            yield line.decode().rstrip('\r')
+    if remainder:
+        yield remainder.decode().rstrip('\r')
+
+
+class BGZFWriter(object):
+    """
+    File-like object that writes BGZF-compressed data. Blocks are compressed in parallel, and written in order. BGZF
+    files are valid gzip files, so the output can be read by any tool that accepts gzipped input
+    """
+
+    def write(self, data):
+        """
+        Add data to the file
+        :param data: string or bytes to write
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        self.buffer += data
+        # Send full blocks to be compressed
+        while len(self.buffer) >= BLOCKSIZE:
+            self.pending.append(self.executor.submit(deflate, bytes(self.buffer[:BLOCKSIZE]), self.level))
+            del self.buffer[:BLOCKSIZE]
+            # Write the oldest blocks once enough blocks are in flight to keep all the threads busy
+            while len(self.pending) >= self.threads * 4:
+                self.handle.write(self.pending.popleft().result())
+
+    def close(self):
+        """
+        Compress any remaining data, write the end-of-file marker, and close the file
+        """
+        if self.buffer:
+            self.pending.append(self.executor.submit(deflate, bytes(self.buffer), self.level))
+            self.buffer = bytearray()
+        while self.pending:
+            self.handle.write(self.pending.popleft().result())
+        self.handle.write(EOF)
+        self.executor.shutdown()
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __init__(self, filename, threads=1, level=6):
+        """
+        :param filename: name and path of the file to create
+        :param threads: number of threads to use for compression
+        :param level: zlib compression level
+        """
+        self.handle = open(filename, 'wb')
+        self.threads = threads
+        self.level = level
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+
+
+def fastqreader(fastq, threads=1):
+    """
+    Generator that yields the records in a (gzipped) FASTQ file without loading the whole file into memory
+    :param fastq: name and path of FASTQ file to read
+    :param threads: number of threads to use for decompression
+    :return: tuples of header, sequence, and quality strings for each record
+    """
+    lines = readlines(fastq, threads)
+    for header in lines:
+        if not header:
+            continue
+        try:
+            sequence = next(lines)
+            # Skip the '+' separator line
+            next(lines)
+            quality = next(lines)
+        # A StopIteration raised inside a generator is converted into a RuntimeError (PEP 479), so report the
+        # truncated record explicitly
+        except StopIteration:
+            raise ValueError('Truncated record {} at the end of FASTQ file {}'.format(header, fastq))
+        yield header, sequence, quality
+
+
+def fastqchunks(fastq, size=10000, threads=1):
+    """
+    Group the records of a FASTQ file into lists, which allows the sequences to be processed in batches
+    :param fastq: name and path of FASTQ file to read
+    :param size: maximum number of records to include in each list
+    :param threads: number of threads to use for decompression
+    :return: lists of header, sequence, and quality tuples
+    """
+    chunk = list()
+    for record in fastqreader(fastq, threads):
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+def fastqwriter(records, fastq, threads=1):
+    """
+    Write records to a FASTQ file. Files with a .gz extension are BGZF-compressed in parallel
+    :param records: iterable of header, sequence, and quality tuples
+    :param fastq: name and path of FASTQ file to create
+    :param threads: number of threads to use for compression
+    """
+    handle = BGZFWriter(fastq, threads) if fastq.endswith('.gz') else open(fastq, 'w')
+    with handle:
+        for header, sequence, quality in records:
+            handle.write('{}\n{}\n+\n{}\n'.format(header, sequence, quality))
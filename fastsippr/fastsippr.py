@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+from accessoryFunctions.accessoryFunctions import printtime
+from sipprCommon.sippingmethods import Sippr
+from fastsippr.fastqio import fastqchunks, fastqreader, fastqwriter
+from fastsippr.kmers import contained, kmerhashes
+from sipprutilities.fileio import atomicfile
+from threading import Thread
+from queue import Queue
+from Bio import SeqIO
+import numpy
+import pysam
+import os
+__author__ = 'adamkoziol'
+
+# Seed of the random number generator used to choose the reads retained by downsampling, so that reruns of an analysis
+# retain the same reads
+SEED = 1
+
+
+class FastSippr(Sippr):
+
+    def main(self):
+        """
+        Run the methods in the correct order for pipelines
+        """
+        # Find the target files
+        self.targets()
+        # Use bbduk to bait the FASTQ reads matching the target sequences
+        self.bait()
+        # Reduce the targets to those with plausible hits in the baited reads. The prefilter and reverse baiting both
+        # create a per-sample subset of the targets, so only one of the two is run
+        if self.prefilter:
+            self.prefiltering()
+        elif self.revbait:
+            self.reversebait()
+        # If desired, cap the depth of coverage of each target by subsampling the baited reads
+        if self.maxdepth:
+            self.downsampling()
+        # If desired, collapse exact duplicate reads into a single read prior to mapping
+        if self.collapse:
+            self.collapsing()
+        # Run the bowtie2 read mapping module
+        self.mapping()
+        # Use samtools to index the sorted bam file
+        self.indexing()
+        # Parse the results
+        self.parsing()
+        # Clear out the large attributes that will difficult to handle objects
+        self.clear()
+        # Filter out any sequences with cigar features such as internal soft-clipping from the results
+        self.clipper()
+
+    def prefiltering(self):
+        """
+        Count the k-mer hits of the baited reads against each target, and create a reduced target file containing only
+        the targets with plausible hits. This file is used in place of the full target file for all the mapping steps,
+        so the cost of indexing and mapping depends on the number of hits rather than on the size of the database
+        """
+        printtime('Prefiltering {} targets with baited reads'.format(self.analysistype), self.start,
+                  output=self.portallog)
+        for i in range(len(self.runmetadata)):
+            # Send the threads to the k-mer filtering method
+            threads = Thread(target=self.kmerfilter, args=())
+            # Set the daemon to true - something to do with thread management
+            threads.setDaemon(True)
+            # Start the threading
+            threads.start()
+        for sample in self.runmetadata:
+            if sample.general.bestassemblyfile != 'NA' and sample[self.analysistype].runanalysis:
+                # Set the name of the reduced target file. Note that the .fasta extension is required, as it is
+                # stripped off to create the name of the bowtie2 index
+                sample[self.analysistype].prefilteredtargets = \
+                    os.path.join(sample[self.analysistype].outputdir,
+                                 '{}_prefilteredtargets.fasta'.format(self.analysistype))
+                self.prefilterqueue.put(sample)
+        self.prefilterqueue.join()
+
+    def kmerfilter(self):
+        while True:
+            sample = self.prefilterqueue.get()
+            # Only create the reduced target file if it doesn't already exist
+            if not os.path.isfile(sample[self.analysistype].prefilteredtargets):
+                # Find all the k-mers present in the baited reads
+                readkmers = self.readkmers(sample[self.analysistype].baitedfastq)
+                # Create a list to store the targets that pass the filter
+                passing = list()
+                batch = list()
+                length = 0
+                # Process the targets in batches to keep memory usage constant for large databases
+                for record in SeqIO.parse(sample[self.analysistype].baitfile, 'fasta'):
+                    batch.append(record)
+                    length += len(record.seq)
+                    if length >= 5000000:
+                        passing.extend(self.targetfilter(batch, readkmers))
+                        batch = list()
+                        length = 0
+                if batch:
+                    passing.extend(self.targetfilter(batch, readkmers))
+                # Write the passing targets to the reduced target file
+                with open(sample[self.analysistype].prefilteredtargets, 'w') as prefiltered:
+                    SeqIO.write(passing, prefiltered, 'fasta')
+            # If none of the targets have any plausible hits, there is no need to perform the mapping
+            if not os.path.getsize(sample[self.analysistype].prefilteredtargets):
+                sample[self.analysistype].runanalysis = False
+            # Set the baitfile to use in the mapping steps as the reduced target file
+            sample[self.analysistype].baitfile = sample[self.analysistype].prefilteredtargets
+            self.prefilterqueue.task_done()
+
+    def readkmers(self, fastq):
+        """
+        Create a sorted array of all the unique k-mer hashes in a FASTQ file
+        :param fastq: name and path of the FASTQ file
+        :return: sorted array of unique k-mer hashes
+        """
+        kmers = [numpy.zeros(0, dtype=numpy.uint64)]
+        for chunk in fastqchunks(fastq, threads=self.threads):
+            hashes, _, _ = kmerhashes([sequence for _, sequence, _ in chunk], self.prefilterkmer)
+            kmers.append(numpy.unique(hashes))
+        return numpy.unique(numpy.concatenate(kmers))
+
+    def targetfilter(self, records, readkmers):
+        """
+        Determine the fraction of bases in each target that are covered by k-mers present in the baited reads. This is
+        the same criterion used by bbduk (mincovfraction) in the reverse baiting
+        :param records: list of SeqIO records of the targets
+        :param readkmers: sorted array of unique k-mer hashes in the baited reads
+        :return: list of SeqIO records of the targets with sufficient coverage
+        """
+        # Targets shorter than the k-mer length cannot have any hits
+        records = [record for record in records if len(record.seq) >= self.prefilterkmer]
+        if not records:
+            return list()
+        hashes, owners, positions = kmerhashes([str(record.seq) for record in records], self.prefilterkmer)
+        # Find the target k-mers that are also present in the baited reads
+        hits = contained(hashes, readkmers)
+        lengths = numpy.array([len(record.seq) for record in records], dtype=numpy.int64)
+        offsets = numpy.zeros(len(records) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum(lengths)
+        # Mark the bases covered by each of the hits with a difference array: +1 at the start of each hit, and -1
+        # following its final base. The cumulative sum is positive for every covered base
+        starts = offsets[owners[hits]] + positions[hits]
+        difference = numpy.bincount(starts, minlength=offsets[-1] + self.prefilterkmer) \
+            - numpy.bincount(starts + self.prefilterkmer, minlength=offsets[-1] + self.prefilterkmer)
+        covered = (numpy.cumsum(difference)[:offsets[-1]] > 0).astype(numpy.int64)
+        # Calculate the fraction of each target that is covered
+        coverage = numpy.add.reduceat(covered, offsets[:-1]) / lengths
+        return [record for record, fraction in zip(records, coverage) if fraction >= self.prefiltercutoff]
+
+    def downsampling(self):
+        """
+        Cap the depth of coverage of each target at self.maxdepth. Every baited read is counted towards each of the
+        targets with which it shares k-mers, and reads are retained in a random order until each target is covered to
+        the maximum depth. As reads shared by paralogous or overlapping targets count towards all these targets, the
+        depth of every target remains at least self.maxdepth (or the original depth, if lower). As the calls only
+        require ~20-50X coverage, this bounds the mapping and parsing time of very deep samples
+        """
+        printtime('Capping {} targets at {}X depth of coverage'.format(self.analysistype, self.maxdepth), self.start,
+                  output=self.portallog)
+        for i in range(len(self.runmetadata)):
+            # Send the threads to the downsampling method
+            threads = Thread(target=self.downsample, args=())
+            # Set the daemon to true - something to do with thread management
+            threads.setDaemon(True)
+            # Start the threading
+            threads.start()
+        for sample in self.runmetadata:
+            if sample.general.bestassemblyfile != 'NA' and sample[self.analysistype].runanalysis:
+                # Create the name of the downsampled read file
+                sample[self.analysistype].downsampledreads = \
+                    os.path.join(sample[self.analysistype].outputdir,
+                                 '{}_targetMatches_downsampled.fastq.gz'.format(self.analysistype))
+                self.downsamplequeue.put(sample)
+        self.downsamplequeue.join()
+
+    def downsample(self):
+        while True:
+            sample = self.downsamplequeue.get()
+            # Only downsample the reads if the downsampled file doesn't already exist
+            if not os.path.isfile(sample[self.analysistype].downsampledreads):
+                # Load the targets, and create an index of the k-mers in each target. Each k-mer is stored once for
+                # every target in which it is found, so that reads hitting multiple targets are counted for each
+                records = [record for record in SeqIO.parse(sample[self.analysistype].baitfile, 'fasta')]
+                hashes, owners, _ = kmerhashes([str(record.seq) for record in records], self.prefilterkmer)
+                pairs = numpy.unique(numpy.rec.fromarrays([hashes, owners], names='kmer,target'))
+                targetlengths = numpy.array([len(record.seq) for record in records], dtype=numpy.int64)
+                # Find the targets hit by every read
+                reads = [numpy.zeros(0, dtype=numpy.int64)]
+                targets = [numpy.zeros(0, dtype=numpy.int64)]
+                kmers = [numpy.zeros(0, dtype=numpy.int64)]
+                readcount = 0
+                for chunk in fastqchunks(sample[self.analysistype].baitedfastq, threads=self.threads):
+                    chunkreads, chunktargets, chunkkmers = self.hits(chunk, pairs['kmer'], pairs['target'],
+                                                                     len(records))
+                    reads.append(chunkreads + readcount)
+                    targets.append(chunktargets)
+                    kmers.append(chunkkmers)
+                    readcount += len(chunk)
+                retained = self.select(numpy.concatenate(reads), numpy.concatenate(targets),
+                                       numpy.concatenate(kmers), targetlengths, readcount)
+                # Write the retained reads to file in their original order
+                fastqwriter((read for index, read in enumerate(fastqreader(sample[self.analysistype].baitedfastq,
+                                                                           self.threads))
+                             if retained[index]),
+                            sample[self.analysistype].downsampledreads, self.threads)
+            # Update the variable to store the baited reads
+            sample[self.analysistype].baitedfastq = sample[self.analysistype].downsampledreads
+            self.downsamplequeue.task_done()
+
+    def collapsing(self):
+        """
+        Collapse exact duplicate baited reads into a single copy of each sequence. The number of copies is appended to
+        the name of the read, and the copies are restored in the sorted bam files before they are parsed, so the depth
+        of coverage is unchanged. As bowtie2 -a aligns every read separately, this reduces the mapping time of deep
+        samples
+        """
+        printtime('Collapsing duplicate {} reads'.format(self.analysistype), self.start, output=self.portallog)
+        for i in range(len(self.runmetadata)):
+            # Send the threads to the collapsing method
+            threads = Thread(target=self.collapse_reads, args=())
+            # Set the daemon to true - something to do with thread management
+            threads.setDaemon(True)
+            # Start the threading
+            threads.start()
+        for sample in self.runmetadata:
+            if sample.general.bestassemblyfile != 'NA' and sample[self.analysistype].runanalysis:
+                # Create the name of the collapsed read file
+                sample[self.analysistype].collapsedreads = \
+                    os.path.join(sample[self.analysistype].outputdir,
+                                 '{}_targetMatches_collapsed.fastq.gz'.format(self.analysistype))
+                self.collapsequeue.put(sample)
+        self.collapsequeue.join()
+
+    def collapse_reads(self):
+        while True:
+            sample = self.collapsequeue.get()
+            # Only collapse the reads if the collapsed file doesn't already exist
+            if not os.path.isfile(sample[self.analysistype].collapsedreads):
+                # Store the name and quality of the first copy of each sequence, as well as the number of copies
+                reads = dict()
+                for header, sequence, quality in fastqreader(sample[self.analysistype].baitedfastq, self.threads):
+                    try:
+                        reads[sequence][2] += 1
+                    except KeyError:
+                        # bowtie2 truncates read names at the first whitespace, so only the first field is kept
+                        reads[sequence] = [header[1:].split()[0], quality, 1]
+                # Write a single copy of each sequence, with the number of copies appended to the read name
+                fastqwriter((('@{};size={}'.format(name, count), sequence, quality)
+                             for sequence, (name, quality, count) in reads.items()),
+                            sample[self.analysistype].collapsedreads, self.threads)
+            # Update the variable to store the baited reads
+            sample[self.analysistype].baitedfastq = sample[self.analysistype].collapsedreads
+            self.collapsequeue.task_done()
+
+    def hits(self, chunk, targethashes, targetowners, targetcount):
+        """
+        Find every target with which each read shares k-mers
+        :param chunk: list of header, sequence, quality tuples of reads
+        :param targethashes: sorted array of the k-mer hashes in the targets. K-mers present in multiple targets are
+        repeated once for each target
+        :param targetowners: array of the index of the target from which each of the target k-mers was extracted
+        :param targetcount: total number of targets
+        :return: array of the index of the read, array of the index of the target, and array of the number of k-mers
+        shared by each read/target pair
+        """
+        hashes, owners, _ = kmerhashes([sequence for _, sequence, _ in chunk], self.prefilterkmer)
+        # Find the range of target k-mers matching each of the read k-mers
+        left = numpy.searchsorted(targethashes, hashes, side='left')
+        matches = numpy.searchsorted(targethashes, hashes, side='right') - left
+        total = int(matches.sum())
+        if not total:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), \
+                numpy.zeros(0, dtype=numpy.int64)
+        # Expand the ranges, so that there is one entry for every read k-mer/target k-mer match
+        offsets = numpy.arange(total) - numpy.repeat(numpy.cumsum(matches) - matches, matches)
+        targets = targetowners[numpy.repeat(left, matches) + offsets].astype(numpy.int64)
+        reads = numpy.repeat(owners, matches).astype(numpy.int64)
+        # Count the hits for every read/target pair
+        pairs, counts = numpy.unique(reads * targetcount + targets, return_counts=True)
+        return pairs // targetcount, pairs % targetcount, counts
+
+    def select(self, reads, targets, kmers, targetlengths, readcount):
+        """
+        Choose the reads to retain. The reads hitting each target are visited in a seeded random order, and are
+        retained until the bases of the target that they cover (estimated from the number of shared k-mers) reach
+        self.maxdepth times the length of the target. A read that is retained for any target is retained for all of
+        them, and reads without any hits are always retained
+        :param reads: array of the index of the read of each read/target pair
+        :param targets: array of the index of the target of each read/target pair
+        :param kmers: array of the number of k-mers shared by each read/target pair
+        :param targetlengths: array of the length of each target
+        :param readcount: total number of reads
+        :return: boolean array of whether each read is retained
+        """
+        retained = numpy.ones(readcount, dtype=bool)
+        if not len(reads):
+            return retained
+        retained[reads] = False
+        # Shuffle the pairs with a seeded generator, and then group the pairs by target. The stable sort keeps the
+        # shuffled order of the pairs of each target
+        order = numpy.random.RandomState(SEED).permutation(len(reads))
+        order = order[numpy.argsort(targets[order], kind='mergesort')]
+        reads = reads[order]
+        targets = targets[order]
+        # Each run of n shared k-mers covers n + k - 1 bases of the target
+        bases = kmers[order] + self.prefilterkmer - 1
+        # Calculate the number of bases covered by the reads of each target preceding every read
+        covered = numpy.cumsum(bases) - bases
+        covered -= covered[numpy.searchsorted(targets, targets, side='left')]
+        # Retain the reads visited before the target was covered to the maximum depth
+        retained[reads[covered < self.maxdepth * targetlengths[targets]]] = True
+        return retained
+
+    def indexing(self):
+        """
+        Index the sorted bam files. If the reads were collapsed, the duplicate reads are first restored, so that the
+        sorted bam files are parsed by Sippr.reduce exactly as they would have been without collapsing
+        """
+        if self.collapse:
+            self.expanding()
+        Sippr.indexing(self)
+
+    def expanding(self):
+        """
+        Write each alignment of a collapsed read once for every copy of the read into a new sorted bam file
+        """
+        printtime('Restoring collapsed {} reads'.format(self.analysistype), self.start, output=self.portallog)
+        for i in range(len(self.runmetadata)):
+            # Send the threads to the expanding method
+            threads = Thread(target=self.expand, args=())
+            # Set the daemon to true - something to do with thread management
+            threads.setDaemon(True)
+            # Start the threading
+            threads.start()
+        for sample in self.runmetadata:
+            if sample.general.bestassemblyfile != 'NA' and sample[self.analysistype].runanalysis:
+                # Create the name of the expanded sorted bam file
+                sample[self.analysistype].expandedbam = \
+                    os.path.join(sample[self.analysistype].outputdir,
+                                 '{}_expanded_sorted.bam'.format(self.analysistype))
+                self.expandqueue.put(sample)
+        self.expandqueue.join()
+
+    def expand(self):
+        while True:
+            sample = self.expandqueue.get()
+            # Only expand the alignments if the expanded file doesn't already exist, and the mapping was successful
+            if not os.path.isfile(sample[self.analysistype].expandedbam) \
+                    and os.path.isfile(sample[self.analysistype].sortedbam):
+                # Write to a temporary file, so that an interrupted run does not leave behind an incomplete bam file.
+                # The copies of an alignment are written consecutively, so the file remains sorted
+                with atomicfile(sample[self.analysistype].expandedbam) as temporaryfile:
+                    with pysam.AlignmentFile(sample[self.analysistype].sortedbam, 'rb') as collapsed:
+                        with pysam.AlignmentFile(temporaryfile, 'wb', template=collapsed) as expanded:
+                            for record in collapsed.fetch(until_eof=True):
+                                for _ in range(self.copies(record.query_name)):
+                                    expanded.write(record)
+            # Use the expanded sorted bam file in the indexing and parsing steps
+            if os.path.isfile(sample[self.analysistype].expandedbam):
+                sample[self.analysistype].sortedbam = sample[self.analysistype].expandedbam
+            self.expandqueue.task_done()
+
+    @staticmethod
+    def copies(readname):
+        """
+        Determine the number of copies represented by a (collapsed) read
+        :param readname: name of the read
+        :return: integer of the number of copies. Reads without a size field are a single copy
+        """
+        try:
+            return int(readname.rsplit(';size=', 1)[1])
+        except (IndexError, ValueError):
+            return 1
+
+    def __init__(self, inputobject, cutoff=0.98, averagedepth=10):
+        # Determine whether the targets should be prefiltered with the baited reads
+        try:
+            self.prefilter = inputobject.prefilter
+        except AttributeError:
+            self.prefilter = False
+        # Minimum fraction of a target that must be covered by k-mers from the baited reads to pass the prefilter.
+        # Default to the same value used by the reverse baiting
+        try:
+            self.prefiltercutoff = float(inputobject.prefiltercutoff)
+        except AttributeError:
+            self.prefiltercutoff = cutoff
+        # Use the same k-mer length as the baiting
+        self.prefilterkmer = 27
+        # Maximum depth of coverage of each target to retain prior to mapping. Disabled (0) by default
+        try:
+            self.maxdepth = int(inputobject.maxdepth)
+        except (AttributeError, TypeError):
+            self.maxdepth = 0
+        # Determine whether exact duplicate reads should be collapsed prior to mapping
+        try:
+            self.collapse = inputobject.collapse
+        except AttributeError:
+            self.collapse = False
+        self.prefilterqueue = Queue(maxsize=inputobject.cpus)
+        self.downsamplequeue = Queue(maxsize=inputobject.cpus)
+        self.collapsequeue = Queue(maxsize=inputobject.cpus)
+        self.expandqueue = Queue(maxsize=inputobject.cpus)
+        Sippr.__init__(self, inputobject, cutoff, averagedepth)
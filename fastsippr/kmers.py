@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+import numpy
+__author__ = 'adamkoziol'
+
+# Lookup table to convert ASCII nucleotides into two-bit codes (A: 0, C: 1, G: 2, T: 3). Every other character
+# (ambiguous bases, gaps, separators) is set to 4, and will invalidate any k-mer in which it is found
+CODES = numpy.full(256, 4, dtype=numpy.uint8)
+for index, bases in enumerate(['Aa', 'Cc', 'Gg', 'Tt']):
+    for base in bases:
+        CODES[ord(base)] = index
+
+
+def encode(sequences):
+    """
+    Convert a list of sequences into a single array of two-bit nucleotide codes. An invalid character is placed between
+    consecutive sequences, so that no k-mer can span two sequences
+    :param sequences: list of nucleotide sequences (as strings)
+    :return: array of nucleotide codes, array of the offset of each sequence in the array of codes
+    """
+    # Join the sequences with a character that does not correspond to a nucleotide
+    joined = 'N'.join(sequences).encode('ascii')
+    codes = CODES[numpy.frombuffer(joined, dtype=numpy.uint8)]
+    # Calculate the starting position of each sequence in the joined string - the separator adds one to each length
+    lengths = numpy.array([len(sequence) + 1 for sequence in sequences], dtype=numpy.int64)
+    offsets = numpy.zeros(len(sequences), dtype=numpy.int64)
+    if len(sequences) > 1:
+        offsets[1:] = numpy.cumsum(lengths)[:-1]
+    return codes, offsets
+
+
+def fmix(values, seed=42):
+    """
+    Scramble 64-bit integers with the finalisation mix of MurmurHash3. This function is a bijection, so distinct
+    k-mers will never collide, but the output is uniformly distributed, which is required for MinHash-style sampling
+    :param values: array of unsigned 64-bit integers
+    :param seed: integer combined with the values prior to mixing - stops poly-A k-mers from hashing to zero
+    :return: array of hashed unsigned 64-bit integers
+    """
+    hashes = values.astype(numpy.uint64) ^ numpy.uint64(seed)
+    hashes ^= hashes >> numpy.uint64(33)
+    hashes *= numpy.uint64(0xff51afd7ed558ccd)
+    hashes ^= hashes >> numpy.uint64(33)
+    hashes *= numpy.uint64(0xc4ceb9fe1a85ec53)
+    hashes ^= hashes >> numpy.uint64(33)
+    return hashes
+
+
+def canonical(codes, k):
+    """
+    Calculate the canonical (the smaller of the forward and reverse complement) two-bit representation of every k-mer
+    in the array of nucleotide codes
+    :param codes: array of nucleotide codes created by encode()
+    :param k: length of k-mers to use. Must be between 1 and 32, so that each k-mer fits in a 64-bit integer
+    :return: array of canonical k-mers, array of the starting position of each of the k-mers in the array of codes
+    """
+    assert 0 < k <= 32, 'k-mer length must be between 1 and 32, not {}'.format(k)
+    # Number of possible k-mers in the array
+    total = len(codes) - k + 1
+    if total <= 0:
+        return numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=numpy.int64)
+    # Determine which windows contain an invalid character using a cumulative sum of the invalid positions
+    invalid = numpy.zeros(len(codes) + 1, dtype=numpy.int64)
+    invalid[1:] = numpy.cumsum(codes > 3)
+    valid = (invalid[k:] - invalid[:total]) == 0
+    # Mask the invalid codes to stop them from bleeding into neighbouring bits
+    bases = (codes & 3).astype(numpy.uint64)
+    forward = numpy.zeros(total, dtype=numpy.uint64)
+    reverse = numpy.zeros(total, dtype=numpy.uint64)
+    # Build the forward k-mers by shifting in one base at a time, and the reverse complement k-mers by adding the
+    # complement of each base to the increasingly significant end of the integer
+    for position in range(k):
+        window = bases[position:position + total]
+        forward <<= numpy.uint64(2)
+        forward |= window
+        reverse |= (numpy.uint64(3) - window) << numpy.uint64(2 * position)
+    starts = numpy.flatnonzero(valid)
+    return numpy.minimum(forward[starts], reverse[starts]), starts
+
+
+def kmerhashes(sequences, k):
+    """
+    Hash all the canonical k-mers in a list of sequences
+    :param sequences: list of nucleotide sequences (as strings)
+    :param k: length of k-mers to use
+    :return: array of k-mer hashes, array of the index of the sequence from which each k-mer was extracted, array of
+    the position of each k-mer in its sequence
+    """
+    codes, offsets = encode(sequences)
+    kmers, starts = canonical(codes, k)
+    # Use the offsets of the sequences to find the sequence of origin, and the position within that sequence
+    owners = numpy.searchsorted(offsets, starts, side='right') - 1
+    return fmix(kmers), owners, starts - offsets[owners]
+
+
+def contained(hashes, reference):
+    """
+    Determine which hashes are present in a sorted array of reference hashes with a binary search
+    :param hashes: array of k-mer hashes to check
+    :param reference: sorted array of unique k-mer hashes
+    :return: boolean array of whether each of the hashes is present in the reference
+    """
+    if not len(reference):
+        return numpy.zeros(len(hashes), dtype=bool)
+    # Clip the insertion points to the bounds of the array, as hashes larger than any reference hash are placed past
+    # the end of the array
+    indices = numpy.minimum(numpy.searchsorted(reference, hashes), len(reference) - 1)
+    return reference[indices] == hashes
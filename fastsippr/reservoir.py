@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+__author__ = 'adamkoziol'
+
+
+class Reservoir(object):
+    """
+    Uniform random sample of a fixed number of items from a stream of unknown length (Algorithm R). Only the sampled
+    items are kept in memory, so arbitrarily large files can be sampled in a single pass
+    """
+
+    def add(self, item):
+        """
+        Offer an item from the stream to the reservoir
+        :param item: item to (potentially) add to the sample
+        """
+        self.seen += 1
+        # Fill the reservoir with the first items
+        if len(self.items) < self.size:
+            self.items.append(item)
+        else:
+            # Each subsequent item replaces a random item in the reservoir with a probability of size / seen
+            index = self.random.randrange(self.seen)
+            if index < self.size:
+                self.items[index] = item
+
+    def __init__(self, size, random):
+        """
+        :param size: maximum number of items to retain
+        :param random: random.Random object used to select items - seed this object for reproducible samples
+        """
+        self.size = size
+        self.random = random
+        self.seen = 0
+        self.items = list()
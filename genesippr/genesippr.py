@@ -2,7 +2,8 @@
 from accessoryFunctions.accessoryFunctions import printtime, MetadataObject
 from accessoryFunctions.metadataprinter import MetadataPrinter
 from sipprCommon.objectprep import Objectprep
-from sipprCommon.sippingmethods import Sippr
+from fastsippr.fastsippr import FastSippr
+from fastsippr.arguments import fastsipprarguments, fastsipprattributes
 from reporter.reports import Reports
 from argparse import ArgumentParser
 import multiprocessing
@@ -30,7 +31,7 @@ class GeneSippr(object):
                 objects.objectprep()
                 self.runmetadata = objects.samples
         # Run the analyses
-        Sippr(self, self.cutoff)
+        FastSippr(self, self.cutoff)
         # Create the reports
         reports = Reports(self)
         Reports.reporter(reports, analysistype=self.analysistype)
@@ -101,6 +102,8 @@ class GeneSippr(object):
             self.averagedepth = int(args.averagedepth)
         except AttributeError:
             self.averagedepth = 10
+        # Pass any arguments of the optional FastSippr stages on to the analyses
+        fastsipprattributes(self, args)
         try:
             self.copy = args.copy
         except AttributeError:
@@ -181,6 +184,7 @@ if __name__ == '__main__':
     parser.add_argument('-a', '--averagedepth',
                         default=10,
                         help='Supply an integer of the minimum mapping depth in order to return a positive result ')
+    fastsipprarguments(parser)
     parser.add_argument('-C', '--copy',
                         action='store_true',
                         help='Normally, the program will create symbolic links of the files into the sequence path, '
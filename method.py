@@ -1,5 +1,6 @@
 #!/usr/bin/python3
-from sipprCommon.sippingmethods import Sippr
+from fastsippr.fastsippr import FastSippr
+from fastsippr.arguments import fastsipprarguments, fastsipprattributes
 from sipprCommon.objectprep import Objectprep
 from accessoryFunctions.accessoryFunctions import MetadataObject, make_path, printtime
 from accessoryFunctions.metadataprinter import MetadataPrinter
@@ -168,7 +169,7 @@ class Method(object):
         self.cutoff = 0.9
         self.analysistype = 'genesippr'
         self.targetpath = os.path.join(self.reffilepath, self.analysistype, '')
-        Sippr(self, self.cutoff, 5)
+        FastSippr(self, self.cutoff, 5)
         # Update the reports object
         self.reports = Reports(self)
         # Create the reports
@@ -187,7 +188,7 @@ class Method(object):
         # Run the GDCS analysis
         self.analysistype = 'GDCS'
         self.pipeline = True
-        Sippr(self, 0.95)
+        FastSippr(self, 0.95)
         # Create the reports
         Reports.gdcsreporter(self.reports)
         self.pipeline = False
@@ -326,6 +327,8 @@ class Method(object):
             self.debug = args.debug
         except AttributeError:
             self.debug = False
+        # Pass any arguments of the optional FastSippr stages on to the analyses
+        fastsipprattributes(self, args)
         self.pipeline = False
         self.forward = str()
         self.reverse = str()
@@ -394,6 +397,7 @@ if __name__ == '__main__':
                         action='store_true',
                         help='Normally, the program will create symbolic links of the files into the sequence path, '
                              'however, the are occasions when it is necessary to copy the files instead')
+    fastsipprarguments(parser)
     # Get the arguments into an object
     arguments = parser.parse_args()
     arguments.portallog = os.path.join(arguments.path, 'portal.log')
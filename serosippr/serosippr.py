@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 import operator
 import subprocess
-from sipprCommon.sippingmethods import Sippr
+from fastsippr.fastsippr import FastSippr
+from fastsippr.arguments import fastsipprarguments, fastsipprattributes
 from sipprCommon.objectprep import Objectprep
 from accessoryFunctions.accessoryFunctions import printtime, MetadataObject, make_path
 from accessoryFunctions.metadataprinter import MetadataPrinter
@@ -18,7 +19,7 @@ class SeroSippr(object):
         """
         printtime('Starting {} analysis pipeline'.format(self.analysistype), self.starttime)
         # Run the analyses
-        Sippr(self, self.cutoff)
+        FastSippr(self, self.cutoff)
         printer = MetadataPrinter(self)
         printer.printmetadata()
         self.serotype_escherichia()
@@ -172,6 +173,8 @@ class SeroSippr(object):
             self.averagedepth = int(args.averagedepth)
         except AttributeError:
             self.averagedepth = 10
+        # Pass any arguments of the optional FastSippr stages on to the analyses
+        fastsipprattributes(self, args)
         try:
             self.copy = args.copy
         except AttributeError:
@@ -258,6 +261,7 @@ if __name__ == '__main__':
     parser.add_argument('-u', '--cutoff',
                         default=0.8,
                         help='Custom cutoff values')
+    fastsipprarguments(parser)
     # Get the arguments into an object
     arguments = parser.parse_args()
     arguments.pipeline = False
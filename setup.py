@@ -16,6 +16,7 @@ setup(
     install_requires=['OLCTools',
                       'sipprverse',
                       'biopython==1.70',
-                      'pysam==0.13'
+                      'pysam==0.13',
+                      'numpy==1.14.1'
                       ]
 )
@@ -4,7 +4,8 @@ from accessoryFunctions.metadataprinter import MetadataPrinter
 from spadespipeline.typingclasses import Resistance
 from sixteenS.sixteens_full import SixteenS as SixteensFull
 from sipprCommon.objectprep import Objectprep
-from sipprCommon.sippingmethods import Sippr
+from fastsippr.fastsippr import FastSippr
+from fastsippr.arguments import fastsipprarguments, fastsipprattributes
 from serosippr.serosippr import SeroSippr
 from reporter.reports import Reports
 from argparse import ArgumentParser
@@ -32,7 +33,7 @@ class Sipprverse(object):
         # Run the genesippr analyses
         self.analysistype = 'genesippr'
         self.targetpath = os.path.join(self.reffilepath, self.analysistype, '')
-        Sippr(self, 0.90)
+        FastSippr(self, 0.90)
         # Create the reports
         self.reports = Reports(self)
         Reports.reporter(self.reports)
@@ -47,7 +48,7 @@ class Sipprverse(object):
         self.analysistype = 'GDCS'
         self.pipeline = True
         self.targetpath = os.path.join(self.targetpath, self.analysistype)
-        Sippr(self, 0.95)
+        FastSippr(self, 0.95)
         # Create the reports
         Reports.gdcsreporter(self.reports)
         # Perform serotyping for samples classified as Escherichia
@@ -111,6 +112,8 @@ class Sipprverse(object):
         self.taxonomy = {'Escherichia': 'coli', 'Listeria': 'monocytogenes', 'Salmonella': 'enterica'}
         self.analysistype = 'GeneSippr'
         self.copy = args.copy
+        # Pass any arguments of the optional FastSippr stages on to the analyses
+        fastsipprattributes(self, args)
         self.pipeline = False
         self.forward = str()
         self.reverse = str()
@@ -185,6 +188,7 @@ if __name__ == '__main__':
     parser.add_argument('-u', '--customcutoffs',
                         default=0.90,
                         help='Custom cutoff values')
+    fastsipprarguments(parser)
     parser.add_argument('-C', '--copy',
                         action='store_true',
                         help='Normally, the program will create symbolic links of the files into the sequence path, '
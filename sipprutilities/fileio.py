@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+from contextlib import contextmanager
+import hashlib
+import os
+__author__ = 'adamkoziol'
+
+
+def checksum(filename):
+    """
+    Calculate the checksum of a file in chunks, so that large files are never read into memory
+    :param filename: name and path of the file
+    :return: MD5 hex digest of the contents of the file
+    """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(1048576), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def temporaryname(filename):
+    """
+    :param filename: name and path of the file to create
+    :return: name and path of the temporary file to write in place of the file. The process ID is included, so that
+    concurrent analyses never write to the same temporary file
+    """
+    return '{}.{}.tmp'.format(filename, os.getpid())
+
+
+@contextmanager
+def atomicfile(filename):
+    """
+    Provide a temporary file to write in place of a file. If the block completes, the temporary file replaces the file,
+    otherwise it is removed, so that an interrupted analysis never leaves behind an incomplete file that would be
+    reused, and concurrent analyses never read a partially written file
+    :param filename: name and path of the file to create
+    :return: name and path of the temporary file
+    """
+    temporary = temporaryname(filename)
+    # Remove any temporary file left behind by an earlier process with the same ID
+    if os.path.isfile(temporary):
+        os.remove(temporary)
+    try:
+        yield temporary
+    except BaseException:
+        if os.path.isfile(temporary):
+            os.remove(temporary)
+        raise
+    os.replace(temporary, filename)
+
+
+def atomicwrite(filename, writer, mode='w'):
+    """
+    Write a file atomically with atomicfile
+    :param filename: name and path of the file to create
+    :param writer: function that writes the contents of the file to the supplied handle
+    :param mode: mode with which to open the temporary file
+    """
+    with atomicfile(filename) as temporary:
+        with open(temporary, mode) as handle:
+            writer(handle)
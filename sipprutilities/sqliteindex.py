@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+from sipprutilities.fileio import atomicfile, checksum
+import sqlite3
+import os
+__author__ = 'adamkoziol'
+
+
+class SQLiteIndex(object):
+    """
+    Looks up the records of a source file using an SQLite index of the file. The index is stored next to the source
+    file, is only rebuilt when the source file changes, and is memory-mapped, so that lookups do not require the source
+    file to be parsed on every run. Subclasses supply the columns of the index and the parser that extracts the rows
+    from the source file
+    """
+
+    def current(self):
+        """
+        Determine whether the index corresponds to the source file: the modification time and size are checked first,
+        and if they differ, the checksum of the source file is compared to the checksum stored in the index
+        :return: boolean of whether the index can be used
+        """
+        if not os.path.isfile(self.indexfile):
+            return False
+        try:
+            connection = sqlite3.connect(self.indexfile)
+            try:
+                metadata = dict(connection.execute('SELECT key, value FROM metadata'))
+                # Indexes created with different columns must be rebuilt
+                if metadata['schema'] != self.schema:
+                    return False
+                stats = os.stat(self.sourcefile)
+                if metadata['mtime'] == repr(stats.st_mtime) and metadata['size'] == str(stats.st_size):
+                    return True
+                if metadata['checksum'] != checksum(self.sourcefile):
+                    return False
+                # The file was touched, but not changed. Update the index with the new modification time
+                try:
+                    with connection:
+                        connection.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)',
+                                               [('mtime', repr(stats.st_mtime)), ('size', str(stats.st_size))])
+                except sqlite3.Error:
+                    pass
+                return True
+            finally:
+                connection.close()
+        except (sqlite3.Error, IOError, OSError, KeyError):
+            return False
+
+    def build(self, database):
+        """
+        Populate an index with the rows parsed from the source file
+        :param database: name and path of the SQLite database to populate
+        :return: connection to the populated database
+        """
+        stats = os.stat(self.sourcefile)
+        connection = sqlite3.connect(database)
+        with connection:
+            connection.execute(self.schema)
+            connection.execute('CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)')
+            connection.executemany('INSERT OR REPLACE INTO {} VALUES ({})'
+                                   .format(self.table, ', '.join('?' * len(self.columns))),
+                                   self.parser(self.sourcefile))
+            connection.executemany('INSERT INTO metadata VALUES (?, ?)',
+                                   [('schema', self.schema), ('mtime', repr(stats.st_mtime)),
+                                    ('size', str(stats.st_size)), ('checksum', checksum(self.sourcefile))])
+        return connection
+
+    def close(self):
+        self.connection.close()
+
+    def __getitem__(self, key):
+        """
+        :param key: value of the first column of the row
+        :return: tuple of the values of the remaining columns of the row
+        """
+        row = self.connection.execute('SELECT {} FROM {} WHERE {} = ?'
+                                      .format(', '.join(self.columns[1:]), self.table, self.columns[0]),
+                                      (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row
+
+    def __init__(self, sourcefile, indexfile, table, columns, parser):
+        """
+        :param sourcefile: name and path of the file to index
+        :param indexfile: name and path of the SQLite index
+        :param table: name of the table of the index
+        :param columns: list of the names of the columns of the table. The first column is the key of the lookups
+        :param parser: function that extracts the rows of the index from the source file. It is called with the name
+        and path of the source file, and returns tuples of the values of the columns
+        """
+        self.sourcefile = sourcefile
+        self.indexfile = indexfile
+        self.table = table
+        self.columns = columns
+        self.parser = parser
+        self.schema = 'CREATE TABLE {} ({} TEXT PRIMARY KEY, {}) WITHOUT ROWID' \
+            .format(table, columns[0], ', '.join('{} TEXT'.format(column) for column in columns[1:]))
+        if self.current():
+            self.connection = sqlite3.connect(self.indexfile)
+        else:
+            # Build the index in a temporary file, and replace any outdated index once it is complete, so that an
+            # incomplete index is never used
+            try:
+                with atomicfile(self.indexfile) as temporaryfile:
+                    self.build(temporaryfile).close()
+                self.connection = sqlite3.connect(self.indexfile)
+            except (sqlite3.Error, IOError, OSError):
+                # If the index cannot be written (e.g. the folder is read-only), build the index in memory
+                self.connection = self.build(':memory:')
+        # Memory-map the index rather than reading it through the page cache of each connection
+        self.connection.execute('PRAGMA mmap_size = 1073741824')
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+from sipprutilities.sqliteindex import SQLiteIndex
+from glob import glob
+import os
+__author__ = 'adamkoziol'
+
+
+def databasefile(targetpath):
+    """
+    Find the FASTA-formatted NCBI 16S reference database in the target path. The database is stored in the bait folder
+    of the target path (sixteens_full), or as the combined target file in the target path itself (sixteenS)
+    :param targetpath: target path of the 16S analysis
+    :return: name and path of the database
+    """
+    for pattern in [os.path.join(targetpath, 'bait', '*.fa'), os.path.join(targetpath, '*.fasta')]:
+        databases = sorted(glob(pattern))
+        if databases:
+            return databases[0]
+    raise FileNotFoundError('Could not find the 16S reference database (bait/*.fa or *.fasta) in the target path {}'
+                            .format(targetpath))
+
+
+class DescriptionIndex(SQLiteIndex):
+    """
+    Looks up the genus, species, and full description of the records of a 16S reference database using an SQLite
+    index of the FASTA headers, so that all the samples share a single copy of the descriptions instead of each parsing
+    the whole database
+    """
+
+    @staticmethod
+    def parse(fastafile):
+        """
+        Extract the IDs and descriptions from the headers of the database. Only the header lines are parsed, so the
+        sequences are never loaded
+        :param fastafile: name and path of the FASTA-formatted database
+        :return: tuples of ID e.g. gi|1018196593|ref|NR_136472.1|, genus e.g. Escherichia, species e.g. marmotae,
+        and description e.g. gi|1018196593|ref|NR_136472.1| Escherichia marmotae strain HT073016 16S ribosomal RNA,
+        partial sequence
+        """
+        with open(fastafile) as fasta:
+            for line in fasta:
+                if line.startswith('>'):
+                    description = line[1:].rstrip()
+                    try:
+                        recordid = description.split()[0]
+                    except IndexError:
+                        continue
+                    # The genus and species follow the final pipe of the description
+                    organism = description.split('|')[-1].split()
+                    genus = organism[0] if organism else str()
+                    species = organism[1] if len(organism) > 1 else str()
+                    yield recordid, genus, species, description
+
+    def __init__(self, fastafile):
+        """
+        :param fastafile: name and path of the FASTA-formatted database
+        """
+        SQLiteIndex.__init__(self, fastafile, os.path.splitext(fastafile)[0] + '_descriptions.sqlite', 'records',
+                             ['id', 'genus', 'species', 'description'], self.parse)
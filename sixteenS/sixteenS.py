@@ -3,6 +3,7 @@ import subprocess
 import time
 from sipprCommon.sippingmethods import *
 from sipprCommon.objectprep import Objectprep
+from sixteenS.descriptions import DescriptionIndex, databasefile
 from accessoryFunctions.accessoryFunctions import *
 from accessoryFunctions.metadataprinter import *
 
@@ -41,16 +42,16 @@ class SixteenS(object):
         Parses the 16S target files to link accession numbers stored in the .fai and metadata files to the genera stored
         in the target file
         """
-        from Bio import SeqIO
         import operator
+        # Load the index of the descriptions of the combined target file once for all the samples. The baitfiles of
+        # the samples only contain records from the combined target file
+        descriptions = DescriptionIndex(databasefile(self.targetpath))
         for sample in self.runmetadata.samples:
-            # Load the records from the target file into a dictionary
-            record_dict = SeqIO.to_dict(SeqIO.parse(sample[self.analysistype].baitfile, "fasta"))
             sample[self.analysistype].classification = set()
             sample[self.analysistype].genera = dict()
             # Add all the genera with hits into the set of genera
             for result in sample[self.analysistype].results:
-                genus, species = record_dict[result].description.split('|')[-1].split()[:2]
+                genus, species, _ = descriptions[result]
                 sample[self.analysistype].classification.add(genus)
                 sample[self.analysistype].genera[result] = genus
             # Convert the set to a list for easier JSON serialisation
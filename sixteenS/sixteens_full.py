@@ -2,22 +2,28 @@
 from accessoryFunctions.accessoryFunctions import MetadataObject, GenObject, printtime, make_path, write_to_logfile, \
     run_subprocess
 from sipprCommon.objectprep import Objectprep
-from sipprCommon.sippingmethods import Sippr
+from sixteenS.descriptions import DescriptionIndex, databasefile
+from fastsippr.fastsippr import FastSippr
+from fastsippr.arguments import fastsipprarguments, fastsipprattributes
+from fastsippr.fastqio import fastqreader
+from fastsippr.reservoir import Reservoir
+from sipprutilities.fileio import atomicwrite
 from Bio.Blast.Applications import NcbiblastnCommandline
 import Bio.Application
 from Bio import SeqIO
 from threading import Thread
-from subprocess import PIPE
+from subprocess import Popen, PIPE
 from csv import DictReader
 from glob import glob
 import operator
+import random
 import time
 import os
 
 __author__ = 'adamkoziol'
 
 
-class SixteenSBait(Sippr):
+class SixteenSBait(FastSippr):
 
     def main(self):
         """
@@ -25,7 +31,11 @@ class SixteenSBait(Sippr):
         """
         self.targets()
         self.bait(k=51)
-        self.reversebait()
+        # Reduce the full 16S database to the targets with hits in the baited reads
+        if self.prefilter:
+            self.prefiltering()
+        else:
+            self.reversebait()
         self.subsample_reads()
 
     def targets(self):
@@ -37,8 +47,7 @@ class SixteenSBait(Sippr):
                 setattr(sample, self.analysistype, GenObject())
                 sample[self.analysistype].runanalysis = True
                 sample[self.analysistype].targetpath = self.targetpath
-                baitpath = os.path.join(self.targetpath, 'bait')
-                sample[self.analysistype].baitfile = glob(os.path.join(baitpath, '*.fa'))[0]
+                sample[self.analysistype].baitfile = databasefile(self.targetpath)
                 sample[self.analysistype].outputdir = os.path.join(sample.run.outputdirectory, self.analysistype)
                 sample[self.analysistype].logout = os.path.join(sample[self.analysistype].outputdir, 'logout.txt')
                 sample[self.analysistype].logerr = os.path.join(sample[self.analysistype].outputdir, 'logerr.txt')
@@ -47,7 +56,7 @@ class SixteenSBait(Sippr):
                 sample[self.analysistype].complete = False
 
 
-class SixteenSSipper(Sippr):
+class SixteenSSipper(FastSippr):
 
     def main(self):
         """
@@ -55,9 +64,17 @@ class SixteenSSipper(Sippr):
         """
         self.targets()
         self.bait()
-        # If desired, use bbduk to bait the target sequences with the previously baited FASTQ files
-        if self.revbait:
+        # If desired, reduce the targets with the previously baited FASTQ files
+        if self.prefilter:
+            self.prefiltering()
+        elif self.revbait:
             self.reversebait()
+        # If desired, cap the depth of coverage of each target by subsampling the baited reads
+        if self.maxdepth:
+            self.downsampling()
+        # If desired, collapse exact duplicate reads into a single read prior to mapping
+        if self.collapse:
+            self.collapsing()
         # Run the bowtie2 read mapping module
         self.mapping()
         # Use samtools to index the sorted bam file
@@ -125,10 +142,10 @@ class SixteenS(object):
         # Use a custom sippr method to use the full reference database as bait, and run mirabait against the FASTQ
         # reads - do not perform reference mapping yet
         SixteenSBait(self, self.cutoff)
-        # Subsample 1000 reads from the FASTQ files
-        self.subsample()
-        # Convert the subsampled FASTQ files to FASTA format
-        self.fasta()
+        # When streaming, the subsampled reads are piped directly into BLAST rather than being written to disk
+        if not self.streaming:
+            # Subsample 1000 reads from the FASTQ files, and write them in FASTA format
+            self.fasta()
         # Create BLAST databases if required
         self.makeblastdb()
         # Run BLAST analyses of the subsampled FASTA files against the NCBI 16S reference database
@@ -141,52 +158,11 @@ class SixteenS(object):
         # Create reports
         self.reporter()
 
-    def subsample(self):
-        """
-        Subsample 1000 reads from the baited files
-        """
-        # Create the threads for the analysis
-        printtime('Subsampling FASTQ reads', self.starttime, output=self.portallog)
-        for _ in range(self.cpus):
-            threads = Thread(target=self.subsamplethreads, args=())
-            threads.setDaemon(True)
-            threads.start()
-        for sample in self.runmetadata.samples:
-            if sample.general.bestassemblyfile != 'NA':
-                # Set the name of the subsampled FASTQ file
-                sample[self.analysistype].subsampledfastq = os.path.splitext(sample[self.analysistype].baitedfastq)[0] \
-                                                            + '_subsampled.fastq'
-                # Set the system call
-                sample[self.analysistype].seqtkcall = 'reformat.sh in={} out={} samplereadstarget=1000'\
-                    .format(sample[self.analysistype].baitedfastq,
-                            sample[self.analysistype].subsampledfastq)
-                # Add the sample to the queue
-                self.samplequeue.put(sample)
-        self.samplequeue.join()
-
-    def subsamplethreads(self):
-        while True:
-            sample = self.samplequeue.get()
-            # Check to see if the subsampled FASTQ file has already been created
-            if not os.path.isfile(sample[self.analysistype].subsampledfastq):
-                # Run the system call
-                # call(sample[self.analysistype].seqtkcall, shell=True, stdout=self.devnull, stderr=self.devnull)
-                out, err = run_subprocess(sample[self.analysistype].seqtkcall)
-                write_to_logfile(sample[self.analysistype].seqtkcall,
-                                 sample[self.analysistype].seqtkcall,
-                                 self.logfile, sample.general.logout, sample.general.logerr,
-                                 sample[self.analysistype].logout, sample[self.analysistype].logerr)
-                write_to_logfile(out,
-                                 err,
-                                 self.logfile, sample.general.logout, sample.general.logerr,
-                                 sample[self.analysistype].logout, sample[self.analysistype].logerr)
-            self.samplequeue.task_done()
-
     def fasta(self):
         """
-        Convert the subsampled reads to FASTA format using fastq_to_fasta from the FASTX toolkit
+        Subsample reads from the baited FASTQ files, and write them directly to FASTA format
         """
-        printtime('Converting FASTQ files to FASTA format', self.starttime, output=self.portallog)
+        printtime('Subsampling FASTQ reads to FASTA format', self.starttime, output=self.portallog)
         # Create the threads for the analysis
         for _ in range(self.cpus):
             threads = Thread(target=self.fastathreads, args=())
@@ -194,11 +170,9 @@ class SixteenS(object):
             threads.start()
         for sample in self.runmetadata.samples:
             if sample.general.bestassemblyfile != 'NA':
-                # Set the name as the FASTA file - the same as the FASTQ, but with .fa file extension instead of .fastq
-                sample[self.analysistype].fasta = os.path.splitext(sample[self.analysistype].subsampledfastq)[0] + '.fa'
-                # Set the system call
-                sample[self.analysistype].fastxcall = 'fastq_to_fasta -i {} -o {}'\
-                    .format(sample[self.analysistype].subsampledfastq, sample[self.analysistype].fasta)
+                # Set the name of the FASTA file of the subsampled reads
+                sample[self.analysistype].fasta = os.path.splitext(sample[self.analysistype].baitedfastq)[0] \
+                    + '_subsampled.fa'
                 # Add the sample to the queue
                 self.fastaqueue.put(sample)
         self.fastaqueue.join()
@@ -206,20 +180,29 @@ class SixteenS(object):
     def fastathreads(self):
         while True:
             sample = self.fastaqueue.get()
-            # Check to see if the FASTA file already exists
-            if not os.path.isfile(sample[self.analysistype].fasta):
-                # Run the system call , stdout=self.devnull, stderr=self.devnull
-                out, err = run_subprocess(sample[self.analysistype].fastxcall)
-                write_to_logfile(sample[self.analysistype].fastxcall,
-                                 sample[self.analysistype].fastxcall,
-                                 self.logfile, sample.general.logout, sample.general.logerr,
-                                 sample[self.analysistype].logout, sample[self.analysistype].logerr)
-                write_to_logfile(out,
-                                 err,
-                                 self.logfile, sample.general.logout, sample.general.logerr,
-                                 sample[self.analysistype].logout, sample[self.analysistype].logerr)
+            # Check to see if the FASTA file already exists, and that there are baited reads to subsample
+            if not os.path.isfile(sample[self.analysistype].fasta) \
+                    and os.path.isfile(sample[self.analysistype].baitedfastq):
+                # Write the subsampled reads to a temporary file, so that an interrupted run does not leave behind an
+                # incomplete FASTA file that would be reused
+                atomicwrite(sample[self.analysistype].fasta, lambda fasta: fasta.writelines(self.fastarecords(sample)))
             self.fastaqueue.task_done()
 
+    def fastarecords(self, sample):
+        """
+        Subsample reads from the baited FASTQ file with a reservoir, and yield them as FASTA-formatted strings
+        :param sample: sample object
+        :return: FASTA-formatted string of each subsampled read
+        """
+        # Use a seeded random number generator, so that reruns of the analysis use the same reads
+        reservoir = Reservoir(self.subsamplereads, random.Random(self.seed))
+        for read in fastqreader(sample[self.analysistype].baitedfastq, self.threads):
+            reservoir.add(read)
+        for header, sequence, _ in reservoir.items:
+            # As with fastq_to_fasta, discard any reads containing unknown (N) bases
+            if 'N' not in sequence:
+                yield '>{}\n{}\n'.format(header[1:], sequence)
+
     def makeblastdb(self):
         """
         Makes blast database files from targets as necessary
@@ -263,7 +246,9 @@ class SixteenS(object):
                     sample[self.analysistype].outputdir,
                     '{}_{}_blastresults.csv'.format(sample.name, self.analysistype))
                 # Use the NCBI BLASTn command line wrapper module from BioPython to set the parameters of the search
-                blastn = NcbiblastnCommandline(query=sample[self.analysistype].fasta,
+                # Streamed reads are read by BLAST from stdin
+                query = '-' if self.streaming else sample[self.analysistype].fasta
+                blastn = NcbiblastnCommandline(query=query,
                                                db=os.path.splitext(sample[self.analysistype].baitfile)[0],
                                                max_target_seqs=1,
                                                num_threads=self.threads,
@@ -280,8 +265,12 @@ class SixteenS(object):
         while True:
             sample, blastn = self.blastqueue.get()
             if not os.path.isfile(sample[self.analysistype].blastreport):
+                if self.streaming:
+                    # Subsample the baited reads, and pipe the FASTA-formatted reads into BLAST
+                    if os.path.isfile(sample[self.analysistype].baitedfastq) and not self.streamblast(sample, blastn):
+                        sample[self.analysistype].blastreport = str()
                 # Ensure that the query file exists; this can happen with very small .fastq files
-                if os.path.isfile(sample[self.analysistype].fasta):
+                elif os.path.isfile(sample[self.analysistype].fasta):
                     # Perform the BLAST analysis
                     try:
                         blastn()
@@ -289,16 +278,51 @@ class SixteenS(object):
                         sample[self.analysistype].blastreport = str()
             self.blastqueue.task_done()
 
+    def streamblast(self, sample, blastn):
+        """
+        Write the subsampled reads to the standard input of BLAST as each FASTA-formatted read is produced, so that the
+        query is never written to disk, or joined into a single string in memory
+        :param sample: sample object
+        :param blastn: NcbiblastnCommandline object with the query set to stdin (-)
+        :return: boolean of whether BLAST completed successfully
+        """
+        records = self.fastarecords(sample)
+        first = next(records, None)
+        # There is nothing to BLAST if none of the subsampled reads passed the filter
+        if first is None:
+            return True
+        process = Popen(str(blastn), shell=True, stdin=PIPE, stdout=self.devnull, stderr=self.devnull,
+                        universal_newlines=True)
+        try:
+            process.stdin.write(first)
+            for record in records:
+                process.stdin.write(record)
+            process.stdin.close()
+        # BLAST closes its input if it fails, which is reported through the return code below
+        except BrokenPipeError:
+            pass
+        return process.wait() == 0
+
+    def descriptionindex(self):
+        """
+        Load the index of the descriptions of the NCBI 16S reference database once, and share it between all the
+        samples. The reduced databases of the samples only contain records from the full database, so the index is
+        always built from the full database
+        :return: DescriptionIndex object
+        """
+        if self.descriptions is None:
+            self.descriptions = DescriptionIndex(databasefile(self.targetpath))
+        return self.descriptions
+
     def blastparse(self):
         """
         Parse the blast results, and store necessary data in dictionaries in sample object
         """
         printtime('Parsing BLAST results', self.starttime, output=self.portallog)
-        # Load the NCBI 16S reference database as a dictionary
+        # Load the index of the descriptions of the NCBI 16S reference database
+        dbrecords = self.descriptionindex()
         for sample in self.runmetadata.samples:
             if sample.general.bestassemblyfile != 'NA':
-                # Load the NCBI 16S reference database as a dictionary
-                dbrecords = SeqIO.to_dict(SeqIO.parse(sample[self.analysistype].baitfile, 'fasta'))
                 # Allow for no BLAST results
                 if os.path.isfile(sample[self.analysistype].blastreport):
                     # Initialise a dictionary to store the number of times a genus is the best hit
@@ -310,11 +334,15 @@ class SixteenS(object):
                     for record in blastdict:
                         # Create the subject id. It will look like this: gi|1018196593|ref|NR_136472.1|
                         subject = record['subject_id']
-                        # Extract the genus name. Use the subject id as a key in the dictionary of the reference db.
-                        # It will return the full record e.g. gi|1018196593|ref|NR_136472.1| Escherichia marmotae
-                        # strain HT073016 16S ribosomal RNA, partial sequence
-                        # This full description can be manipulated to extract the genus e.g. Escherichia
-                        genus = dbrecords[subject].description.split('|')[-1].split()[0]
+                        # Extract the genus name. Use the subject id as a key in the index of the reference db.
+                        # It will return the genus e.g. Escherichia, the species, and the full description
+                        # e.g. gi|1018196593|ref|NR_136472.1| Escherichia marmotae strain HT073016 16S ribosomal RNA,
+                        # partial sequence. Hits to records missing from the index (e.g. a BLAST database that does
+                        # not match the FASTA file) are skipped
+                        try:
+                            genus, _, description = dbrecords[subject]
+                        except KeyError:
+                            continue
                         # Increment the number of times this genus was found, or initialise the dictionary with this
                         # genus the first time it is seen
                         try:
@@ -322,9 +350,9 @@ class SixteenS(object):
                         except KeyError:
                             sample[self.analysistype].frequency[genus] = 1
                         try:
-                            recorddict[dbrecords[subject].description] += 1
+                            recorddict[description] += 1
                         except KeyError:
-                            recorddict[dbrecords[subject].description] = 1
+                            recorddict[description] = 1
                     # Sort the dictionary based on the number of times a genus is seen
                     sample[self.analysistype].sortedgenera = sorted(sample[self.analysistype].frequency.items(),
                                                                     key=operator.itemgetter(1), reverse=True)
@@ -359,6 +387,8 @@ class SixteenS(object):
         # Create the path in which the reports are stored
         make_path(self.reportpath)
         printtime('Creating {} report'.format(self.analysistype), self.starttime)
+        # Load the index of the descriptions of the NCBI 16S reference database
+        descriptions = self.descriptionindex()
         # Initialise the header and data strings
         header = 'Strain,Gene,PercentIdentity,Genus,FoldCoverage\n'
         data = ''
@@ -373,16 +403,16 @@ class SixteenS(object):
                         # fewest number of SNPs rather than the highest percent identity
                         sample[self.analysistype].besthit = sorted(sample[self.analysistype].resultssnp.items(),
                                                                    key=operator.itemgetter(1))[0][0]
-                        # Parse the baited FASTA file to pull out the the description of the hit
-                        for record in SeqIO.parse(sample[self.analysistype].baitfile, 'fasta'):
-                            # If the best hit e.g. gi|631251361|ref|NR_112558.1| is present in the current record,
-                            # gi|631251361|ref|NR_112558.1| Escherichia coli strain JCM 1649 16S ribosomal RNA ...,
-                            # extract the match and the species
-                            if sample[self.analysistype].besthit in record.id:
-                                # Set the best match and species from the records
-                                sample[self.analysistype].sixteens_match = record.description.split(' 16S')[0]
-                                sample[self.analysistype].species = \
-                                    sample[self.analysistype].sixteens_match.split('|')[-1].split()[1]
+                        # Look up the description of the best hit e.g. gi|631251361|ref|NR_112558.1| in the index of
+                        # the reference database: gi|631251361|ref|NR_112558.1| Escherichia coli strain JCM 1649 16S
+                        # ribosomal RNA ..., and extract the match and the species
+                        try:
+                            _, species, description = descriptions[sample[self.analysistype].besthit]
+                            # Set the best match and species from the record
+                            sample[self.analysistype].sixteens_match = description.split(' 16S')[0]
+                            sample[self.analysistype].species = species
+                        except KeyError:
+                            pass
                         # Add the sample name to the data string
                         data += sample.name + ','
                         # Find the record that matches the best hit, and extract the necessary values to be place in the
@@ -480,12 +510,23 @@ class SixteenS(object):
             self.copy = args.copy
         except AttributeError:
             self.copy = False
+        # Pass any arguments of the optional FastSippr stages on to the analyses
+        fastsipprattributes(self, args)
+        # Stream the subsampled reads into BLAST instead of writing intermediate files
+        try:
+            self.streaming = args.streaming
+        except AttributeError:
+            self.streaming = False
+        # Number of reads to subsample for the BLAST analyses, and the seed used to select them
+        self.subsamplereads = 1000
+        self.seed = 1
         self.revbait = True
         self.devnull = open(os.path.devnull, 'w')
-        self.samplequeue = Queue(maxsize=self.cpus)
         self.fastaqueue = Queue(maxsize=self.cpus)
         self.blastqueue = Queue(maxsize=self.cpus)
         self.baitfile = str()
+        # Index of the descriptions of the 16S reference database, which is loaded once by descriptionindex()
+        self.descriptions = None
         self.taxonomy = {'Escherichia': 'coli', 'Listeria': 'monocytogenes', 'Salmonella': 'enterica'}
         # Fields used for custom outfmt 6 BLAST output:
         self.fieldnames = ['query_id', 'subject_id', 'positives', 'mismatches', 'gaps',
@@ -553,6 +594,11 @@ if __name__ == '__main__':
     parser.add_argument('-u', '--cutoff',
                         default=0.8,
                         help='Custom cutoff values')
+    fastsipprarguments(parser)
+    parser.add_argument('--streaming',
+                        action='store_true',
+                        help='Stream subsampled reads directly into BLAST rather than writing intermediate FASTQ and '
+                             'FASTA files')
     parser.add_argument('-C', '--copy',
                         action='store_true',
                         help='Normally, the program will create symbolic links of the files into the sequence path, '
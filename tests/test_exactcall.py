@@ -0,0 +1,81 @@
+#!/usr/bin/env python 3
+from Bio.SeqRecord import SeqRecord
+from Bio.Seq import Seq
+from collections import defaultdict
+import pytest
+import numpy
+import sys
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+scriptpath = os.path.join(testpath, '..')
+sys.path.append(scriptpath)
+from MLSTsippr.sipprmlst import MLSTmap
+from fastsippr.kmers import kmerhashes
+
+__author__ = 'adamkoziol'
+
+
+def exactcaller(averagedepth=10):
+    """
+    Create an MLSTmap object with only the attributes used by the exact calling methods
+    """
+    mlst = MLSTmap.__new__(MLSTmap)
+    mlst.exactkmer = 31
+    mlst.averagedepth = averagedepth
+    return mlst
+
+
+def readcounts(reads):
+    hashes, _, _ = kmerhashes(reads, 31)
+    return numpy.unique(hashes, return_counts=True)
+
+
+def tiledreads(sequence, copies, length=100):
+    # Reads starting at every position of the sequence, so that every k-mer is covered at least copies times
+    return [sequence[start:start + length] for start in range(len(sequence) - length + 1)] * copies
+
+
+def alleles():
+    # Two alleles of the same gene that differ by a single substitution in the middle
+    reference = ''.join(numpy.random.RandomState(0).choice(list('ACGT'), 300))
+    variant = reference[:150] + ('A' if reference[150] != 'A' else 'C') + reference[151:]
+    records = [SeqRecord(Seq(reference), id='abcZ_1'), SeqRecord(Seq(variant), id='abcZ_2')]
+    alleleindex = {'abcZ_1': ('abcZ', '1'), 'abcZ_2': ('abcZ', '2')}
+    return records, alleleindex
+
+
+def test_exact_reference():
+    records, alleleindex = alleles()
+    readkmers, counts = readcounts(tiledreads(str(records[0].seq), 10))
+    covered = defaultdict(dict)
+    exactcaller().coveredalleles(records, readkmers, counts, alleleindex, covered)
+    assert list(covered) == ['abcZ']
+    assert list(covered['abcZ']) == ['abcZ_1']
+    assert covered['abcZ']['abcZ_1'] > 10
+
+
+def test_exact_single_read_variant():
+    # A single read with the substitution must not call the variant allele, even though the average depth of the
+    # variant allele is high
+    records, alleleindex = alleles()
+    reads = tiledreads(str(records[0].seq), 10) + [str(records[1].seq)[100:200]]
+    readkmers, counts = readcounts(reads)
+    covered = defaultdict(dict)
+    exactcaller().coveredalleles(records, readkmers, counts, alleleindex, covered)
+    assert list(covered['abcZ']) == ['abcZ_1']
+
+
+def test_exact_insufficient_depth():
+    records, alleleindex = alleles()
+    readkmers, counts = readcounts(tiledreads(str(records[0].seq), 5))
+    covered = defaultdict(dict)
+    exactcaller().coveredalleles(records, readkmers, counts, alleleindex, covered)
+    assert not covered
+
+
+def test_allelesplitter():
+    assert MLSTmap.allelesplitter('abcZ_2') == ('abcZ', '2')
+    assert MLSTmap.allelesplitter('BACT000001-5') == ('BACT000001', '5')
+    with pytest.raises(ValueError):
+        MLSTmap.allelesplitter('abcZ')
@@ -0,0 +1,65 @@
+#!/usr/bin/env python 3
+import pytest
+import gzip
+import sys
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+scriptpath = os.path.join(testpath, '..')
+sys.path.append(scriptpath)
+from fastsippr.fastqio import BLOCKSIZE, fastqchunks, fastqreader, fastqwriter, isbgzf, readchunks
+
+__author__ = 'adamkoziol'
+
+
+def records(count):
+    # Enough records to span several BGZF blocks
+    return [('@read{}'.format(index), 'ACGT' * 25, 'I' * 100) for index in range(count)]
+
+
+def fastqtext(reads):
+    return ''.join('{}\n{}\n+\n{}\n'.format(header, sequence, quality) for header, sequence, quality in reads)
+
+
+def test_bgzf_round_trip(tmpdir):
+    reads = records(2000)
+    fastq = str(tmpdir.join('reads.fastq.gz'))
+    fastqwriter(reads, fastq, threads=4)
+    assert isbgzf(fastq)
+    assert len(fastqtext(reads)) > 2 * BLOCKSIZE
+    # BGZF files must be readable as ordinary gzip files
+    with gzip.open(fastq, 'rt') as handle:
+        assert handle.read() == fastqtext(reads)
+    assert list(fastqreader(fastq, threads=4)) == reads
+    chunks = list(fastqchunks(fastq, size=300))
+    assert [len(chunk) for chunk in chunks] == [300] * 6 + [200]
+    assert [record for chunk in chunks for record in chunk] == reads
+
+
+def test_multi_member_gzip(tmpdir):
+    reads = records(500)
+    fastq = str(tmpdir.join('reads.fastq.gz'))
+    # Concatenated gzip members, as created by e.g. cat a.fastq.gz b.fastq.gz
+    with open(fastq, 'wb') as handle:
+        handle.write(gzip.compress(fastqtext(reads[:123]).encode()))
+        handle.write(gzip.compress(fastqtext(reads[123:]).encode()))
+    assert not isbgzf(fastq)
+    assert b''.join(readchunks(fastq)).decode() == fastqtext(reads)
+    assert list(fastqreader(fastq)) == reads
+
+
+def test_uncompressed(tmpdir):
+    reads = records(10)
+    fastq = str(tmpdir.join('reads.fastq'))
+    fastqwriter(reads, fastq)
+    with open(fastq) as handle:
+        assert handle.read() == fastqtext(reads)
+    assert list(fastqreader(fastq)) == reads
+
+
+def test_truncated_record(tmpdir):
+    fastq = str(tmpdir.join('truncated.fastq'))
+    with open(fastq, 'w') as handle:
+        handle.write(fastqtext(records(2)) + '@read2\nACGT\n+\n')
+    with pytest.raises(ValueError):
+        list(fastqreader(fastq))
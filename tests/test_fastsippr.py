@@ -0,0 +1,145 @@
+#!/usr/bin/env python 3
+from Bio.SeqRecord import SeqRecord
+from Bio.Seq import Seq
+from types import SimpleNamespace
+from collections import Counter
+from threading import Thread
+from queue import Queue
+import numpy
+import pysam
+import sys
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+scriptpath = os.path.join(testpath, '..')
+sys.path.append(scriptpath)
+from fastsippr.fastsippr import FastSippr
+from fastsippr.fastqio import fastqchunks, fastqreader, fastqwriter
+from fastsippr.kmers import kmerhashes
+
+__author__ = 'adamkoziol'
+
+
+def fastsippr(maxdepth):
+    """
+    Create a FastSippr object with only the attributes used by the downsampling methods
+    """
+    sippr = FastSippr.__new__(FastSippr)
+    sippr.prefilterkmer = 27
+    sippr.maxdepth = maxdepth
+    return sippr
+
+
+def sampledreads(sequence, count, state, length=100):
+    starts = state.randint(0, len(sequence) - length + 1, count)
+    return [sequence[start:start + length] for start in starts]
+
+
+def retainedreads(sippr, records, fastq):
+    """
+    Find the retained reads in the same way as FastSippr.downsample
+    """
+    hashes, owners, _ = kmerhashes([str(record.seq) for record in records], sippr.prefilterkmer)
+    pairs = numpy.unique(numpy.rec.fromarrays([hashes, owners], names='kmer,target'))
+    targetlengths = numpy.array([len(record.seq) for record in records], dtype=numpy.int64)
+    reads = list()
+    targets = list()
+    kmers = list()
+    readcount = 0
+    for chunk in fastqchunks(fastq, size=50):
+        chunkreads, chunktargets, chunkkmers = sippr.hits(chunk, pairs['kmer'], pairs['target'], len(records))
+        reads.append(chunkreads + readcount)
+        targets.append(chunktargets)
+        kmers.append(chunkkmers)
+        readcount += len(chunk)
+    return sippr.select(numpy.concatenate(reads), numpy.concatenate(targets), numpy.concatenate(kmers),
+                        targetlengths, readcount)
+
+
+def test_depth_cap(tmpdir):
+    state = numpy.random.RandomState(0)
+    deep, shallow = [''.join(state.choice(list('ACGT'), 500)) for _ in range(2)]
+    records = [SeqRecord(Seq(deep), id='deep'), SeqRecord(Seq(shallow), id='shallow')]
+    # 40X of the deep target, 4X of the shallow target, and reads that do not hit either target
+    sequences = sampledreads(deep, 200, state) + sampledreads(shallow, 20, state) + \
+        [''.join(state.choice(list('ACGT'), 100)) for _ in range(10)]
+    fastq = str(tmpdir.join('reads.fastq.gz'))
+    fastqwriter((('@read{}'.format(index), sequence, 'I' * len(sequence))
+                 for index, sequence in enumerate(sequences)), fastq)
+    sippr = fastsippr(10)
+    retained = retainedreads(sippr, records, fastq)
+    # Each read covers 100 bases, so 50 reads cover the 500 bases of the deep target to 10X
+    assert retained[:200].sum() == 50
+    # The shallow target is below the maximum depth, and reads without hits are never discarded
+    assert retained[200:].all()
+    # The same reads are retained on every run
+    assert (retainedreads(sippr, records, fastq) == retained).all()
+
+
+def test_depth_cap_shared_reads(tmpdir):
+    # Reads of two identical targets count towards both targets, so neither target is reduced below the maximum
+    state = numpy.random.RandomState(1)
+    sequence = ''.join(state.choice(list('ACGT'), 500))
+    records = [SeqRecord(Seq(sequence), id='target_1'), SeqRecord(Seq(sequence), id='target_2')]
+    fastq = str(tmpdir.join('reads.fastq'))
+    fastqwriter((('@read{}'.format(index), read, 'I' * len(read))
+                 for index, read in enumerate(sampledreads(sequence, 200, state))), fastq)
+    retained = retainedreads(fastsippr(10), records, fastq)
+    assert 50 <= retained.sum() <= 100
+
+
+def worker(queue, target, sample):
+    """
+    Run a single sample through one of the threaded FastSippr methods
+    """
+    thread = Thread(target=target)
+    thread.setDaemon(True)
+    thread.start()
+    queue.put(sample)
+    queue.join()
+
+
+def test_collapse_round_trip(tmpdir):
+    state = numpy.random.RandomState(2)
+    reference = ''.join(state.choice(list('ACGT'), 500))
+    starts = state.randint(0, 400, 20)
+    # Include exact duplicates of some of the reads
+    starts = list(starts) + list(starts[:5]) * 3
+    fastq = str(tmpdir.join('reads.fastq.gz'))
+    fastqwriter((('@read{} 1:N:0:1'.format(index), reference[start:start + 100], 'I' * 100)
+                 for index, start in enumerate(starts)), fastq)
+    sippr = fastsippr(0)
+    sippr.analysistype = 'genesippr'
+    sippr.threads = 1
+    sippr.collapsequeue = Queue()
+    sippr.expandqueue = Queue()
+    sample = {'genesippr': SimpleNamespace(baitedfastq=fastq,
+                                           collapsedreads=str(tmpdir.join('collapsed.fastq.gz')),
+                                           sortedbam=str(tmpdir.join('sorted.bam')),
+                                           expandedbam=str(tmpdir.join('expanded.bam')))}
+    worker(sippr.collapsequeue, sippr.collapse_reads, sample)
+    collapsed = list(fastqreader(sample['genesippr'].baitedfastq))
+    # Each sequence is written once, and the copies add up to the original number of reads
+    assert len(collapsed) == len(set(starts))
+    assert len({sequence for _, sequence, _ in collapsed}) == len(collapsed)
+    assert sum(FastSippr.copies(header[1:]) for header, _, _ in collapsed) == len(starts)
+    # Align the collapsed reads to the reference in sorted order
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': 'reference', 'LN': len(reference)}]}
+    with pysam.AlignmentFile(sample['genesippr'].sortedbam, 'wb', header=header) as bam:
+        for name, sequence, quality in sorted(collapsed, key=lambda read: reference.index(read[1])):
+            record = pysam.AlignedSegment()
+            record.query_name = name[1:]
+            record.query_sequence = sequence
+            record.query_qualities = pysam.qualitystring_to_array(quality)
+            record.reference_id = 0
+            record.reference_start = reference.index(sequence)
+            record.cigartuples = [(0, len(sequence))]
+            record.mapping_quality = 42
+            bam.write(record)
+    worker(sippr.expandqueue, sippr.expand, sample)
+    assert sample['genesippr'].sortedbam == sample['genesippr'].expandedbam
+    with pysam.AlignmentFile(sample['genesippr'].sortedbam, 'rb') as bam:
+        expanded = list(bam.fetch(until_eof=True))
+    # Every original read is restored, and the alignments remain sorted
+    assert Counter(record.reference_start for record in expanded) == Counter(starts)
+    assert [record.reference_start for record in expanded] == sorted(starts)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python 3
+import hashlib
+import pytest
+import sys
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+scriptpath = os.path.join(testpath, '..')
+sys.path.append(scriptpath)
+from sipprutilities.fileio import atomicfile, atomicwrite, checksum
+
+__author__ = 'adamkoziol'
+
+
+def test_checksum(tmpdir):
+    # Include multiple chunks
+    contents = os.urandom(2500000)
+    filename = tmpdir.join('contents.bin')
+    filename.write_binary(contents)
+    assert checksum(str(filename)) == hashlib.md5(contents).hexdigest()
+
+
+def test_atomicwrite(tmpdir):
+    filename = tmpdir.join('report.csv')
+    filename.write('previous\n')
+    atomicwrite(str(filename), lambda handle: handle.write('current\n'))
+    assert filename.read() == 'current\n'
+    assert tmpdir.listdir() == [filename]
+
+
+def test_atomicfile_failure(tmpdir):
+    filename = tmpdir.join('report.csv')
+    filename.write('previous\n')
+    with pytest.raises(ValueError):
+        with atomicfile(str(filename)) as temporaryfile:
+            with open(temporaryfile, 'w') as handle:
+                handle.write('incomplete\n')
+            raise ValueError
+    # The existing file is untouched, and the temporary file is removed
+    assert filename.read() == 'previous\n'
+    assert tmpdir.listdir() == [filename]
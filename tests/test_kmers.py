@@ -0,0 +1,75 @@
+#!/usr/bin/env python 3
+import numpy
+import sys
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+scriptpath = os.path.join(testpath, '..')
+sys.path.append(scriptpath)
+from fastsippr.kmers import contained, fmix, kmerhashes
+
+__author__ = 'adamkoziol'
+
+COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+
+
+def reversecomplement(sequence):
+    return ''.join(COMPLEMENT.get(base, 'N') for base in reversed(sequence.upper()))
+
+
+def referencehashes(sequence, k):
+    """
+    Hash the canonical k-mers of a sequence one k-mer at a time
+    """
+    hashes = list()
+    positions = list()
+    for position in range(len(sequence) - k + 1):
+        kmer = sequence[position:position + k].upper()
+        if set(kmer) - set('ACGT'):
+            continue
+        value = min(int(''.join(str('ACGT'.index(base)) for base in window), 4)
+                    for window in (kmer, reversecomplement(kmer)))
+        hashes.append(int(fmix(numpy.array([value], dtype=numpy.uint64))[0]))
+        positions.append(position)
+    return hashes, positions
+
+
+def randomsequence(length, seed=0):
+    return ''.join(numpy.random.RandomState(seed).choice(list('ACGT'), length))
+
+
+def test_canonical_kmers():
+    sequence = randomsequence(200)
+    # Include an ambiguous base and lower case bases
+    sequence = sequence[:50] + 'N' + sequence[51:150] + sequence[150:].lower()
+    for k in [1, 15, 31, 32]:
+        hashes, owners, positions = kmerhashes([sequence], k)
+        expected, expectedpositions = referencehashes(sequence, k)
+        assert [int(value) for value in hashes] == expected
+        assert list(positions) == expectedpositions
+        assert not owners.any()
+
+
+def test_reverse_complement():
+    sequence = randomsequence(300, seed=1)
+    forward, _, _ = kmerhashes([sequence], 31)
+    reverse, _, _ = kmerhashes([reversecomplement(sequence)], 31)
+    assert sorted(forward) == sorted(reverse)
+
+
+def test_multiple_sequences():
+    # k-mers must not span consecutive sequences
+    sequences = [randomsequence(40, seed=2), randomsequence(20, seed=3), randomsequence(10, seed=4)]
+    hashes, owners, positions = kmerhashes(sequences, 15)
+    assert list(numpy.bincount(owners)) == [26, 6]
+    for index, sequence in enumerate(sequences):
+        expected, expectedpositions = referencehashes(sequence, 15)
+        assert [int(value) for value in hashes[owners == index]] == expected
+        assert list(positions[owners == index]) == expectedpositions
+
+
+def test_contained():
+    reference = numpy.array([3, 7, 11], dtype=numpy.uint64)
+    hashes = numpy.array([1, 3, 8, 11, 12], dtype=numpy.uint64)
+    assert list(contained(hashes, reference)) == [False, True, False, True, False]
+    assert not contained(hashes, numpy.zeros(0, dtype=numpy.uint64)).any()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python 3
+from types import SimpleNamespace
+import subprocess
+import random
+import sys
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+scriptpath = os.path.join(testpath, '..')
+sys.path.append(scriptpath)
+from MASHsippr.mash import Mash
+
+__author__ = 'adamkoziol'
+
+
+class Sample(dict):
+    """
+    Metadata object with the analysis-specific attributes accessible as items
+    """
+    pass
+
+
+def masher(mashhits=2, mashtable=True):
+    """
+    Create a Mash object with only the attributes used to calculate distances with mash dist
+    """
+    mash = Mash.__new__(Mash)
+    mash.analysistype = 'mash'
+    mash.cpus = 1
+    mash.starttime = 0
+    mash.mashhits = mashhits
+    mash.mashtable = mashtable
+    mash.fnull = open(os.devnull, 'w')
+    return mash
+
+
+def mashsamples(tmpdir, count=3):
+    samples = list()
+    for index in range(count):
+        sample = Sample()
+        sample.name = 'sample{}'.format(index)
+        sample.general = SimpleNamespace(trimmedcorrectedfastqfiles=['/reads/sample{}_R1.fastq.gz'.format(index),
+                                                                     '/reads/sample{}_R2.fastq.gz'.format(index)])
+        sample.commands = SimpleNamespace()
+        sample['mash'] = SimpleNamespace(sketchfile=str(tmpdir.join('{}.msh'.format(sample.name))),
+                                         mashresults=str(tmpdir.join('{}.tab'.format(sample.name))),
+                                         mashfulltable=str(tmpdir.join('{}_full.tab'.format(sample.name))))
+        samples.append(sample)
+    return samples
+
+
+def fakemash(tmpdir, monkeypatch, lines, returncode=0):
+    """
+    Put a mash executable on the path that prints the supplied mash dist outputs and exits with the supplied code
+    """
+    outputs = tmpdir.join('outputs.tab')
+    outputs.write(''.join(lines))
+    executable = tmpdir.mkdir('bin').join('mash')
+    executable.write('#!/bin/sh\ncat {}\nexit {}\n'.format(outputs, returncode))
+    executable.chmod(0o755)
+    monkeypatch.setenv('PATH', '{}{}{}'.format(executable.dirname, os.pathsep, os.environ['PATH']))
+
+
+def distancelines(samples):
+    # Interleave the outputs of the samples, as in the outputs of a single call of mash dist
+    lines = list()
+    for reference in range(5):
+        for index, sample in enumerate(samples):
+            for fastq in sample.general.trimmedcorrectedfastqfiles:
+                distance = ((reference * 7 + index * 3 + len(fastq)) % 11) / 100
+                lines.append('GCF_{:09d}.1_genomic.fna.gz\t{}\t{}\t0\t{}/1000\n'
+                             .format(reference, fastq, distance, reference))
+    return lines
+
+
+def test_batchmash_split(tmpdir, monkeypatch):
+    samples = mashsamples(tmpdir)
+    lines = distancelines(samples)
+    fakemash(tmpdir, monkeypatch, lines)
+    mash = masher()
+    besthits = mash.batchmash('RefSeqSketchesDefaults.msh', samples)
+    for sample in samples:
+        # Each sample receives the outputs of its own FASTQ files
+        expected = [line for line in lines if line.split('\t')[1] in sample.general.trimmedcorrectedfastqfiles]
+        with open(sample['mash'].mashfulltable) as mashtable:
+            assert mashtable.readlines() == expected
+        # The results table only contains the closest reference genomes, sorted by distance
+        assert besthits[sample.name] == sorted(expected, key=lambda line: (float(line.split('\t')[2]), line))[:2]
+        with open(sample['mash'].mashresults) as mashresults:
+            assert mashresults.readlines() == besthits[sample.name]
+    assert not tmpdir.listdir(lambda path: path.ext == '.tmp')
+
+
+def test_batchmash_failure(tmpdir, monkeypatch):
+    samples = mashsamples(tmpdir)
+    # mash dist fails part of the way through the outputs
+    fakemash(tmpdir, monkeypatch, distancelines(samples)[:10], returncode=1)
+    assert masher().batchmash('RefSeqSketchesDefaults.msh', samples) == dict()
+    # Neither results tables nor temporary files are left behind, so the samples are analysed again on a rerun
+    for sample in samples:
+        assert not os.path.isfile(sample['mash'].mashresults)
+        assert not os.path.isfile(sample['mash'].mashfulltable)
+    assert not tmpdir.listdir(lambda path: path.ext == '.tmp')
+
+
+def test_batchmash_skip_table(tmpdir, monkeypatch):
+    samples = mashsamples(tmpdir)
+    fakemash(tmpdir, monkeypatch, distancelines(samples))
+    besthits = masher(mashtable=False).batchmash('RefSeqSketchesDefaults.msh', samples)
+    for sample in samples:
+        assert not os.path.isfile(sample['mash'].mashfulltable)
+        with open(sample['mash'].mashresults) as mashresults:
+            assert mashresults.readlines() == besthits[sample.name]
+
+
+def test_closest():
+    state = random.Random(0)
+    for _ in range(50):
+        # Include ties, and distances written in different formats
+        lines = ['GCF_{:09d}.1_genomic.fna.gz\tsample.fastq.gz\t{}\t0\t{}/1000\n'
+                 .format(state.randint(0, 30), state.choice(['0.01', '0.02', '1e-2', '0.03', '0.0200']),
+                         state.randint(0, 999)) for _ in range(state.randint(1, 60))]
+        mashhits = state.randint(1, 10)
+        expected = subprocess.run('sort -gk3 | head -n {}'.format(mashhits), shell=True, input=''.join(lines),
+                                  stdout=subprocess.PIPE, universal_newlines=True, env=dict(os.environ, LC_ALL='C'),
+                                  check=True).stdout
+        assert ''.join(masher(mashhits).closest(lines)) == expected
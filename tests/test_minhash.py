@@ -0,0 +1,173 @@
+#!/usr/bin/env python 3
+from math import factorial
+import timeit
+import numpy
+import sys
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+scriptpath = os.path.join(testpath, '..')
+sys.path.append(scriptpath)
+from MASHsippr.minhash import References, Sketch, adaptivesketch, distance, kmerhashes, murmur3, pvalue, \
+    writesketches
+from fastsippr.fastqio import fastqwriter
+
+__author__ = 'adamkoziol'
+
+
+def murmurhash(string, seed):
+    data = numpy.zeros((1, max(16, (len(string) + 15) // 16 * 16)), dtype=numpy.uint8)
+    data[0, :len(string)] = list(string.encode())
+    return int(murmur3(data, len(string), seed)[0])
+
+
+def randomsequence(length, state):
+    return ''.join(state.choice(list('ACGT'), length))
+
+
+def referencesketches(tmpdir, genomes, size=1000):
+    """
+    Sketch each of the genomes, and load the sketches as references
+    """
+    sketches = list()
+    for index, genome in enumerate(genomes):
+        sketch = Sketch(kmer=21, size=size)
+        sketch.add([genome])
+        sketches.append({'name': 'reference{}'.format(index), 'length': sketch.length, 'hashes': sketch.hashes})
+    sketchfile = str(tmpdir.join('references.json'))
+    writesketches(sketchfile, sketches, kmer=21, size=size)
+    return References(sketchfile)
+
+
+def readfile(tmpdir, genome, count, state, length=100):
+    """
+    Write a FASTQ file of reads sampled from a genome
+    """
+    fastq = str(tmpdir.join('reads.fastq'))
+    starts = state.randint(0, len(genome) - length + 1, count)
+    fastqwriter((('@read{}'.format(index), genome[start:start + length], 'I' * length)
+                 for index, start in enumerate(starts)), fastq)
+    return fastq
+
+
+def test_murmur3():
+    # First 64 bits of MurmurHash3_x64_128, as calculated by the reference implementation
+    assert murmurhash('hello', 42) == 14175277504640544520
+    assert murmurhash('The quick brown fox jumps over the lazy dog', 0) == 16378391709484522348
+    assert murmurhash('AAAAAAAAAAAAAAAA', 42) == 13494848630691601671
+    assert murmurhash('', 42) == 17305828677633410339
+
+
+def test_mash_kmer_hashes():
+    # mash hashes the lexicographically smaller of each k-mer and its reverse complement
+    assert list(kmerhashes(['ACGTACGTACGTACGTACGTA'], 21)) == [13036166743686632327]
+    assert list(kmerhashes(['TACGTACGTACGTACGTACGT'], 21)) == [13036166743686632327]
+    assert not len(kmerhashes(['ACGTACGTACNTACGTACGTA'], 21))
+
+
+def test_distance():
+    # mash dist genome1.msh genome2.msh: genome1.fna genome2.fna 0.0222766 0 456/1000
+    distances = distance(numpy.array([456, 1000, 0]), numpy.array([1000, 1000, 1000]), 21)
+    assert '{:g}'.format(distances[0]) == '0.0222766'
+    assert distances[1] == 0
+    assert distances[2] == 1
+    assert pvalue(456, 5000000, 5000000, 21, 1000) == 0
+    assert pvalue(0, 5000000, 5000000, 21, 1000) == 1
+
+
+def test_pvalue():
+    # Compare the summation of the tail of the binomial distribution to the exact tail for small sketches
+    for shared, length, kmer, sketchsize in [(1, 1000, 5, 10), (3, 100, 4, 10), (8, 5000, 6, 20), (2, 50, 8, 5)]:
+        px = 1. / (1. + 4. ** kmer / length)
+        r = px * px / (px + px - px * px)
+        exact = sum(factorial(sketchsize) // (factorial(count) * factorial(sketchsize - count)) *
+                    r ** count * (1 - r) ** (sketchsize - count) for count in range(shared, sketchsize + 1))
+        assert abs(pvalue(shared, length, length, kmer, sketchsize) - exact) <= 1e-12 * max(exact, 1e-300)
+
+
+def test_adaptivesketch(tmpdir):
+    state = numpy.random.RandomState(0)
+    genomes = [randomsequence(20000, state) for _ in range(3)]
+    references = referencesketches(tmpdir, genomes, size=200)
+    fastq = readfile(tmpdir, genomes[0], 60000, state)
+    # The reads are sketched in chunks of 10000 reads, and the closest reference is settled by the first chunk, so
+    # sketching stops once the margin has remained the same for three further chunks
+    sketch = adaptivesketch(fastq, references)
+    assert sketch['comment'] == 'adaptive sketch of the first 40000 reads'
+    assert sketch['length'] == 4000000
+    distances = distance(*references.distances(sketch['hashes']), kmer=21)
+    assert numpy.argmin(distances) == 0
+    # Without enough consecutive stable chunks, all the reads are sketched
+    assert adaptivesketch(fastq, references, patience=10)['comment'] == 'adaptive sketch of the first 60000 reads'
+
+
+def test_screen(tmpdir):
+    state = numpy.random.RandomState(1)
+    genomes = [randomsequence(20000, state) for _ in range(3)]
+    references = referencesketches(tmpdir, genomes)
+    # Reads of the whole of the first genome, and of half of the second genome. The third genome is absent
+    fastq = readfile(tmpdir, genomes[0] + 'N' + genomes[1][:10000], 20000, state)
+    containment = references.screen([fastq])
+    # Compare to the fraction of the hashes of each reference present in the k-mers of the reads
+    with open(fastq) as reads:
+        sequences = reads.read().split('\n')[1::4]
+    readhashes = set(kmerhashes(sequences, 21).tolist())
+    for index in range(len(genomes)):
+        hashes = set(references.hashes[numpy.asarray(references.owners) == index].tolist())
+        assert containment[index] == len(hashes & readhashes) / len(hashes)
+    assert containment[0] > 0.95
+    assert 0.3 < containment[1] < 0.7
+    assert containment[2] == 0
+
+
+def test_lsh_recall(tmpdir):
+    # Sketch random references, and mutated copies of each reference as queries
+    state = numpy.random.RandomState(0)
+    genomes = [randomsequence(20000, state) for _ in range(50)]
+    references = referencesketches(tmpdir, genomes)
+    found = 0
+    for index, genome in enumerate(genomes):
+        # Mutate 1% of the bases (a mash distance of roughly 0.01)
+        sequence = numpy.array(list(genome))
+        positions = state.choice(len(genome), len(genome) // 100, replace=False)
+        sequence[positions] = ['ACGT'[('ACGT'.index(base) + 1) % 4] for base in sequence[positions]]
+        sketch = Sketch(kmer=21, size=1000)
+        sketch.add([''.join(sequence)])
+        query = {'name': 'query{}'.format(index), 'length': sketch.length, 'hashes': sketch.hashes}
+        candidates = references.candidates(numpy.array(query['hashes'], dtype=numpy.uint64))
+        found += index in candidates
+        # The closest reference is the same with and without the locality-sensitive hashing index
+        exhaustive = list(references.lines(query, limit=1))
+        assert list(references.lines(query, limit=1, lsh=True)) == exhaustive
+        assert exhaustive[0].startswith('reference{}\t'.format(index))
+    assert found == len(genomes)
+
+
+def test_lsh_time(tmpdir):
+    # Thousands of references drawn from a shared pool of hashes, so that, as with related genomes, each hash of a
+    # query is present in many references
+    state = numpy.random.RandomState(2)
+    pool = numpy.unique(state.randint(0, 2 ** 63, size=200000, dtype=numpy.int64).astype(numpy.uint64))
+    sketches = [{'name': 'reference{}'.format(index), 'length': 5000000,
+                 'hashes': pool[numpy.unique(state.randint(0, len(pool), 1100))[:1000]].tolist()}
+                for index in range(3000)]
+    sketchfile = str(tmpdir.join('references.json'))
+    writesketches(sketchfile, sketches)
+    references = References(sketchfile)
+    # Replace 5% of the hashes of one of the references to create the query
+    hashes = numpy.array(sketches[5]['hashes'], dtype=numpy.uint64)
+    hashes[state.choice(len(hashes), 50, replace=False)] = state.choice(pool, 50)
+    query = {'name': 'query', 'length': 5000000, 'hashes': numpy.unique(hashes).tolist()}
+    candidates = references.candidates(numpy.array(query['hashes'], dtype=numpy.uint64))
+    assert 5 in candidates and len(candidates) < 100
+    # The distances to the candidates are the same as the distances calculated by comparing every reference
+    shared, denominators = references.distances(query['hashes'])
+    candidateshared, candidatedenominators = references.distances(query['hashes'], candidates)
+    assert (candidateshared == shared[candidates]).all()
+    assert (candidatedenominators == denominators[candidates]).all()
+    exhaustive = list(references.lines(query, limit=1))
+    assert list(references.lines(query, limit=1, lsh=True)) == exhaustive
+    # Only the hashes of the candidates are searched, so the comparison is faster than an exhaustive comparison
+    exhaustivetime = min(timeit.repeat(lambda: list(references.lines(query, limit=1)), number=5, repeat=5))
+    lshtime = min(timeit.repeat(lambda: list(references.lines(query, limit=1, lsh=True)), number=5, repeat=5))
+    assert lshtime * 2 < exhaustivetime
@@ -0,0 +1,110 @@
+#!/usr/bin/env python 3
+from collections import defaultdict
+import numpy
+import sys
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+scriptpath = os.path.join(testpath, '..')
+sys.path.append(scriptpath)
+from MLSTsippr.profiles import Profile, sortalleles
+
+__author__ = 'adamkoziol'
+
+GENES = ['BACT000001', 'BACT000002', 'BACT000003', 'BACT000014', 'BACT000060', 'BACT000065', 'BACT000100']
+
+
+def profilefile(tmpdir, count=300, seed=0):
+    """
+    Write a profile with few alleles per gene, so that many sequence types share alleles, and with 'N' and multiple
+    allele entries
+    """
+    state = numpy.random.RandomState(seed)
+    entries = ['1', '2', '3', 'N', '10 692']
+    profile = dict()
+    with open(str(tmpdir.join('profile.txt')), 'w') as handle:
+        handle.write('ST\t{}\n'.format('\t'.join(GENES)))
+        for sequencetype in range(1, count + 1):
+            alleles = [entries[index] for index in state.choice(len(entries), len(GENES), p=[.4, .3, .1, .1, .1])]
+            profile[str(sequencetype)] = dict(zip(GENES, alleles))
+            handle.write('{}\t{}\n'.format(sequencetype, '\t'.join(alleles)))
+    return str(tmpdir.join('profile.txt')), profile
+
+
+def queries(count, seed=1):
+    state = numpy.random.RandomState(seed)
+    entries = ['1', '2', '3', '4', 'N', '692 10', 'NA']
+    alleles = list()
+    identities = list()
+    for _ in range(count):
+        query = {gene: entries[index] for gene, index in zip(GENES, state.choice(len(entries), len(GENES)))}
+        # Query alleles are sorted in the same way as in the analysis
+        alleles.append({gene: sortalleles(allele) if allele != 'N' else allele for gene, allele in query.items()})
+        identities.append({gene: 0 if allele == 'N' else state.choice(['100.00', '99.50'], p=[.8, .2])
+                           for gene, allele in query.items()})
+    return alleles, identities
+
+
+def baselinematches(profile, query, identity):
+    """
+    Number of matching genes of every sequence type, as calculated by the dictionary-based sequence typer
+    """
+    bestmatch = defaultdict(int)
+    for gene in GENES:
+        allele = query[gene]
+        percentid = identity[gene]
+        for sequencetype in profile:
+            sortedrefallele = sortalleles(profile[sequencetype][gene])
+            if allele == sortedrefallele and float(percentid) == 100.00:
+                bestmatch[sequencetype] += 1
+            elif gene == 'BACT000060' or gene == 'BACT000065' or gene == 'BACT000014':
+                if sortedrefallele == 'N' and allele != 'N':
+                    bestmatch[sequencetype] += 1
+            elif allele == sortedrefallele and sortedrefallele == 'N':
+                bestmatch[sequencetype] += 1
+    return bestmatch
+
+
+def test_typing(tmpdir):
+    filename, profile = profilefile(tmpdir)
+    profiledata = Profile(filename, GENES)
+    alleles, identities = queries(200)
+    for (matches, mismatches), query, identity in zip(profiledata.typing(alleles, identities), alleles, identities):
+        bestmatch = baselinematches(profile, query, identity)
+        best = max(bestmatch.values()) if bestmatch else 0
+        assert matches == {sequencetype: best for sequencetype, count in bestmatch.items() if count == best and best}
+        for sequencetype, genes in mismatches.items():
+            assert genes == {gene for gene in GENES
+                             if sortalleles(profile[sequencetype][gene]) != query[gene]}
+
+
+def test_compiled_profile(tmpdir):
+    filename, profile = profilefile(tmpdir)
+    Profile(filename, GENES)
+    # The compiled profile is reused, even if the genes are supplied in a different order
+    genes = list(reversed(GENES))
+    profiledata = Profile(filename, genes)
+    assert os.path.isfile(profiledata.compiledfiles(filename)[0])
+    for sequencetype in profile:
+        assert profiledata[sequencetype] == {gene: sortalleles(allele) for gene, allele in
+                                             profile[sequencetype].items()}
+        assert profiledata.allele(sequencetype, 'BACT000060') == sortalleles(profile[sequencetype]['BACT000060'])
+    assert profiledata.allele('NA', 'BACT000060') == ''
+
+
+def test_nearest(tmpdir):
+    filename, profile = profilefile(tmpdir)
+    profiledata = Profile(filename, GENES)
+    alleles, identities = queries(200, seed=2)
+    for query, identity in zip(alleles, identities):
+        bestmatch = baselinematches(profile, query, identity)
+        for tolerance in [0, 2, 3]:
+            # Brute force: every sequence type within the tolerance, sorted by mismatches and then by the order of
+            # the sequence types in the profile
+            expected = sorted((sequencetype for sequencetype in profile
+                               if len(GENES) - bestmatch[sequencetype] <= tolerance),
+                              key=lambda sequencetype: (len(GENES) - bestmatch[sequencetype], int(sequencetype)))[:5]
+            nearest = profiledata.nearest(query, identity, k=5, tolerance=tolerance)
+            assert [sequencetype for sequencetype, _ in nearest] == expected
+            for sequencetype, genes in nearest:
+                assert len(genes) == len(GENES) - bestmatch[sequencetype]
@@ -0,0 +1,53 @@
+#!/usr/bin/env python 3
+import sys
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+scriptpath = os.path.join(testpath, '..')
+sys.path.append(scriptpath)
+from MASHsippr.refseqindex import RefSeqIndex
+
+__author__ = 'adamkoziol'
+
+
+def summaryfile(tmpdir, organism):
+    """
+    Write a RefSeq assembly summary file with a single assembly of the supplied organism
+    """
+    summary = tmpdir.join('assembly_summary_refseq.txt')
+    fields = ['GCF_001298055.1', 'PRJNA224116', 'SAMN04029595', '', 'representative genome', '35818', '35818',
+              organism, 'strain=CCUG 33837', '', 'latest', 'Scaffold', 'Major', 'Full', '2015/10/05']
+    summary.write('#   See ftp://ftp.ncbi.nlm.nih.gov/genomes/README_assembly_summary.txt for a description of the '
+                  'columns\n# assembly_accession\tbioproject\n{}\n'.format('\t'.join(fields)))
+    return str(summary)
+
+
+def lookup(summary):
+    index = RefSeqIndex(summary)
+    try:
+        return index['GCF_001298055']
+    finally:
+        index.close()
+
+
+def test_index_reused(tmpdir):
+    summary = summaryfile(tmpdir, 'Listeria ivanovii')
+    assert lookup(summary) == 'Listeria ivanovii'
+    indexfile = os.path.splitext(summary)[0] + '.sqlite'
+    inode = os.stat(indexfile).st_ino
+    # Touching the summary file changes its modification time, but not its checksum, so the index is reused
+    os.utime(summary, ns=(0, os.stat(summary).st_mtime_ns + 10 ** 9))
+    assert lookup(summary) == 'Listeria ivanovii'
+    assert os.stat(indexfile).st_ino == inode
+    assert not tmpdir.listdir(lambda path: path.ext == '.tmp')
+
+
+def test_index_rebuilt(tmpdir):
+    summary = summaryfile(tmpdir, 'Listeria ivanovii')
+    assert lookup(summary) == 'Listeria ivanovii'
+    # Replace the organism with one of the same length, so that only the modification time and checksum of the
+    # summary file reveal the change
+    mtime = os.stat(summary).st_mtime_ns
+    summaryfile(tmpdir, 'Shigella flexneri')
+    os.utime(summary, ns=(0, mtime + 10 ** 9))
+    assert lookup(summary) == 'Shigella flexneri'
@@ -0,0 +1,91 @@
+#!/usr/bin/env python 3
+from types import SimpleNamespace
+import pytest
+import numpy
+import sys
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+scriptpath = os.path.join(testpath, '..')
+sys.path.append(scriptpath)
+from sixteenS.sixteens_full import SixteenS
+from sixteenS.descriptions import DescriptionIndex, databasefile
+from fastsippr.fastqio import fastqwriter
+
+__author__ = 'adamkoziol'
+
+
+def sixteens(subsamplereads):
+    """
+    Create a SixteenS object with only the attributes used to subsample reads
+    """
+    analysis = SixteenS.__new__(SixteenS)
+    analysis.analysistype = 'sixteens_full'
+    analysis.subsamplereads = subsamplereads
+    analysis.seed = 1
+    analysis.threads = 1
+    analysis.devnull = open(os.devnull, 'w')
+    return analysis
+
+
+def baitedsample(tmpdir, count):
+    state = numpy.random.RandomState(0)
+    reads = list()
+    for index in range(count):
+        sequence = ''.join(state.choice(list('ACGT'), 50))
+        # Include reads with unknown bases
+        if index % 10 == 0:
+            sequence = sequence[:25] + 'N' + sequence[26:]
+        reads.append(('@read{} 1:N:0:1'.format(index), sequence, 'I' * 50))
+    fastq = str(tmpdir.join('sixteens_full_targetMatches.fastq.gz'))
+    fastqwriter(reads, fastq)
+    return {'sixteens_full': SimpleNamespace(baitedfastq=fastq)}, reads
+
+
+def test_streamblast(tmpdir):
+    # Stream the subsampled reads into a command in place of BLAST
+    sample, _ = baitedsample(tmpdir, 500)
+    analysis = sixteens(100)
+    streamed = str(tmpdir.join('streamed.fa'))
+    assert analysis.streamblast(sample, 'cat > {}'.format(streamed))
+    with open(streamed) as handle:
+        assert handle.read() == ''.join(analysis.fastarecords(sample))
+    # Failures of the command are reported
+    assert not analysis.streamblast(sample, 'exit 1')
+
+
+def test_databasefile(tmpdir):
+    with pytest.raises(FileNotFoundError):
+        databasefile(str(tmpdir))
+    # The combined target file of the sixteenS analysis
+    combined = tmpdir.join('16S.fasta')
+    combined.write('>gi|1018196593|ref|NR_136472.1| Escherichia marmotae strain HT073016 16S ribosomal RNA\nACGT\n')
+    assert databasefile(str(tmpdir)) == str(combined)
+    # The database of the sixteens_full analysis in the bait folder
+    database = tmpdir.mkdir('bait').join('NCBI_16S.fa')
+    database.write(combined.read())
+    assert databasefile(str(tmpdir)) == str(database)
+    descriptions = DescriptionIndex(databasefile(str(tmpdir)))
+    assert descriptions['gi|1018196593|ref|NR_136472.1|'][:2] == ('Escherichia', 'marmotae')
+    descriptions.close()
+
+
+def test_fastarecords(tmpdir):
+    sample, reads = baitedsample(tmpdir, 500)
+    analysis = sixteens(100)
+    records = list(analysis.fastarecords(sample))
+    # The same reads are subsampled on every run
+    assert records == list(analysis.fastarecords(sample))
+    # Reads with unknown bases are discarded after subsampling
+    assert 80 <= len(records) < 100
+    expected = {'>{}\n{}\n'.format(header[1:], sequence) for header, sequence, _ in reads if 'N' not in sequence}
+    assert set(records) <= expected
+    assert len(set(records)) == len(records)
+
+
+def test_fastarecords_all_reads(tmpdir):
+    # Samples with fewer reads than the subsample keep every read without unknown bases
+    sample, reads = baitedsample(tmpdir, 50)
+    records = list(sixteens(100).fastarecords(sample))
+    assert records == ['>{}\n{}\n'.format(header[1:], sequence) for header, sequence, _ in reads
+                       if 'N' not in sequence]